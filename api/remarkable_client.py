@@ -1,13 +1,20 @@
 
 import os
-from io import BytesIO
-import requests
+import time
+import base64
+import threading
 from uuid import uuid4
 from pathlib import Path
 import json
+from email.utils import parsedate_to_datetime
 
 import utils.config as cfg
-from utils.helper import Singleton
+import utils.timing as timing
+from utils.helper import Singleton, LazyModule
+from utils.concurrency import AdaptiveLimiter
+
+# Loaded with the first request such that it does not delay the startup
+requests = LazyModule("requests")
 
 # 
 # EVENTS
@@ -36,6 +43,123 @@ UPDATE_STATUS_URL = BASE_URL + "/document-storage/json/2/upload/update-status"
 UPLOAD_REQUEST_URL = BASE_URL + "/document-storage/json/2/upload/request"
 DELETE_ENTRY_URL = BASE_URL + "/document-storage/json/2/delete"
 
+# Max. number of items that are sent with one bulk request
+BULK_CHUNK_SIZE = 100
+
+# Redirects all requests e.g. to a local mock cloud (see set_base_url)
+ENV_BASE_URL = "REMAPY_BASE_URL"
+
+# The user token is renewed in the background this many seconds before 
+# it expires
+USER_TOKEN_REFRESH_MARGIN = 5 * 60
+
+# Upper bound of concurrent requests (see AdaptiveLimiter)
+MAX_CONCURRENT_REQUESTS = 16
+
+# Throttled (429) or failed (5xx) requests are retried this many times
+MAX_RETRIES = 3
+RETRY_BACKOFF_SECONDS = 1.0
+
+# Interrupted downloads are resumed this many times (see download_file)
+MAX_RESUMES = 5
+
+
+#
+# HELPER
+#
+class IncompleteDownloadError(IOError):
+    pass
+
+
+def set_base_url(base_url):
+    """ Sends all requests (including authentication) to the given url 
+        rather than to the rm cloud, e.g. to benchmarks/mock_cloud.py
+    """
+    global BASE_URL, DEVICE_TOKEN_URL, USER_TOKEN_URL, LIST_DOCS_URL, \
+        UPDATE_STATUS_URL, UPLOAD_REQUEST_URL, DELETE_ENTRY_URL
+
+    BASE_URL = base_url.rstrip("/")
+    DEVICE_TOKEN_URL = BASE_URL + "/token/json/2/device/new"
+    USER_TOKEN_URL = BASE_URL + "/token/json/2/user/new"
+    LIST_DOCS_URL = BASE_URL + "/document-storage/json/2/docs"
+    UPDATE_STATUS_URL = BASE_URL + "/document-storage/json/2/upload/update-status"
+    UPLOAD_REQUEST_URL = BASE_URL + "/document-storage/json/2/upload/request"
+    DELETE_ENTRY_URL = BASE_URL + "/document-storage/json/2/delete"
+
+
+def get_token_expiry(token):
+    """ Returns the expiry (unix time) of the given JWT or None if it 
+        is unknown.
+    """
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload)).get("exp", None)
+    except Exception:
+        return None
+
+
+def parse_content_range(value):
+    """ Returns (start, length) of a Content-Range header such as 
+        "bytes 100-199/200". The length is None if it is unknown.
+    """
+    try:
+        unit, value = value.split(" ", 1)
+        byte_range, length = value.split("/")
+        start = int(byte_range.split("-")[0])
+        return start, None if length == "*" else int(length)
+    except Exception:
+        return None, None
+
+
+def parse_retry_after(value):
+    """ Returns the seconds of a Retry-After header (either seconds or 
+        a http date) or None if it is not given.
+    """
+    if value is None:
+        return None
+
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+class ProgressReader(object):
+    """ Wraps a file object and reports how many bytes were read from it
+        such that we can show the progress of streamed uploads.
+    """
+
+    def __init__(self, file, progress):
+        self.file = file
+        self.progress = progress
+        self.bytes_read = 0
+
+        self.file.seek(0, os.SEEK_END)
+        self.size = self.file.tell()
+        self.file.seek(0)
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size=-1):
+        chunk = self.file.read(size)
+        self.bytes_read += len(chunk)
+        self.progress(self.bytes_read, self.size)
+        return chunk
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.bytes_read = self.file.seek(offset, whence)
+        return self.bytes_read
+
+    def tell(self):
+        return self.file.tell()
+
 
 #
 # CLIENT
@@ -64,58 +188,160 @@ class RemarkableClient():
                     print(e)
 
 
+    class UserTokenHandler(metaclass=Singleton):
+        """ Shares the user token between all clients and renews it in 
+            the background shortly before it expires.
+        """
+        def __init__(self):
+            self.user_token = None
+            self._lock = threading.Lock()
+            self._timer = None
+        
+        def get(self):
+            if self.user_token is None:
+                return cfg.get("authentication.user_token")
+            return self.user_token
+
+        def is_valid(self, user_token):
+            if user_token is None or user_token == "":
+                return False
+
+            # Without an expiry we can not know, therefore we renew it
+            expiry = get_token_expiry(user_token)
+            return expiry != None and expiry - USER_TOKEN_REFRESH_MARGIN > time.time()
+
+        def set(self, user_token, renew):
+            """ renew(device_token) requests a new user token.
+            """
+            self.user_token = user_token
+
+            if self._timer != None:
+                self._timer.cancel()
+                self._timer = None
+
+            expiry = get_token_expiry(user_token)
+            if expiry is None:
+                return
+
+            # Short-lived tokens are renewed after half of their lifetime
+            remaining = expiry - time.time()
+            delay = remaining - USER_TOKEN_REFRESH_MARGIN
+            if remaining < 2 * USER_TOKEN_REFRESH_MARGIN:
+                delay = remaining / 2
+            delay = max(1, delay)
+            self._timer = threading.Timer(delay, self.refresh, args=(renew,))
+            self._timer.daemon = True
+            self._timer.start()
+
+        def refresh(self, renew, expired_token=None):
+            """ Renews the user token. If expired_token is given and another
+                thread renewed it in the meantime, nothing is requested.
+                return: True if a new user token is available
+            """
+            with self._lock:
+                if expired_token != None and self.get() != expired_token:
+                    return True
+
+                device_token = cfg.get("authentication.device_token")
+                user_token = renew(device_token)
+                if user_token is None:
+                    print("(Warning) Failed to renew user token.")
+                    return False
+
+                cfg.save({"authentication": {
+                    "device_token": device_token,
+                    "user_token": user_token}})
+                self.set(user_token, renew)
+                return True
+
+
+    class RequestLimiter(AdaptiveLimiter, metaclass=Singleton):
+        """ Adapts the number of concurrent requests of all clients to the
+            bandwidth and to the throttling of the server. general.syncworkers
+            fixes the number of concurrent requests instead.
+        """
+        def __init__(self):
+            workers = cfg.get("general.syncworkers", default=None)
+            if workers is None:
+                super().__init__(maximum=MAX_CONCURRENT_REQUESTS)
+            else:
+                super().__init__(maximum=int(workers), adaptive=False)
+
+
     def __init__(self):
         self.test = True
         self.listener_handler = self.SignInListenerHandler()
+        self.token_handler = self.UserTokenHandler()
+        self.limiter = self.RequestLimiter()
 
     def listen_sign_in_event(self, subscriber):
         self.listener_handler.listen_sign_in_event(subscriber)   
 
 
-    def sign_in(self, onetime_code=None):
+    def sign_in(self, onetime_code=None, dispatch=None):
         """ Load token. If not available the user must provide a 
             one time code from https://my.remarkable.com/connect/remarkable
+            If dispatch is given, events are published through 
+            dispatch(publish, event, data) e.g. on the gui thread.
         """ 
+        publish = self.listener_handler.publish
+        if dispatch != None:
+            publish = lambda *args: dispatch(self.listener_handler.publish, *args)
 
         try:
             # Get device token if not stored local
             device_token = cfg.get("authentication.device_token")
+            user_token = cfg.get("authentication.user_token")
             if device_token == None:
                 if onetime_code is None or onetime_code == "":
-                    self.listener_handler.publish(EVENT_ONETIMECODE_NEEDED)
+                    publish(EVENT_ONETIMECODE_NEEDED)
                     return
 
                 device_token = self._get_device_token(onetime_code)
                 if device_token is None:
-                    self.listener_handler.publish(EVENT_DEVICE_TOKEN_FAILED)
+                    publish(EVENT_DEVICE_TOKEN_FAILED)
                     return            
+                user_token = None
             
-            # Renew the user token.
-            user_token = self._get_user_token(device_token)
-            if user_token is None:
-                self.listener_handler.publish(EVENT_USER_TOKEN_FAILED)
-                return
+            # Renew the user token only if it expires soon.
+            if not self.token_handler.is_valid(user_token):
+                user_token = self._get_user_token(device_token)
+                if user_token is None:
+                    publish(EVENT_USER_TOKEN_FAILED)
+                    return
             
             # Save tokens to config
             auth = {"device_token": device_token,
                     "user_token": user_token}
             cfg.save({"authentication": auth})
+            self.token_handler.set(user_token, self._get_user_token)
 
             # Inform all subscriber
-            self.listener_handler.publish(EVENT_SUCCESS, auth)
+            publish(EVENT_SUCCESS, auth)
         except:
             auth={}
-            self.listener_handler.publish(EVENT_FAILED, auth)
+            publish(EVENT_FAILED, auth)
 
         return auth
+
+
+    def sign_in_async(self, onetime_code=None, dispatch=None):
+        """ Signs in (see sign_in) without blocking the caller such that 
+            e.g. the window is shown while the user token is renewed.
+        """
+        thread = threading.Thread(target=self.sign_in, 
+            args=(onetime_code, dispatch), daemon=True)
+        thread.start()
+        return thread
         
 
     def get_item(self, id):
         
-        response = self._request("GET", LIST_DOCS_URL, params={
-            "doc": id,
-            "withBlob": True
-        })
+        with timing.phase("client.get_item"):
+            response = self._request("GET", LIST_DOCS_URL, params={
+                "doc": id,
+                "withBlob": True
+            })
         
         if response.ok:
             items = response.json()
@@ -125,20 +351,41 @@ class RemarkableClient():
 
     
     def delete_item(self, id, version):
+        deleted_ids = self.delete_items([(id, version)])
+        return id in deleted_ids
+
+
+    def delete_items(self, entries):
+        """ Deletes all given (id, version) entries with one request per 
+            BULK_CHUNK_SIZE entries. A failed request or a failed entry 
+            does not abort the deletion of the other entries.
+            return: set of ids that were deleted successfully
+        """
+        deleted_ids = set()
+        for i in range(0, len(entries), BULK_CHUNK_SIZE):
+            chunk = entries[i:i+BULK_CHUNK_SIZE]
+            try:
+                response = self._request("PUT", DELETE_ENTRY_URL, body=[{
+                    "ID": id,
+                    "Version": version
+                } for id, version in chunk])
+            except Exception as e:
+                print("(Error) Delete request failed")
+                print(e)
+                continue
+            
+            if not response.ok:
+                print("(Error) Delete request failed")
+                continue
+            
+            deleted_ids.update(self._successful_ids(response, "delete"))
         
-        response = self._request("PUT", DELETE_ENTRY_URL, body=[{
-            "ID": id,
-            "Version": version
-        }])
-        
-        if response.ok:
-            return True
-        
-        return False
+        return deleted_ids
     
 
     def list_items(self):
-        response = self._request("GET", LIST_DOCS_URL)
+        with timing.phase("client.list_items"):
+            response = self._request("GET", LIST_DOCS_URL)
 
         if response.ok:
             items = response.json()
@@ -152,16 +399,124 @@ class RemarkableClient():
         return None
     
 
-    def get_raw_file(self, blob_url):
-        stream = self._request("GET", blob_url, stream=True)
-        zip_io = BytesIO()
-        for chunk in stream.iter_content(chunk_size=8192):
-            zip_io.write(chunk)
-        return zip_io.getbuffer()
+    def download_file(self, blob_url, path, version=None):
+        """ Downloads the blob into the given file. The data is written to
+            path.part first such that an interrupted download is resumed 
+            with a range request (also by a later sync) rather than 
+            started again. The partial data is only used if the etag, the 
+            length and the given version of the blob did not change.
+        """
+        path_part = "%s.part" % path
+        path_info = "%s.part.json" % path
+        info = self._read_part_info(path_part, path_info, version)
+
+        for attempt in range(MAX_RESUMES + 1):
+            try:
+                if self._download_part(blob_url, path_part, path_info, info):
+                    os.replace(path_part, path)
+                    os.remove(path_info)
+                    return path
+
+            except (requests.exceptions.ConnectionError, 
+                    requests.exceptions.ChunkedEncodingError, 
+                    requests.exceptions.Timeout, 
+                    IncompleteDownloadError) as e:
+                if attempt >= MAX_RESUMES:
+                    raise
+                print("(Warning) Download interrupted, resume at %d bytes." % 
+                    (os.path.getsize(path_part) if os.path.exists(path_part) else 0))
+                print(e)
+                time.sleep(RETRY_BACKOFF_SECONDS)
+
+        raise IncompleteDownloadError("Could not download %s" % path)
+
+
+    def _download_part(self, blob_url, path_part, path_info, info):
+        """ Downloads the rest of the blob into path_part. Returns False if 
+            the partial data is invalid and the download must start again.
+        """
+        offset = os.path.getsize(path_part) if os.path.exists(path_part) else 0
+        headers = {}
+        if offset > 0:
+            headers["Range"] = "bytes=%d-" % offset
+            if info.get("etag") != None:
+                headers["If-Range"] = info["etag"]
+
+        # The slot is held until the body is read such that the limiter
+        # sees the time and throughput of the whole transfer
+        with timing.phase("client.download"), self.limiter.slot() as slot:
+            response = self._request("GET", blob_url, headers=headers, stream=True)
+
+            # The partial data does not match the blob (anymore)
+            if response.status_code == 416:
+                response.close()
+                self._remove_part(path_part, path_info)
+                return False
+            response.raise_for_status()
+
+            etag = response.headers.get("ETag", None)
+            if response.status_code == 206:
+                start, length = parse_content_range(response.headers.get("Content-Range", None))
+                if start != offset or (info.get("length") != None and length != info["length"]) or \
+                        (info.get("etag") != None and etag != info["etag"]):
+                    response.close()
+                    self._remove_part(path_part, path_info)
+                    return False
+            else:
+                # The server ignored the range (or the blob changed)
+                offset = 0
+                length = response.headers.get("Content-Length", None)
+                length = int(length) if length != None else None
+
+            info.update({"etag": etag, "length": length})
+            with open(path_info, "w") as out:
+                out.write(json.dumps(info))
+
+            with open(path_part, "ab" if offset > 0 else "wb") as out:
+                for chunk in response.iter_content(chunk_size=64*1024):
+                    out.write(chunk)
+                    slot.add_bytes(len(chunk))
+                    timing.count("client.download_bytes", len(chunk))
+
+        size = os.path.getsize(path_part)
+        if length != None and size < length:
+            raise IncompleteDownloadError("Received %d of %d bytes" % (size, length))
+        if length != None and size > length:
+            self._remove_part(path_part, path_info)
+            return False
+        return True
+
+
+    def _read_part_info(self, path_part, path_info, version):
+        info = {}
+        if os.path.exists(path_part) and os.path.exists(path_info):
+            try:
+                with open(path_info) as f:
+                    info = json.loads(f.read())
+            except Exception as e:
+                print("(Warning) Failed to read %s." % path_info)
+                print(e)
+
+        if info.get("version", version) != version or \
+                (os.path.exists(path_part) and not os.path.exists(path_info)):
+            self._remove_part(path_part, path_info)
+            info = {}
+
+        info["version"] = version
+        return info
+
+
+    def _remove_part(self, path_part, path_info):
+        for path in [path_part, path_info]:
+            if os.path.exists(path):
+                os.remove(path)
     
 
-    def upload(self, id, metadata, zip_file):
-        response = self._request("PUT", "/document-storage/json/2/upload/request",
+    def upload(self, id, metadata, zip_file, progress=None):
+        """ Uploads the given zip file. The optional progress function is 
+            called with (bytes sent, total bytes) while the file is sent.
+        """
+        response = self._request("PUT", UPLOAD_REQUEST_URL,
                            body=[{
                                "ID": id,
                                "Type": "DocumentType",
@@ -174,7 +529,10 @@ class RemarkableClient():
         response = response.json()
         blob_url = response[0].get("BlobURLPut", None)
 
-        response = self._request("PUT", blob_url, data=zip_file.getvalue())
+        # Stream the (spooled) zip file rather than copying it into memory
+        zip_file.seek(0)
+        data = zip_file if progress is None else ProgressReader(zip_file, progress)
+        response = self._request("PUT", blob_url, data=data)
         zip_file.seek(0)
         if not response.ok:        
             print("(Error) Upload request failed")
@@ -190,7 +548,71 @@ class RemarkableClient():
             return 
 
         return self.get_item(metadata["ID"])
+
+
+    def update_metadata_bulk(self, metadata_list):
+        """ Updates the metadata of all given items with one request per 
+            BULK_CHUNK_SIZE items. A failed request or a failed entry does
+            not abort the update of the other entries. The new versions 
+            are fetched afterwards with a single listing request.
+            return: dict id -> new metadata of the items that were updated
+                    successfully (None if the listing failed)
+        """
+        updated_ids = set()
+        for i in range(0, len(metadata_list), BULK_CHUNK_SIZE):
+            chunk = metadata_list[i:i+BULK_CHUNK_SIZE]
+            try:
+                response = self._request("PUT", UPDATE_STATUS_URL, body=chunk)
+            except Exception as e:
+                print("(Error) Update status request failed")
+                print(e)
+                continue
+
+            if not response.ok:
+                print("(Error) Update status request failed")
+                continue
+
+            updated_ids.update(self._successful_ids(response, "update"))
         
+        if len(updated_ids) <= 0:
+            return {}
+
+        try:
+            items = self.list_items()
+        except Exception as e:
+            print("(Warning) Failed to fetch the new versions")
+            print(e)
+            items = None
+
+        if items is None:
+            return {id: None for id in updated_ids}
+
+        cloud_items = {item["ID"]: item for item in items if item["ID"] in updated_ids}
+        return {id: cloud_items.get(id, None) for id in updated_ids}
+
+
+    def _successful_ids(self, response, action):
+        """ Returns the ids of all entries of a bulk request that succeeded.
+            The cloud reports the result of each entry; without it we can 
+            not know what succeeded, therefore nothing did.
+        """
+        try:
+            results = response.json()
+        except ValueError:
+            results = None
+
+        if not isinstance(results, list):
+            print("(Error) Invalid response of %s request" % action)
+            return set()
+
+        ids = set()
+        for result in results:
+            if result.get("Success", True) and result.get("ID") != None:
+                ids.add(result.get("ID"))
+            else:
+                print("(Warning) Could not %s %s: %s" % (action, result.get("ID"), result.get("Message", "")))
+        return ids
+
 
     def _get_device_token(self, one_time_code):
         """ Create a new device for a given one_time_code to be able to 
@@ -231,7 +653,7 @@ class RemarkableClient():
 
     def _request(self, method, path,
                 data=None, body=None, headers=None,
-                params=None, stream=False):
+                params=None, stream=False, retry_auth=True):
         """Creates a request against the Remarkable Cloud API
         This function automatically fills in the blanks of base
         url & authentication.
@@ -244,13 +666,12 @@ class RemarkableClient():
             headers: a dict of additional headers to add to the request.
             params: Query params to append to the request.
             stream: Should the response be a stream?
+            retry_auth: Renew the user token and retry once on 401
         Returns:
             A Response instance containing most likely the response from
             the server.
         """
 
-        config = cfg.load()
-
         if headers is None:
             headers = {}
        
@@ -265,22 +686,57 @@ class RemarkableClient():
             "user-agent": USER_AGENT,
         }
 
-        user_token = cfg.get("authentication.user_token")
+        user_token = self.token_handler.get()
         if user_token != None:
             _headers["Authorization"] = "Bearer %s" % user_token
         
         for k in headers.keys():
             _headers[k] = headers[k]
         
-        r = requests.request(method, url,
-                             json=body,
-                             data=data,
-                             headers=_headers,
-                             params=params,
-                             stream=stream,
-                             timeout=60*2)
+        # Streamed uploads can only be sent again if we can rewind them
+        can_retry = data is None or isinstance(data, (bytes, str)) or hasattr(data, "seek")
+        for attempt in range(MAX_RETRIES + 1):
+            with self.limiter.slot():
+                r = requests.request(method, url,
+                                    json=body,
+                                    data=data,
+                                    headers=_headers,
+                                    params=params,
+                                    stream=stream,
+                                    timeout=60*2)
+
+                # Only throttled requests are retried in any case, failed 
+                # requests only if they do not modify anything
+                is_throttled = r.status_code == 429
+                is_failed = r.status_code >= 500
+                retry_after = None
+                if is_throttled or is_failed:
+                    retry_after = parse_retry_after(r.headers.get("Retry-After", None))
+                    self.limiter.throttle(retry_after)
+
+            retry = is_throttled or (is_failed and method == "GET")
+            if not retry or not can_retry or attempt >= MAX_RETRIES:
+                break
+
+            r.close()
+            time.sleep(retry_after if retry_after != None else RETRY_BACKOFF_SECONDS * 2**attempt)
+            if hasattr(data, "seek"):
+                data.seek(0)
+
+        # The user token expired (e.g. during a long sync), therefore we 
+        # renew it and try once again. Token requests are never retried.
+        is_token_request = "Authorization" in headers
+        if r.status_code == 401 and retry_auth and not is_token_request and user_token != None:
+            if self.token_handler.refresh(self._get_user_token, expired_token=user_token):
+                if hasattr(data, "seek"):
+                    data.seek(0)
+                return self._request(method, path, data=data, body=body, 
+                    headers=headers, params=params, stream=stream, retry_auth=False)
         return r
 
 
-
-        
\ No newline at end of file
+# Apply the base url override if given
+if os.environ.get(ENV_BASE_URL, "") != "":
+    set_base_url(os.environ[ENV_BASE_URL])
+elif cfg.get("general.baseurl", default=None) != None:
+    set_base_url(cfg.get("general.baseurl"))
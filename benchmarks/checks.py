@@ -0,0 +1,124 @@
+""" Functional checks against the local mock cloud. In contrast to the
+    benchmarks they fail if a result is wrong or exceeds its limit:
+
+        python -m benchmarks.checks [-v] [DownloadResumeCheck ...]
+
+    The checks run with a temporary home folder, therefore your own
+    RemaPy data and config are never touched.
+"""
+
+import os
+import math
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+
+#
+# DEFINITIONS
+#
+# The memory of an upload must not grow with the size of the file
+UPLOAD_RSS_LIMIT_MB = 64
+STRESS_SECONDS = 10
+
+_home = None
+
+
+def setUpModule():
+    # Before anything of RemaPy is imported, as the config reads HOME
+    global _home
+    _home = tempfile.mkdtemp(prefix="remapy_checks_")
+    os.environ["HOME"] = _home
+    Path(_home, ".remapy/data").mkdir(parents=True, exist_ok=True)
+
+
+def tearDownModule():
+    shutil.rmtree(_home, ignore_errors=True)
+
+
+#
+# CHECKS
+#
+class DownloadResumeCheck(unittest.TestCase):
+
+    def test_resume_interrupted_download(self):
+        """ Every transfer of the mock cloud is dropped in the middle until
+            the client gives up, the next download must continue with the
+            partial data rather than starting again.
+        """
+        import api.remarkable_client
+        from api.remarkable_client import RemarkableClient
+        from benchmarks.mock_cloud import MockCloud
+
+        cloud = MockCloud(documents=1, collections=0, pages=20, strokes=200, drop_rate=1.0)
+        api.remarkable_client.set_base_url(cloud.start())
+        try:
+            client = RemarkableClient()
+            id = cloud.listing()[0]["ID"]
+            blob = cloud.blob(id)
+            path = "%s/%s.zip" % (_home, id)
+
+            # The last interruption is raised (all of them are IOErrors)
+            with self.assertRaises(IOError):
+                client.download_file(cloud._blob_url(id), path)
+            self.assertFalse(os.path.exists(path))
+            self.assertTrue(0 < os.path.getsize("%s.part" % path) < len(blob))
+            self.assertTrue(os.path.exists("%s.part.json" % path))
+
+            cloud.drop_rate = 0.0
+            bytes_sent = cloud.bytes_sent
+            client.download_file(cloud._blob_url(id), path)
+
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), blob)
+            self.assertLess(cloud.bytes_sent - bytes_sent, len(blob))
+            self.assertFalse(os.path.exists("%s.part" % path))
+            self.assertFalse(os.path.exists("%s.part.json" % path))
+
+        finally:
+            cloud.stop()
+
+
+class UploadCheck(unittest.TestCase):
+
+    def test_upload_memory_and_bulk_requests(self):
+        """ See benchmarks.run.bench_upload_bulk
+        """
+        from benchmarks.run import bench_upload_bulk
+
+        result = bench_upload_bulk(_home, scale=1.0)
+
+        upload = result["upload"]
+        self.assertGreaterEqual(upload["bytes_received"], upload["file_mb"] * 1024 * 1024)
+        if not "rss_growth_mb" in upload:
+            self.skipTest("The current RSS is not available on this platform")
+        self.assertLess(upload["rss_growth_mb"], UPLOAD_RSS_LIMIT_MB)
+
+        trash = result["trash"]
+        self.assertEqual(trash["requests"].get("PUT /document-storage/json/2/upload/update-status", 0),
+            math.ceil(trash["items"] / 100))
+
+        delete = result["delete"]
+        self.assertEqual(delete["failed"], 0)
+        self.assertLess(delete["requests"].get("PUT /document-storage/json/2/delete", 0),
+            delete["items"] / 50)
+
+
+class StressCheck(unittest.TestCase):
+
+    def test_concurrent_tree_access(self):
+        """ See benchmarks.stress
+        """
+        from benchmarks import stress
+
+        counts, errors = stress.run(seconds=STRESS_SECONDS)
+        self.assertEqual(errors, [])
+        self.assertGreater(counts.get("move", 0), 0)
+
+
+#
+# M A I N
+#
+if __name__ == "__main__":
+    unittest.main()
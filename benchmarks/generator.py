@@ -0,0 +1,161 @@
+import os
+import json
+import struct
+import random
+import uuid
+
+
+#
+# DEFINITIONS
+#
+HEADER_V3 = b'reMarkable .lines file, version=3          '
+HEADER_V5 = b'reMarkable .lines file, version=5          '
+
+# Ballpoint, marker, fineliner, highlighter and pencil (see render.py)
+DEFAULT_PENS = [2, 3, 4, 5, 7, 15, 16, 17, 18]
+
+SCREEN_WIDTH = 1404
+SCREEN_HEIGHT = 1872
+
+
+#
+# Functions
+#
+def rm_page(version=5, layers=1, strokes=100, points=50, pens=DEFAULT_PENS, seed=0):
+    """ Returns the content of a synthetic .rm file. Every stroke is a
+        random walk of the given number of points.
+    """
+    rnd = random.Random(seed)
+    header = HEADER_V5 if version == 5 else HEADER_V3
+    out = [struct.pack("<%dsI" % len(header), header, layers)]
+
+    for layer in range(layers):
+        out.append(struct.pack("<I", strokes))
+        for stroke in range(strokes):
+            pen = rnd.choice(pens)
+            color = rnd.randint(0, 1)
+            pen_width = rnd.choice([1.875, 2.0, 2.125])
+            if version == 5:
+                out.append(struct.pack("<IIIffI", pen, color, 0, pen_width, 0.0, points))
+            else:
+                out.append(struct.pack("<IIIfI", pen, color, 0, pen_width, points))
+
+            x = rnd.uniform(0, SCREEN_WIDTH)
+            y = rnd.uniform(0, SCREEN_HEIGHT)
+            for point in range(points):
+                x = min(max(x + rnd.uniform(-5, 5), 0), SCREEN_WIDTH)
+                y = min(max(y + rnd.uniform(-5, 5), 0), SCREEN_HEIGHT)
+                pressure = rnd.uniform(0.1, 1.0)
+                tilt = rnd.uniform(0.0, 1.0)
+                out.append(struct.pack("<ffffff", x, y, 0.0, pressure, tilt, 0.0))
+
+    return b"".join(out)
+
+
+def write_rm_page(rm_file_name, **kwargs):
+    """ Writes a synthetic page to rm_file_name.rm (see rm_page).
+    """
+    with open("%s.rm" % rm_file_name, "wb") as out:
+        out.write(rm_page(**kwargs))
+
+
+def write_pdf(path, pages=10, width=612, height=792):
+    """ Writes a synthetic pdf with some text on each page.
+    """
+    from reportlab.pdfgen import canvas
+
+    can = canvas.Canvas(path, pagesize=(width, height))
+    for page in range(pages):
+        for line in range(40):
+            can.drawString(50, height - 50 - line * 17,
+                "Page %d, line %d: The quick brown fox jumps over the lazy dog." % (page, line))
+        can.showPage()
+    can.save()
+
+
+def write_pdf_document(path, id, pages=10, annotated_pages=None, **kwargs):
+    """ Writes an annotated pdf document in the same layout as it is
+        extracted from the rm cloud i.e. path/id.pdf and path/id/n.rm
+        Returns (rm_files_path, path of the original pdf).
+    """
+    annotated_pages = range(pages) if annotated_pages is None else annotated_pages
+    rm_files_path = "%s/%s" % (path, id)
+    os.makedirs(rm_files_path, exist_ok=True)
+
+    path_pdf = "%s/%s.pdf" % (path, id)
+    write_pdf(path_pdf, pages)
+
+    for page in annotated_pages:
+        write_rm_page("%s/%d" % (rm_files_path, page), seed=page, **kwargs)
+    return rm_files_path, path_pdf
+
+
+def write_notebook(path, id, pages=10, template="Blank", **kwargs):
+    """ Writes a notebook in the same layout as it is extracted from the
+        rm cloud i.e. path/id.pagedata and path/id/n.rm
+    """
+    rm_files_path = "%s/%s" % (path, id)
+    os.makedirs(rm_files_path, exist_ok=True)
+
+    for page in range(pages):
+        write_rm_page("%s/%d" % (rm_files_path, page), seed=page, **kwargs)
+
+    with open("%s/%s.pagedata" % (path, id), "w") as out:
+        out.write("\n".join([template] * pages) + "\n")
+    return rm_files_path
+
+
+def metadata(id, parent, name, is_collection=False, version=1, bookmarked=False):
+    return {
+        "ID": id,
+        "Parent": parent,
+        "VissibleName": name,
+        "Version": version,
+        "Bookmarked": bookmarked,
+        "Type": "CollectionType" if is_collection else "DocumentType",
+        "ModifiedClient": "2020-01-01T00:00:00.000000Z",
+        "CurrentPage": 0,
+        "BlobURLGet": "",
+        "Success": True
+    }
+
+
+def account_listing(documents=1000, collections=100, depth=5, trashed=0.05,
+        bookmarked=0.05, seed=0):
+    """ Returns a synthetic listing of an account as it is returned by
+        RemarkableClient.list_items. Collections are nested up to the given
+        depth and documents are distributed randomly over all collections.
+    """
+    rnd = random.Random(seed)
+    words = ["notes", "paper", "draft", "report", "meeting", "book",
+        "project", "ideas", "review", "thesis", "todo", "archive"]
+
+    def name():
+        return "%s %s %d" % (rnd.choice(words).capitalize(), rnd.choice(words), rnd.randint(1, 999))
+
+    def new_id():
+        return str(uuid.UUID(int=rnd.getrandbits(128)))
+
+    listing = []
+    levels = [[""]]
+    for i in range(collections):
+        level = min(len(levels) - 1, rnd.randint(0, depth - 1)) if depth > 0 else 0
+        parent = rnd.choice(levels[level])
+        id = new_id()
+        if level + 1 >= len(levels):
+            levels.append([])
+        levels[level + 1].append(id)
+        listing.append(metadata(id, parent, name(), is_collection=True))
+
+    parents = [id for level in levels for id in level]
+    for i in range(documents):
+        parent = "trash" if rnd.random() < trashed else rnd.choice(parents)
+        listing.append(metadata(new_id(), parent, name(),
+            version=rnd.randint(1, 50), bookmarked=rnd.random() < bookmarked))
+
+    return listing
+
+
+def write_account_listing(path, **kwargs):
+    with open(path, "w") as out:
+        out.write(json.dumps(account_listing(**kwargs), indent=4))
@@ -0,0 +1,495 @@
+""" Local stand-in for the rm cloud that is used to measure syncs
+    reproducibly. Start it e.g. with
+
+        python -m benchmarks.mock_cloud --port 8080 --documents 1000 --latency 0.05
+
+    and start RemaPy with REMAPY_BASE_URL=http://127.0.0.1:8080 (see
+    api.remarkable_client.set_base_url).
+"""
+
+import io
+import json
+import base64
+import hashlib
+import time
+import random
+import zipfile
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from benchmarks import generator
+
+
+#
+# DEFINITIONS
+#
+DOCS_PATH = "/document-storage/json/2/docs"
+UPLOAD_REQUEST_PATH = "/document-storage/json/2/upload/request"
+UPDATE_STATUS_PATH = "/document-storage/json/2/upload/update-status"
+DELETE_PATH = "/document-storage/json/2/delete"
+DEVICE_TOKEN_PATH = "/token/json/2/device/new"
+USER_TOKEN_PATH = "/token/json/2/user/new"
+BLOB_PATH = "/blob/"
+
+CHUNK_SIZE = 64 * 1024
+
+
+#
+# CLASS
+#
+class MockCloud(object):
+    """ Serves a synthetic account (see generator.account_listing). The
+        blobs of all documents are notebooks with the given number of pages
+        and are created when they are downloaded for the first time.
+        latency (seconds) is added to every request, bandwidth (bytes per
+        second) limits the transfer of blobs and is shared by all concurrent
+        transfers, and error_rate is the probability that a request fails
+        with status 500. If more than max_in_flight requests are sent at
+        once, the server throttles them with status 429 and Retry-After
+        retry_after seconds. If token_lifetime (seconds) is given, user
+        tokens expire and requests with an expired token fail with status 401.
+        Blobs support range requests and drop_rate is the probability that
+        the connection is closed in the middle of a blob transfer. If 
+        keep_blobs is False, uploaded blobs are only counted (e.g. to 
+        measure the memory of large uploads).
+    """
+
+    #
+    # CTOR
+    #
+    def __init__(self, documents=1000, collections=50, depth=4, pages=1,
+            strokes=20, points=50, latency=0.0, bandwidth=None,
+            error_rate=0.0, max_in_flight=None, retry_after=1,
+            drop_rate=0.0, keep_blobs=True, token_lifetime=None, host="127.0.0.1", port=0, seed=0):
+        self.latency = latency
+        self.max_in_flight = max_in_flight
+        self.retry_after = retry_after
+        self.drop_rate = drop_rate
+        self.keep_blobs = keep_blobs
+        self.token_lifetime = token_lifetime
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.pages = pages
+        self.strokes = strokes
+        self.points = points
+
+        self.items = {}
+        for metadata in generator.account_listing(documents=documents,
+                collections=collections, depth=depth, seed=seed):
+            self.items[metadata["ID"]] = metadata
+        self.blobs = {}
+        self.requests = {}
+        self.in_flight = 0
+        self.max_seen_in_flight = 0
+        self.transfers = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._server = ThreadingHTTPServer((host, port), self._create_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+        self.url = "http://%s:%d" % (host, self._server.server_port)
+
+
+    #
+    # Functions
+    #
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self.url
+
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+
+    def listing(self, id=None, with_blob=False):
+        with self._lock:
+            items = [self.items[id]] if id != None and id in self.items else \
+                [] if id != None else list(self.items.values())
+            items = [dict(item) for item in items]
+
+        for item in items:
+            item["BlobURLGet"] = self._blob_url(item["ID"]) if with_blob else ""
+        return items
+
+
+    def blob(self, id):
+        with self._lock:
+            if id in self.blobs:
+                return self.blobs[id]
+            if not id in self.items:
+                return None
+
+        blob = self._create_blob(id)
+        with self._lock:
+            self.blobs[id] = blob
+        return blob
+
+
+    def upload_request(self, entries):
+        return [{
+            "ID": entry["ID"],
+            "Version": entry.get("Version", 1),
+            "Message": "",
+            "Success": True,
+            "BlobURLPut": self._blob_url(entry["ID"]),
+            "BlobURLPutExpires": "2100-01-01T00:00:00Z"
+        } for entry in entries]
+
+
+    def update_status(self, entries):
+        results = []
+        with self._lock:
+            for entry in entries:
+                item = self.items.get(entry["ID"], {})
+                item.update(entry)
+                item["Version"] = entry.get("Version", item.get("Version", 0))
+                item["Success"] = True
+                self.items[entry["ID"]] = item
+                results.append({"ID": entry["ID"], "Version": item["Version"],
+                    "Message": "", "Success": True})
+        return results
+
+
+    def delete(self, entries):
+        results = []
+        with self._lock:
+            for entry in entries:
+                success = self.items.pop(entry["ID"], None) != None
+                self.blobs.pop(entry["ID"], None)
+                results.append({"ID": entry["ID"], "Success": success,
+                    "Message": "" if success else "Item not found"})
+        return results
+
+
+    def put_blob(self, id, data):
+        with self._lock:
+            self.bytes_received += len(data)
+            if self.keep_blobs:
+                self.blobs[id] = data
+
+
+    def user_token(self):
+        """ Unsigned JWT that expires after token_lifetime seconds.
+        """
+        def encode(obj):
+            return base64.urlsafe_b64encode(json.dumps(obj).encode()).decode().rstrip("=")
+
+        payload = {"iat": int(time.time())}
+        if self.token_lifetime != None:
+            payload["exp"] = int(time.time() + self.token_lifetime)
+        return "%s.%s." % (encode({"alg": "none", "typ": "JWT"}), encode(payload))
+
+
+    def is_authorized(self, authorization):
+        if self.token_lifetime is None:
+            return True
+
+        try:
+            payload = authorization.split(" ")[1].split(".")[1]
+            payload += "=" * (-len(payload) % 4)
+            return json.loads(base64.urlsafe_b64decode(payload))["exp"] > time.time()
+        except Exception:
+            return False
+
+
+    def should_fail(self):
+        return self._chance(self.error_rate)
+
+
+    def should_drop(self):
+        return self._chance(self.drop_rate)
+
+
+    def _chance(self, probability):
+        if probability <= 0:
+            return False
+
+        with self._lock:
+            return self._random.random() < probability
+
+
+    def count_request(self, name):
+        with self._lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+
+
+    def begin_request(self):
+        """ Returns False if the request must be throttled.
+        """
+        with self._lock:
+            self.in_flight += 1
+            self.max_seen_in_flight = max(self.max_seen_in_flight, self.in_flight)
+            return self.max_in_flight is None or self.in_flight <= self.max_in_flight
+
+
+    def end_request(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
+    def transfer_delay(self, num_bytes):
+        """ Time to send num_bytes if the bandwidth is shared by all
+            concurrent transfers.
+        """
+        if not self.bandwidth:
+            return 0
+        with self._lock:
+            return num_bytes * max(1, self.transfers) / self.bandwidth
+
+
+    def _blob_url(self, id):
+        return "%s%s%s" % (self.url, BLOB_PATH, id)
+
+
+    def _create_blob(self, id):
+        """ Creates a notebook zip in the same layout as the rm cloud.
+        """
+        out = io.BytesIO()
+        with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as zip_file:
+            zip_file.writestr("%s.content" % id, json.dumps({
+                "fileType": "notebook",
+                "pageCount": self.pages
+            }))
+            zip_file.writestr("%s.pagedata" % id, "Blank\n" * self.pages)
+            for page in range(self.pages):
+                zip_file.writestr("%s/%d.rm" % (id, page), generator.rm_page(
+                    strokes=self.strokes, points=self.points, seed=page))
+        return out.getvalue()
+
+
+    def _create_handler(self):
+        cloud = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                self._handle("GET")
+
+            def do_PUT(self):
+                self._handle("PUT")
+
+            def do_POST(self):
+                self._handle("POST")
+
+            def _handle(self, method):
+                url = urlparse(self.path)
+                # Large uploads are not kept in memory if not needed
+                is_blob_upload = method == "PUT" and url.path.startswith(BLOB_PATH)
+                if is_blob_upload and not cloud.keep_blobs:
+                    with cloud._lock:
+                        cloud.bytes_received += self._read_body(discard=True)
+                    body = b""
+                else:
+                    body = self._read_body()
+                cloud.count_request("%s %s" % (method, url.path if not url.path.startswith(BLOB_PATH) else BLOB_PATH))
+
+                if cloud.latency > 0:
+                    time.sleep(cloud.latency)
+
+                try:
+                    if not cloud.begin_request():
+                        cloud.count_request("throttled")
+                        self._send(429, b"Too many requests (mock)",
+                            headers={"Retry-After": str(cloud.retry_after)})
+                        return
+                    self._handle_request(method, url, body)
+                finally:
+                    cloud.end_request()
+
+            def _handle_request(self, method, url, body):
+                if cloud.should_fail():
+                    self._send(500, b"Internal error (mock)")
+                    return
+
+                # Blob urls are signed, therefore they need no user token
+                needs_token = url.path.startswith("/document-storage/")
+                if needs_token and not cloud.is_authorized(self.headers.get("Authorization", "")):
+                    self._send(401, b"Unauthorized")
+                    return
+
+                try:
+                    self._route(method, url, body)
+                except Exception as e:
+                    self._send(500, str(e).encode())
+
+            def _route(self, method, url, body):
+                if method == "POST" and url.path == DEVICE_TOKEN_PATH:
+                    self._send(200, b"mock-device-token")
+
+                elif method == "POST" and url.path == USER_TOKEN_PATH:
+                    self._send(200, cloud.user_token().encode())
+
+                elif method == "GET" and url.path == DOCS_PATH:
+                    query = parse_qs(url.query)
+                    id = query["doc"][0] if "doc" in query else None
+                    with_blob = "withBlob" in query
+                    self._send_json(cloud.listing(id, with_blob))
+
+                elif method == "PUT" and url.path == UPLOAD_REQUEST_PATH:
+                    self._send_json(cloud.upload_request(json.loads(body)))
+
+                elif method == "PUT" and url.path == UPDATE_STATUS_PATH:
+                    self._send_json(cloud.update_status(json.loads(body)))
+
+                elif method == "PUT" and url.path == DELETE_PATH:
+                    self._send_json(cloud.delete(json.loads(body)))
+
+                elif method == "GET" and url.path.startswith(BLOB_PATH):
+                    blob = cloud.blob(url.path[len(BLOB_PATH):])
+                    if blob is None:
+                        self._send(404, b"Not found")
+                    else:
+                        self._send_blob(blob)
+
+                elif method == "PUT" and url.path.startswith(BLOB_PATH):
+                    if cloud.keep_blobs:
+                        cloud.put_blob(url.path[len(BLOB_PATH):], body)
+                    self._send(200, b"")
+
+                else:
+                    self._send(404, b"Not found")
+
+            def _read_body(self, discard=False):
+                """ Returns the body or, if discard is True, only its size.
+                """
+                if self.headers.get("Transfer-Encoding", "") == "chunked":
+                    return self._read_chunked_body(discard)
+
+                length = int(self.headers.get("Content-Length", 0))
+                if not discard:
+                    return self.rfile.read(length) if length > 0 else b""
+                self._skip(length)
+                return length
+
+            def _read_chunked_body(self, discard):
+                body = io.BytesIO()
+                size = 0
+                while True:
+                    length = int(self.rfile.readline().split(b";")[0].strip(), 16)
+                    if length == 0:
+                        self.rfile.readline()
+                        return size if discard else body.getvalue()
+                    if discard:
+                        self._skip(length)
+                    else:
+                        body.write(self.rfile.read(length))
+                    size += length
+                    self.rfile.readline()
+
+            def _skip(self, length):
+                while length > 0:
+                    length -= len(self.rfile.read(min(length, CHUNK_SIZE)))
+
+            def _send_json(self, obj):
+                self._send(200, json.dumps(obj).encode(), content_type="application/json")
+
+            def _send_blob(self, blob):
+                """ Sends the blob or the requested range of it.
+                """
+                etag = '"%s"' % hashlib.md5(blob).hexdigest()
+                headers = {"ETag": etag, "Accept-Ranges": "bytes"}
+                byte_range = self.headers.get("Range", None)
+                if_range = self.headers.get("If-Range", etag)
+                drop = cloud.should_drop()
+
+                if byte_range is None or if_range != etag:
+                    self._send(200, blob, content_type="application/zip", 
+                        headers=headers, drop=drop)
+                    return
+
+                start = int(byte_range.split("=")[1].split("-")[0])
+                if start >= len(blob):
+                    headers["Content-Range"] = "bytes */%d" % len(blob)
+                    self._send(416, b"", headers=headers)
+                    return
+
+                headers["Content-Range"] = "bytes %d-%d/%d" % (start, len(blob) - 1, len(blob))
+                self._send(206, blob[start:], content_type="application/zip", 
+                    headers=headers, drop=drop)
+
+            def _send(self, code, data, content_type="text/plain", headers=None, drop=False):
+                self.send_response(code)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+
+                # Simulate the given bandwidth
+                with cloud._lock:
+                    cloud.transfers += 1
+                try:
+                    # A dropped connection sends only half of the data
+                    end = len(data) // 2 if drop else len(data)
+                    for i in range(0, end, CHUNK_SIZE):
+                        chunk = data[i:min(i+CHUNK_SIZE, end)]
+                        self.wfile.write(chunk)
+                        with cloud._lock:
+                            cloud.bytes_sent += len(chunk)
+                        delay = cloud.transfer_delay(len(chunk))
+                        if delay > 0:
+                            time.sleep(delay)
+                finally:
+                    with cloud._lock:
+                        cloud.transfers -= 1
+
+                if drop:
+                    self.wfile.flush()
+                    self.close_connection = True
+
+        return Handler
+
+
+#
+# M A I N
+#
+def main():
+    parser = argparse.ArgumentParser(description="Mock rm cloud")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--documents", type=int, default=1000)
+    parser.add_argument("--collections", type=int, default=50)
+    parser.add_argument("--pages", type=int, default=1, help="Pages per notebook")
+    parser.add_argument("--strokes", type=int, default=20, help="Strokes per page")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds per request")
+    parser.add_argument("--bandwidth", type=float, default=None, help="Bytes per second")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probability of a failed request")
+    parser.add_argument("--max-in-flight", type=int, default=None, help="Throttle (429) above this many concurrent requests")
+    parser.add_argument("--retry-after", type=float, default=1, help="Retry-After of throttled requests")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="Probability of a dropped blob transfer")
+    parser.add_argument("--token-lifetime", type=float, default=None, help="Seconds until user tokens expire")
+    args = parser.parse_args()
+
+    cloud = MockCloud(documents=args.documents, collections=args.collections,
+        pages=args.pages, strokes=args.strokes, latency=args.latency,
+        bandwidth=args.bandwidth, error_rate=args.error_rate,
+        max_in_flight=args.max_in_flight, retry_after=args.retry_after,
+        drop_rate=args.drop_rate,
+        token_lifetime=args.token_lifetime,
+        host=args.host, port=args.port)
+    print("Mock cloud running on %s" % cloud.url)
+    print("Start RemaPy with REMAPY_BASE_URL=%s" % cloud.url)
+    try:
+        cloud.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,655 @@
+""" Runs all (or only the given) benchmarks and saves the results as json
+    such that the results of different versions can be compared:
+
+        python -m benchmarks.run [--quick] [--only render_pdf ...]
+            [--output results.json] [--compare old_results.json]
+
+    The benchmarks run with a temporary home folder, therefore your own
+    RemaPy data and config are never touched.
+"""
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import platform
+import subprocess
+from pathlib import Path
+
+
+#
+# DEFINITIONS
+#
+PATH_RESULTS = Path(__file__).parent / "results"
+BENCHMARKS = []
+
+
+#
+# HELPER
+#
+def benchmark(name):
+    """ Registers the decorated function as benchmark. It is called with
+        (work_dir, scale) and returns a dict of measurements.
+    """
+    def decorator(fun):
+        BENCHMARKS.append((name, fun))
+        return fun
+    return decorator
+
+
+def measure(fun, repeat=3, setup=None):
+    """ Calls fun repeat times and returns the min. and mean wall time
+        in seconds. If given, setup is called before every call (untimed).
+    """
+    times = []
+    for i in range(repeat):
+        if setup != None:
+            setup()
+        start = time.perf_counter()
+        fun()
+        times.append(time.perf_counter() - start)
+
+    return {
+        "min": min(times),
+        "mean": sum(times) / len(times),
+        "repeat": repeat
+    }
+
+
+def scaled(value, scale):
+    return max(1, int(value * scale))
+
+
+def _sync_all(item_manager, num_workers=10):
+    """ Syncs all documents of the current tree like the file explorer.
+    """
+    import queue
+    import threading
+
+    q = queue.Queue()
+    failed = []
+
+    def worker():
+        while True:
+            document = q.get()
+            if document is None:
+                break
+            try:
+                document.sync()
+            except Exception:
+                failed.append(document.id())
+            q.task_done()
+
+    threads = [threading.Thread(target=worker) for i in range(num_workers)]
+    for thread in threads:
+        thread.start()
+
+    item_manager.traverse_tree(fun=q.put, collection=False)
+    q.join()
+    item_manager.flush_metadata()
+
+    for thread in threads:
+        q.put(None)
+    for thread in threads:
+        thread.join()
+    return failed
+
+
+def _max_rss_mb():
+    """ Returns the peak resident set size of this process in MB.
+    """
+    import resource
+    # ru_maxrss is in kB on linux and in bytes on mac
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / (1024 * 1024 if platform.system() == "Darwin" else 1024)
+
+
+def _rss_mb():
+    """ Returns the current resident set size of this process in MB or 
+        None if it is not available (e.g. no /proc on mac).
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def _requests_since(before, after):
+    """ Returns the number of requests per endpoint sent since before.
+    """
+    return {name: count - before.get(name, 0) for name, count in after.items()
+        if count - before.get(name, 0) > 0}
+
+
+def _tree(listing):
+    """ Creates a new item tree for the given listing and makes it the
+        current tree of the ItemManager.
+    """
+    from model.item_manager import ItemManager
+
+    item_manager = ItemManager()
+    item_manager._swap_tree(item_manager._create_tree(list(listing)))
+    return item_manager
+
+
+#
+# BENCHMARKS
+#
+@benchmark("render_rm_file")
+def bench_render_rm_file(work_dir, scale):
+    import model.render as render
+    from benchmarks import generator
+
+    result = {}
+    strokes, points = scaled(300, scale), 100
+    for version in [3, 5]:
+        rm_file_name = "%s/page_v%d" % (work_dir, version)
+        generator.write_rm_page(rm_file_name, version=version, strokes=strokes, points=points)
+        result["v%d" % version] = measure(lambda: render._render_rm_file(rm_file_name))
+
+    result["strokes"] = strokes
+    result["points"] = points
+    return result
+
+
+@benchmark("render_pdf")
+def bench_render_pdf(work_dir, scale):
+    import model.render as render
+    from benchmarks import generator
+
+    pages = scaled(20, scale)
+    rm_files_path, path_pdf = generator.write_pdf_document(work_dir, "pdf", pages=pages,
+        strokes=50, points=50)
+    result = measure(lambda: render.pdf(rm_files_path, path_pdf,
+        "%s/annotated.pdf" % work_dir, "%s/oap.pdf" % work_dir))
+    result["pages"] = pages
+    return result
+
+
+@benchmark("render_notebook")
+def bench_render_notebook(work_dir, scale):
+    import model.render as render
+    from benchmarks import generator
+
+    pages = scaled(20, scale)
+    generator.write_notebook(work_dir, "notebook", pages=pages, strokes=50, points=50)
+    result = measure(lambda: render.notebook(work_dir, "notebook",
+        "%s/notebook.pdf" % work_dir, path_templates=work_dir))
+    result["pages"] = pages
+    return result
+
+
+@benchmark("create_tree")
+def bench_create_tree(work_dir, scale):
+    from benchmarks import generator
+
+    documents = scaled(20000, scale)
+    listing = generator.account_listing(documents=documents, collections=documents // 20, depth=8)
+    result = measure(lambda: _tree(listing))
+    result["items"] = len(listing)
+    return result
+
+
+@benchmark("filter")
+def bench_filter(work_dir, scale):
+    from model.search_index import SearchIndex
+    from benchmarks import generator
+
+    documents = scaled(20000, scale)
+    listing = generator.account_listing(documents=documents, collections=documents // 20, depth=8)
+    item_manager = _tree(listing)
+
+    # Simulates typing a query (incremental) and single queries (cold)
+    queries = ["n", "no", "not", "note", "notes", "!b", "!b rep", "xyz"]
+    index = SearchIndex(item_manager.root)
+
+    def typing():
+        for query in queries:
+            index.match(query)
+
+    return {
+        "build_index": measure(lambda: SearchIndex(item_manager.root)),
+        "typing": measure(typing),
+        "single_query": measure(lambda: SearchIndex(item_manager.root).match("report")),
+        "items": len(listing)
+    }
+
+
+@benchmark("flat_folder_sync_state")
+def bench_flat_folder_sync_state(work_dir, scale):
+    """ State changes of documents in a single flat folder (see
+        Collection.listen_child_state_change).
+    """
+    import model.item
+    from benchmarks import generator
+
+    documents = scaled(5000, scale)
+    listing = [generator.metadata("folder", "", "Folder", is_collection=True)]
+    listing += [generator.metadata("doc%d" % i, "folder", "Doc %d" % i) for i in range(documents)]
+    item_manager = _tree(listing)
+    folder = [c for c in item_manager.root.children() if c.id() == "folder"][0]
+
+    def sync():
+        for document in folder.children():
+            document.state = model.item.STATE_SYNCING
+            document._update_state_listener()
+        for document in folder.children():
+            document.state = model.item.STATE_SYNCED
+            document._update_state_listener()
+
+    result = measure(sync)
+    result["documents"] = documents
+    return result
+
+
+@benchmark("deep_metadata_write_behind")
+def bench_deep_metadata_write_behind(work_dir, scale):
+    """ Every synced document marks its ancestors dirty, the metadata is
+        written once per batch (see MetadataWriter).
+    """
+    from benchmarks import generator
+
+    depth = 20
+    documents = scaled(2000, scale)
+    listing, parent = [], ""
+    for d in range(depth):
+        listing.append(generator.metadata("c%d" % d, parent, "C%d" % d, is_collection=True))
+        parent = "c%d" % d
+    listing += [generator.metadata("d%d" % i, "c%d" % (i % depth), "D%d" % i) for i in range(documents)]
+    item_manager = _tree(listing)
+
+    writes = []
+    def sync():
+        item_manager.traverse_tree(lambda d: d.parent().sync(), document=True, collection=False)
+        writes.append(item_manager.flush_metadata())
+
+    result = measure(sync)
+    result["documents"] = documents
+    result["writes"] = writes[-1]
+    return result
+
+
+@benchmark("backup")
+def bench_backup(work_dir, scale):
+    from benchmarks import generator
+
+    documents = scaled(5000, scale)
+    listing = generator.account_listing(documents=documents, collections=documents // 20,
+        depth=5, trashed=0)
+    item_manager = _tree(listing)
+
+    # Local copies of all documents
+    data = os.urandom(64 * 1024)
+    def write_local(document):
+        Path(document.path).mkdir(parents=True, exist_ok=True)
+        with open(document.path_original_pdf, "wb") as out:
+            out.write(data)
+        document._write_remapy_file()
+        document._update_state(inform_listener=False)
+    item_manager.traverse_tree(write_local, collection=False)
+
+    backup_path = "%s/backup" % work_dir
+    summaries = []
+    full = measure(lambda: summaries.append(item_manager.create_backup(backup_path)), repeat=1,
+        setup=lambda: shutil.rmtree(backup_path, ignore_errors=True))
+    incremental = measure(lambda: summaries.append(item_manager.create_backup(backup_path)), repeat=3)
+    archive = measure(lambda: item_manager.create_archive_backup("%s/backup.tar" % work_dir), repeat=1)
+
+    full["summary"] = summaries[0]
+    incremental["summary"] = summaries[-1]
+    return {
+        "full": full,
+        "incremental": incremental,
+        "archive": archive,
+        "documents": documents,
+        "bytes": documents * len(data)
+    }
+
+
+@benchmark("import_time")
+def bench_import_time(work_dir, scale):
+    """ Import time of the application (see python -X importtime) i.e. 
+        everything that is loaded before the window can be shown.
+    """
+    import sys
+
+    repeat = 3
+    totals, modules = [], {}
+    for i in range(repeat):
+        process = subprocess.run([sys.executable, "-X", "importtime", "-c", "import rema"],
+            cwd=str(Path(__file__).parent.parent), stderr=subprocess.PIPE,
+            stdout=subprocess.DEVNULL, env=dict(os.environ))
+
+        # Lines look like "import time: self [us] | cumulative | imported package"
+        for line in process.stderr.decode().splitlines():
+            if not line.startswith("import time:") or "cumulative" in line:
+                continue
+            self_us, cumulative_us, name = line[len("import time:"):].split("|")
+            name = name.rstrip()[1:]
+            cumulative = int(cumulative_us) / 1e6
+            modules[name.strip()] = min(modules.get(name.strip(), cumulative), cumulative)
+            if name == "rema":
+                totals.append(cumulative)
+
+    slowest = sorted(modules.items(), key=lambda m: m[1], reverse=True)[:20]
+    return {
+        "rema": {
+            "min": min(totals) if totals else 0,
+            "mean": sum(totals) / len(totals) if totals else 0,
+            "repeat": repeat
+        },
+        "slowest_modules": {name: seconds for name, seconds in slowest}
+    }
+
+
+@benchmark("sync_mock_cloud")
+def bench_sync_mock_cloud(work_dir, scale):
+    """ End-to-end sync of all documents against the local mock cloud
+        (see benchmarks/mock_cloud.py) with 20ms latency per request.
+    """
+    import api.remarkable_client
+    from model.item_manager import ItemManager
+    from benchmarks.mock_cloud import MockCloud
+
+    documents = scaled(200, scale)
+    cloud = MockCloud(documents=documents, collections=10, latency=0.02)
+    api.remarkable_client.set_base_url(cloud.start())
+    try:
+        item_manager = ItemManager()
+        failed = []
+
+        def sync():
+            item_manager.get_root(force=True)
+            failed.extend(_sync_all(item_manager))
+
+        result = measure(sync, repeat=1)
+        result["documents"] = documents
+        result["failed"] = len(failed)
+        result["requests"] = cloud.requests
+        return result
+
+    finally:
+        cloud.stop()
+
+
+@benchmark("sync_throttled")
+def bench_sync_throttled(work_dir, scale):
+    """ Sync against a mock cloud that throttles (429, Retry-After) more 
+        than 4 concurrent requests, once with 10 fixed workers and once
+        with the adaptive limit of the client.
+    """
+    import api.remarkable_client
+    from api.remarkable_client import RemarkableClient
+    from model.item_manager import ItemManager
+    from benchmarks.mock_cloud import MockCloud
+
+    documents = scaled(200, scale)
+    limiter = RemarkableClient.RequestLimiter()
+    results = {}
+    # Different seeds such that no document was downloaded before
+    for seed, (name, adaptive) in enumerate([("fixed", False), ("adaptive", True)]):
+        cloud = MockCloud(documents=documents, collections=10, latency=0.2,
+            max_in_flight=4, retry_after=1, seed=seed)
+        api.remarkable_client.set_base_url(cloud.start())
+        limiter.configure(maximum=10 if not adaptive else 
+            api.remarkable_client.MAX_CONCURRENT_REQUESTS, adaptive=adaptive)
+        try:
+            item_manager = ItemManager()
+            failed = []
+
+            def sync():
+                item_manager.get_root(force=True)
+                failed.extend(_sync_all(item_manager, num_workers=limiter.maximum))
+
+            result = measure(sync, repeat=1)
+            result["failed"] = len(failed)
+            result["throttled"] = cloud.requests.get("throttled", 0)
+            result["limiter"] = limiter.stats()
+            results[name] = result
+
+        finally:
+            cloud.stop()
+
+    limiter.configure(maximum=api.remarkable_client.MAX_CONCURRENT_REQUESTS)
+    results["documents"] = documents
+    return results
+
+
+@benchmark("download_resume")
+def bench_download_resume(work_dir, scale):
+    """ Downloads notebooks from a mock cloud that drops 30% of all blob
+        transfers in the middle. Interrupted downloads are resumed, hence
+        the bytes sent should be close to the size of the blobs.
+    """
+    import api.remarkable_client
+    from api.remarkable_client import RemarkableClient
+    from benchmarks.mock_cloud import MockCloud
+
+    documents = scaled(20, scale)
+    cloud = MockCloud(documents=documents, collections=0, pages=10, 
+        strokes=100, drop_rate=0.3)
+    api.remarkable_client.set_base_url(cloud.start())
+    try:
+        client = RemarkableClient()
+        ids = [item["ID"] for item in cloud.listing() if item["Type"] == "DocumentType"]
+        failed = []
+
+        def download():
+            for id in ids:
+                path = "%s/%s.zip" % (work_dir, id)
+                try:
+                    client.download_file(cloud._blob_url(id), path)
+                    os.remove(path)
+                except Exception:
+                    failed.append(id)
+
+        result = measure(download, repeat=1)
+        blob_bytes = sum(len(cloud.blob(id)) for id in ids)
+        result["documents"] = len(ids)
+        result["failed"] = len(failed)
+        result["blob_bytes"] = blob_bytes
+        result["bytes_sent"] = cloud.bytes_sent
+        result["overhead"] = cloud.bytes_sent / blob_bytes - 1
+        result["requests"] = cloud.requests
+        return result
+
+    finally:
+        cloud.stop()
+
+
+@benchmark("upload_bulk")
+def bench_upload_bulk(work_dir, scale):
+    """ Uploads a large pdf to the local mock cloud and measures the peak
+        memory, which should not grow with the size of the file. Afterwards
+        many documents are moved into the trash and deleted, which should 
+        need only a few bulk requests.
+    """
+    import threading
+    import uuid
+    import api.remarkable_client
+    from model.item import Item
+    from model.item_manager import ItemManager
+    from benchmarks.mock_cloud import MockCloud
+
+    documents = scaled(1000, scale)
+    file_mb = scaled(500, scale)
+    cloud = MockCloud(documents=documents, collections=10, pages=1, 
+        strokes=10, keep_blobs=False)
+    api.remarkable_client.set_base_url(cloud.start())
+    try:
+        item_manager = ItemManager()
+        item_manager.get_root(force=True)
+        results = {"documents": documents}
+
+        # Random data such that the zip can not compress it
+        path = Path(work_dir, "large.pdf")
+        with open(path, "wb") as f:
+            for i in range(file_mb):
+                f.write(os.urandom(1024 * 1024))
+
+        # The peak RSS of the process is not reset, therefore we sample
+        # the current RSS during the upload if possible
+        rss_before = _rss_mb()
+        samples = []
+        done = threading.Event()
+
+        def sample():
+            while not done.wait(0.01):
+                samples.append(_rss_mb())
+
+        sampler = threading.Thread(target=sample)
+        if rss_before != None:
+            sampler.start()
+        
+        def upload():
+            item_manager.upload_file(str(uuid.uuid4()), "", "large", "pdf", 
+                path=str(path), register_local=True)
+        
+        try:
+            results["upload"] = measure(upload, repeat=1)
+        finally:
+            done.set()
+            if sampler.is_alive():
+                sampler.join()
+
+        results["upload"]["file_mb"] = file_mb
+        results["upload"]["bytes_received"] = cloud.bytes_received
+        results["upload"]["max_rss_mb"] = _max_rss_mb()
+        if rss_before != None:
+            results["upload"]["rss_before_mb"] = rss_before
+            results["upload"]["rss_growth_mb"] = max(samples + [rss_before]) - rss_before
+        
+        # Move documents into the trash with a single bulk update
+        items = []
+        item_manager.traverse_tree(fun=items.append, collection=False)
+        to_trash = items[:scaled(300, scale)]
+
+        def move_to_trash():
+            for item in to_trash:
+                item.move(item_manager.trash, push=False)
+            Item.update_metadata_bulk(to_trash)
+        
+        requests_before = dict(cloud.requests)
+        results["trash"] = measure(move_to_trash, repeat=1)
+        results["trash"]["items"] = len(to_trash)
+        results["trash"]["requests"] = _requests_since(requests_before, cloud.requests)
+
+        # Delete all documents
+        failed = []
+        def delete():
+            failed.extend(Item.delete_bulk(items)[1])
+        
+        requests_before = dict(cloud.requests)
+        results["delete"] = measure(delete, repeat=1)
+        results["delete"]["items"] = len(items)
+        results["delete"]["failed"] = len(failed)
+        results["delete"]["requests"] = _requests_since(requests_before, cloud.requests)
+        return results
+
+    finally:
+        cloud.stop()
+
+
+#
+# Functions
+#
+def run(names=None, scale=1.0):
+    results = {}
+    for name, fun in BENCHMARKS:
+        if names and not name in names:
+            continue
+
+        work_dir = tempfile.mkdtemp(prefix="remapy_bench_")
+        print("Running %s..." % name)
+        try:
+            results[name] = fun(work_dir, scale)
+        except Exception as e:
+            print("(Error) Benchmark %s failed." % name)
+            print(e)
+            results[name] = {"error": str(e)}
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def compare(old, new, prefix=""):
+    """ Prints the ratio new / old for all measurements in both results.
+    """
+    for key in new:
+        if not key in old:
+            continue
+
+        name = "%s.%s" % (prefix, key) if prefix else key
+        if isinstance(new[key], dict) and isinstance(old[key], dict):
+            if "min" in new[key] and "min" in old[key]:
+                ratio = new[key]["min"] / old[key]["min"] if old[key]["min"] > 0 else float("inf")
+                print("%-50s %10.4fs %10.4fs %8.2fx" % (name, old[key]["min"], new[key]["min"], ratio))
+            else:
+                compare(old[key], new[key], name)
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).parent, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RemaPy benchmarks")
+    parser.add_argument("--quick", action="store_true", help="Run with 10%% of the default size")
+    parser.add_argument("--scale", type=float, default=1.0, help="Scale the size of all benchmarks")
+    parser.add_argument("--only", nargs="*", help="Names of the benchmarks to run")
+    parser.add_argument("--output", help="Json file for the results")
+    parser.add_argument("--compare", help="Json file of older results to compare with")
+    parser.add_argument("--list", action="store_true", help="List all benchmarks")
+    args = parser.parse_args()
+
+    if args.list:
+        for name, fun in BENCHMARKS:
+            print(name)
+        return
+
+    # Never touch the real RemaPy data of the user
+    home = tempfile.mkdtemp(prefix="remapy_home_")
+    os.environ["HOME"] = home
+    Path(home, ".remapy/data").mkdir(parents=True, exist_ok=True)
+    scale = args.scale * (0.1 if args.quick else 1.0)
+
+    try:
+        started = time.time()
+        results = {
+            "revision": _git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "started": started,
+            "scale": scale,
+            "benchmarks": run(args.only, scale)
+        }
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+    output = args.output
+    if output is None:
+        PATH_RESULTS.mkdir(parents=True, exist_ok=True)
+        output = PATH_RESULTS / ("%s.json" % time.strftime("%Y%m%d-%H%M%S", time.localtime(started)))
+    with open(output, "w") as out:
+        out.write(json.dumps(results, indent=4))
+    print("Results written to %s" % output)
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            old = json.loads(f.read())
+        print("%-50s %11s %11s %9s" % ("benchmark", "old", "new", "ratio"))
+        compare(old["benchmarks"], results["benchmarks"])
+
+
+if __name__ == "__main__":
+    main()
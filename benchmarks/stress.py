@@ -0,0 +1,206 @@
+""" Stress test of the item tree. Syncs, moves, lookups, traversals,
+    reconciles and full reloads run concurrently against the local mock
+    cloud for a while, afterwards the tree is checked for consistency:
+
+        python -m benchmarks.stress [--seconds 20] [--documents 300]
+
+    Exits with status 1 if a thread failed or the tree is inconsistent.
+    The same test runs with python -m benchmarks.checks.
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import threading
+import traceback
+from pathlib import Path
+
+
+#
+# HELPER
+#
+class _Stress(object):
+
+    def __init__(self, item_manager, document_ids, seconds, seed):
+        self.item_manager = item_manager
+        self.document_ids = list(document_ids)
+        self.end = time.time() + seconds
+        self.seed = seed
+        self.errors = []
+        self.counts = {}
+        self._lock = threading.Lock()
+
+
+    def running(self):
+        return time.time() < self.end
+
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+
+    def fail(self, message):
+        with self._lock:
+            self.errors.append(message)
+
+
+    def thread(self, name, fun):
+        """ Calls fun(random) until the time is over.
+        """
+        def run():
+            rnd = random.Random("%s%d" % (name, self.seed))
+            while self.running():
+                try:
+                    fun(rnd)
+                    self.count(name)
+                except Exception:
+                    self.fail("%s: %s" % (name, traceback.format_exc()))
+        return threading.Thread(target=run, name=name)
+
+
+    def sync(self, rnd):
+        document = self.item_manager.get_item(rnd.choice(self.document_ids))
+        if document != None:
+            document.sync()
+
+
+    def move(self, rnd):
+        # Both items must be part of the same tree (a reload replaces it)
+        items = []
+        self.item_manager.traverse_tree(fun=items.append, item=self.item_manager.root)
+        collections = [i for i in items if i.is_collection()]
+        documents = [i for i in items if i.is_document()]
+        rnd.choice(documents).move(rnd.choice(collections), push=False)
+
+
+    def lookup(self, rnd):
+        id = rnd.choice(self.document_ids)
+        item = self.item_manager.get_item(id)
+        if item is None or item.id() != id:
+            self.fail("lookup: %s returned %s" % (id, item))
+
+
+    def traverse(self, rnd):
+        visited = set()
+        self.item_manager.traverse_tree(fun=lambda i: visited.add(i.id()), collection=False)
+        missing = set(self.document_ids) - visited
+        if len(missing) > 0:
+            self.fail("traverse: missed %d documents" % len(missing))
+
+
+    def reconcile(self, rnd):
+        self.item_manager.reconcile()
+        time.sleep(0.2)
+
+
+    def reload(self, rnd):
+        self.item_manager.get_root(force=True)
+        time.sleep(1)
+
+
+def check_tree(item_manager, document_ids):
+    """ Returns a list of all inconsistencies of the current tree.
+    """
+    from model.collection import COUNT_DOCUMENTS, COUNT_SYNCING, COUNT_DELETED
+
+    errors = []
+    root = item_manager.get_root()
+    items = root.subtree()
+    ids = [item.id() for item in items]
+    if len(ids) != len(set(ids)):
+        errors.append("Items are part of the tree more than once")
+
+    for item in items:
+        if item.is_root():
+            continue
+        siblings = [c for c in item.parent().children() if c is item]
+        if len(siblings) != 1:
+            errors.append("%s is %d times a child of its parent" % (item.id(), len(siblings)))
+        if item_manager.get_item(item.id()) is not item:
+            errors.append("Index of %s is outdated" % item.id())
+
+    for item in items:
+        if not item.is_collection():
+            continue
+        documents = len([i for i in item.subtree() if i.is_document()])
+        if item.counts()[COUNT_DOCUMENTS] != documents:
+            errors.append("%s counts %d instead of %d documents" % (
+                item.id(), item.counts()[COUNT_DOCUMENTS], documents))
+        if item.counts()[COUNT_SYNCING] != 0:
+            errors.append("%s is still syncing" % item.id())
+        deleted = len([i for i in item.subtree() if i.is_deleted()])
+        if item.counts()[COUNT_DELETED] != deleted:
+            errors.append("%s counts %d instead of %d deleted items" % (
+                item.id(), item.counts()[COUNT_DELETED], deleted))
+
+    if set([i.id() for i in items if i.is_document()]) != set(document_ids):
+        errors.append("Documents of the tree do not match the cloud")
+    return errors
+
+
+def run(seconds=20, documents=300, syncers=8, seed=0):
+    """ Runs the stress test against a new mock cloud and returns the 
+        (number of operations per kind, list of errors). HOME must point 
+        to a temporary folder beforehand.
+    """
+    import api.remarkable_client
+    from model.item_manager import ItemManager
+    from benchmarks.mock_cloud import MockCloud
+
+    cloud = MockCloud(documents=documents, collections=30, latency=0.005, seed=seed)
+    api.remarkable_client.set_base_url(cloud.start())
+    try:
+        item_manager = ItemManager()
+        item_manager.get_root(force=True)
+        document_ids = [m["ID"] for m in cloud.listing() if m["Type"] == "DocumentType"]
+
+        stress = _Stress(item_manager, document_ids, seconds, seed)
+        threads = [stress.thread("sync", stress.sync) for i in range(syncers)]
+        threads += [stress.thread("move", stress.move) for i in range(2)]
+        threads += [stress.thread("lookup", stress.lookup) for i in range(2)]
+        threads += [stress.thread("traverse", stress.traverse) for i in range(2)]
+        threads.append(stress.thread("reconcile", stress.reconcile))
+        threads.append(stress.thread("reload", stress.reload))
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        item_manager.flush_metadata()
+        return stress.counts, stress.errors + check_tree(item_manager, document_ids)
+
+    finally:
+        cloud.stop()
+
+
+#
+# M A I N
+#
+def main():
+    parser = argparse.ArgumentParser(description="Stress test of the item tree")
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--documents", type=int, default=300)
+    parser.add_argument("--syncers", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # Never touch the data of the user
+    os.environ["HOME"] = tempfile.mkdtemp(prefix="remapy_stress_")
+    Path(os.environ["HOME"], ".remapy/data").mkdir(parents=True)
+
+    counts, errors = run(args.seconds, args.documents, args.syncers, args.seed)
+
+    print("Operations: %s" % ", ".join(["%s %d" % c for c in sorted(counts.items())]))
+    for error in errors[:20]:
+        print("(Error) %s" % error)
+    print("%d errors" % len(errors))
+    sys.exit(1 if len(errors) > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
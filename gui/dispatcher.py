@@ -0,0 +1,116 @@
+import threading
+
+
+#
+# DEFINITIONS
+#
+DEFAULT_INTERVAL_MS = 100
+
+
+#
+# CLASS
+#
+class GuiDispatcher(object):
+    """ Tkinter widgets must only be touched from the main thread. Worker
+        threads therefore post their updates to this dispatcher which
+        applies them on the main thread every interval_ms milliseconds.
+        Multiple updates of the same key are collapsed into one such that
+        e.g. an item that changes its state several times between two
+        flushes is redrawn only once.
+    """
+
+    #
+    # CTOR
+    #
+    def __init__(self, window, interval_ms=DEFAULT_INTERVAL_MS):
+        self.window = window
+        self.interval_ms = interval_ms
+        self._main_thread = threading.current_thread()
+        self._lock = threading.Lock()
+        self._calls = []
+        self._latest = {}
+        self._batches = {}
+
+        self.window.after(self.interval_ms, self._flush)
+
+
+    #
+    # Functions
+    #
+    def is_main_thread(self):
+        return threading.current_thread() is self._main_thread
+
+
+    def post(self, fun, *args):
+        """ Calls fun(*args) on the main thread. Calls are executed in the
+            same order as they are posted.
+        """
+        with self._lock:
+            self._calls.append((fun, args))
+
+
+    def post_latest(self, key, fun, value):
+        """ Calls fun(value) on the main thread. If something was already
+            posted for the same key it is replaced by the new value.
+        """
+        with self._lock:
+            self._latest[key] = (fun, value)
+
+
+    def post_batch(self, key, fun, value):
+        """ Collects all values that are posted for the same key and calls
+            fun(values) only once per flush on the main thread.
+        """
+        with self._lock:
+            if key not in self._batches:
+                self._batches[key] = (fun, [])
+            self._batches[key][1].append(value)
+
+
+    def call(self, fun, *args):
+        """ Calls fun(*args) on the main thread and blocks until the result
+            is available e.g. to show a dialog from a worker thread.
+        """
+        if self.is_main_thread():
+            return fun(*args)
+
+        done = threading.Event()
+        result = {}
+
+        def run():
+            try:
+                result["value"] = fun(*args)
+            finally:
+                done.set()
+
+        self.post(run)
+        done.wait()
+        return result.get("value", None)
+
+
+    def _flush(self):
+        with self._lock:
+            calls, self._calls = self._calls, []
+            latest, self._latest = self._latest, {}
+            batches, self._batches = self._batches, {}
+
+        # Ordered calls first, as they could e.g. create the
+        # tree entries that are updated afterwards.
+        for fun, args in calls:
+            self._execute(fun, *args)
+
+        for fun, value in latest.values():
+            self._execute(fun, value)
+
+        for fun, values in batches.values():
+            self._execute(fun, values)
+
+        self.window.after(self.interval_ms, self._flush)
+
+
+    def _execute(self, fun, *args):
+        try:
+            fun(*args)
+        except Exception as e:
+            print("(Warning) Failed to update gui.")
+            print(e)
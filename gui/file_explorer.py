@@ -7,7 +7,6 @@ import queue
 import uuid
 from time import gmtime, strftime
 import datetime
-import numpy as np
 from pathlib import Path
 import tkinter as tk
 import tkinter.ttk as ttk
@@ -17,13 +16,24 @@ from PIL import ImageTk as itk
 from PIL import Image
 
 from gui.elements.entry_with_placeholder import EntryWithPlaceholder
+from gui.dispatcher import GuiDispatcher
 import api.remarkable_client
 from api.remarkable_client import RemarkableClient
 from model.item_manager import ItemManager
+from model.upload_manager import UploadManager, UploadJob
+from model.sync_coordinator import SyncCoordinator
 from model.item import Item
 import model.document
 from model.document import Document
 import utils.config
+import utils.timing as timing
+import utils.profiling as profiling
+
+
+#
+# DEFINITIONS
+#
+FILTER_DEBOUNCE_MS = 250
 
 
 class FileExplorer(object):
@@ -31,7 +41,7 @@ class FileExplorer(object):
         all your rm documents and collections.
     """
 
-    def __init__(self, root, window, font_size=14, row_height=14):
+    def __init__(self, root, window, font_size=14, row_height=14, dispatcher=None):
         
         self.root = root
         self.window = window
@@ -45,6 +55,8 @@ class FileExplorer(object):
         self.nodes = dict()
         self.rm_client = RemarkableClient()
         self.item_manager = ItemManager()
+        self.upload_manager = UploadManager()
+        self.dispatcher = GuiDispatcher(window) if dispatcher is None else dispatcher
 
         self.tree_style = ttk.Style()
         self.tree_style.configure("remapy.style.Treeview", highlightthickness=0, bd=0, font=font_size, rowheight=row_height)
@@ -58,6 +70,7 @@ class FileExplorer(object):
         self.label_offline.place(relx=0.5, y=12, anchor="center")
 
         self.entry_filter = None
+        self._filter_job = None
         self.entry_filter_var = tk.StringVar()
         self.entry_filter_var.trace("w", self.filter_changed_event_handler)
         self.entry_filter = EntryWithPlaceholder(window, "Filter...", textvariable=self.entry_filter_var)
@@ -131,6 +144,11 @@ class FileExplorer(object):
         self.log_widget.config(state=tk.DISABLED)
         self.log_widget.pack(expand=True, fill=tk.X)
         
+        # Show the documents of the last session immediately. Changes of 
+        # the rm cloud are applied as soon as we are signed in.
+        self.is_online = False
+        self._update_tree(self.item_manager.load_cached_root())
+
         self.rm_client.listen_sign_in_event(self)
     
 
@@ -154,9 +172,17 @@ class FileExplorer(object):
 
 
     def log_console(self, text):
+        """ Can be called from any thread. All lines that are logged in 
+            between two gui updates are written at once.
+        """
         now = strftime("%H:%M:%S", gmtime())
+        line = "\n[%s] %s" % (str(now), text)
+        self.dispatcher.post_batch("log", self._write_log, line)
+
+
+    def _write_log(self, lines):
         self.log_widget.config(state=tk.NORMAL)
-        self.log_widget.insert(tk.END, "\n[%s] %s" % (str(now), text))
+        self.log_widget.insert(tk.END, "".join(lines))
         self.log_widget.config(state=tk.DISABLED)
         self.log_widget.see(tk.END)
     
@@ -208,40 +234,48 @@ class FileExplorer(object):
         if self.entry_filter is None:
             return 
 
+        # Debounce keystrokes such that the tree is only filtered
+        # once the user stopped typing
+        if self._filter_job is not None:
+            self.window.after_cancel(self._filter_job)
+        self._filter_job = self.window.after(FILTER_DEBOUNCE_MS, self._apply_filter)
+
+
+    def _apply_filter(self):
+        self._filter_job = None
+
         filter_text = self.entry_filter_var.get()
-        if filter_text == self.entry_filter.placeholder:
-            filter_text = None
+        if filter_text == self.entry_filter.placeholder or filter_text == "":
+            matches = None
+        else:
+            matches = self.item_manager.get_search_index().match(filter_text)
         
         root = self.item_manager.get_root()
         self.tree.delete(*self.tree.get_children())
-        self._update_tree(root, filter_text)
+        self._update_tree(root, matches)
 
 
-    def _update_tree(self, item, filter=None):
+    def _update_tree(self, item, matches=None):
+        """ Adds the item and all its children to the tree. If matches is 
+            given (see SearchIndex.match) only matching items are added.
+        """
         try:
-            is_direct_match = False
             if not item.is_root():
-                is_match, is_direct_match = self._match_filter(item, filter)
-                if is_match:
-                    self.tree.insert(
-                        item.parent().id(), 
-                        0 if item.id() != "trash" else 99999, 
-                        item.id(),
-                        open=filter!=None)
-
-                    self._update_tree_item(item)
-                    item.add_state_listener(self._update_tree_item)
-                    include_all_childs = item.is_collection() and is_direct_match
-                    if include_all_childs:
-                        filter = None
-
-            # Sort by name and item type
-            sorted_children = item.children()
-            sorted_children.sort(key=lambda x: str.lower(x.name()), reverse=True)
-            sorted_children.sort(key=lambda x: int(x.is_document()), reverse=True)
-            sorted_children.sort(key=lambda x: int(x.id()=="trash"), reverse=True)
-            for child in sorted_children:
-                self._update_tree(child, filter)
+                if matches is not None and not item.id() in matches:
+                    return
+
+                self.tree.insert(
+                    item.parent().id(), 
+                    0 if item.id() != "trash" else 99999, 
+                    item.id(),
+                    open=matches is not None and matches[item.id()])
+
+                self._update_tree_item(item)
+                if not self.item_state_changed_event_handler in item.state_listener:
+                    item.add_state_listener(self.item_state_changed_event_handler)
+
+            for child in self._sorted_children(item):
+                self._update_tree(child, matches)
         except Exception as e:
             self.log_console("(Warning) Failed to add item %s" % item.id())
             print(e)
@@ -252,53 +286,26 @@ class FileExplorer(object):
                 pass
     
 
-    def _match_filter(self, item, filter):  
-        """ Returns whether we have a match on this path (to include all 
-            parent folders) and whether the given item was the matching one.
-        """
-        if filter is None or filter == "":
-            return True, True
-        
-        if filter.startswith("!b "):
-            bookmarked_only = True
-            text_filter = filter[3:]
-        elif filter == "!b":
-            bookmarked_only = True
-            text_filter = ""
-        else:
-            bookmarked_only = False
-            text_filter = filter
-
-        is_match = (text_filter.lower() in item.name().lower())
-        
-        if bookmarked_only:
-            is_match = is_match and item.bookmarked()
-
-        if is_match:
-            return is_match, True
-
-        for child in item.children():
-            child_match, _ = self._match_filter(child, filter)
-            if child_match:
-                return child_match, False
-
-        return False, False
-    
-
     def tree_right_click(self, event):
         selected_ids = self.tree.selection()
         if selected_ids:
             items = [self.item_manager.get_item(id) for id in selected_ids]
+
+            # A selection is invalid if an ancestor of an item is selected 
+            # too. Checking the parents of each item takes O(k * depth).
+            selected = set(selected_ids)
             for item in items:
-                for possile_child in items:
-                    if not item.is_parent_of(possile_child):
-                        continue 
+                if item is None:
+                    continue
+
+                if not any(parent.id() in selected for parent in item.ancestors()):
+                    continue 
                     
-                    messagebox.showerror(
-                        "Invalid operation", 
-                        "Your selection is invalid. You can not perform an \
-                            action on a folder and one of its child items.")
-                    return
+                messagebox.showerror(
+                    "Invalid operation", 
+                    "Your selection is invalid. You can not perform an \
+                        action on a folder and one of its child items.")
+                return
 
             self.context_menu.tk_popup(event.x_root, event.y_root)   
             pass         
@@ -307,7 +314,70 @@ class FileExplorer(object):
             pass
 
 
+    def _sorted_children(self, item):
+        """ Sort by name and item type. Note that the children are inserted
+            at the top of the tree, therefore the order is reversed.
+        """
+        sorted_children = sorted(item.children(), key=lambda x: str.lower(x.name()), reverse=True)
+        sorted_children.sort(key=lambda x: int(x.is_document()), reverse=True)
+        sorted_children.sort(key=lambda x: int(x.id()=="trash"), reverse=True)
+        return sorted_children
+
+
+    def _sort_tree_children(self, item):
+        tree_id = "" if item.is_root() else item.id()
+        ids = [child.id() for child in reversed(self._sorted_children(item)) 
+            if self.tree.exists(child.id())]
+        self.tree.set_children(tree_id, *ids)
+
+
+    def _apply_tree_changes(self, changes):
+        """ Applies the changes of ItemManager.reconcile to the tree such 
+            that only new and moved items are touched. Changed and removed 
+            items are updated by their state listener.
+        """
+        filter_text = self.entry_filter_var.get()
+        if filter_text != self.entry_filter.placeholder and filter_text != "":
+            self._apply_filter()
+            return
+
+        parents = {}
+        for item in changes["added"]:
+            parent = item.parent()
+            parent_id = "" if parent.is_root() else parent.id()
+            if self.tree.exists(item.id()) or (parent_id != "" and not self.tree.exists(parent_id)):
+                continue
+
+            self.tree.insert(parent_id, "end", item.id())
+            self._update_tree_item(item)
+            if not self.item_state_changed_event_handler in item.state_listener:
+                item.add_state_listener(self.item_state_changed_event_handler)
+            parents[parent_id] = parent
+
+        for item, old_parent_id in changes["moved"]:
+            parent = item.parent()
+            parent_id = "" if parent.is_root() else parent.id()
+            if not self.tree.exists(item.id()) or (parent_id != "" and not self.tree.exists(parent_id)):
+                continue
+
+            self.tree.move(item.id(), parent_id, "end")
+            parents[parent_id] = parent
+
+        for parent in parents.values():
+            self._sort_tree_children(parent)
+
+
+    def item_state_changed_event_handler(self, item):
+        """ Called by (worker) threads whenever the state of an item changes.
+            The tree is updated later on the main thread.
+        """
+        self.dispatcher.post_latest(item.id(), self._update_tree_item, item)
+
+
     def _update_tree_item(self, item):
+        if not self.tree.exists(item.id()):
+            return
+
         if item.state == model.item.STATE_DELETED:
             self.tree.delete(item.id())
         else:
@@ -407,6 +477,7 @@ class FileExplorer(object):
             return
 
         item.rename(name)
+        self.item_manager.invalidate_search_index()
 
     def key_binding_resync(self, event):
         self.btn_resync_item_click()
@@ -479,17 +550,36 @@ class FileExplorer(object):
 
 
     def btn_sync_click(self):
+        """ Loads the listing of the rm cloud in the background and applies 
+            only the differences to the tree which is already shown.
+        """
         self.log_console("Syncing all documents...")
-        root, self.is_online = self.item_manager.get_root(force=True)
 
+        def run():
+            try:
+                changes, is_online = self.item_manager.reconcile()
+            except Exception as e:
+                self.log_console("(Error) Failed to load documents")
+                print(e)
+                return
+            self.dispatcher.post(self._reconciled, changes, is_online)
+
+        threading.Thread(target=run).start()
+
+
+    def _reconciled(self, changes, is_online):
+        self.is_online = is_online
         if self.is_online:
             self._set_online_mode("normal")
         else:
             self.log_console("OFFLINE MODE: No connection to the remarkable cloud")
             self._set_online_mode("disabled")
 
-        self.tree.delete(*self.tree.get_children())
-        self._update_tree(root)
+        if changes is None:
+            self.tree.delete(*self.tree.get_children())
+            self._update_tree(self.item_manager.get_root())
+        else:
+            self._apply_tree_changes(changes)
 
         self._sync_items_async([self.item_manager.get_root()],
                 force=False, 
@@ -532,7 +622,9 @@ class FileExplorer(object):
                     
                 q.task_done()
 
-        num_worker_threads = 10
+        # The workers are bounded by the max. number of concurrent requests,
+        # how many of them download at once is adapted by the client.
+        num_worker_threads = self.rm_client.limiter.maximum
         for i in range(num_worker_threads):
             t = threading.Thread(target=worker)
             t.start()
@@ -544,6 +636,18 @@ class FileExplorer(object):
             
         q.join()
 
+        # Persist metadata of all collections once per batch
+        self.item_manager.flush_metadata()
+
+        # Write timings of this run if enabled (see utils.timing)
+        timing_path = timing.dump("sync")
+        if timing_path != None:
+            self.log_console("Timings written to %s" % timing_path)
+
+        profile_path = profiling.dump_summary()
+        if profile_path != None:
+            self.log_console("Slowest documents written to %s" % profile_path)
+
         # stop workers
         for i in range(num_worker_threads):
             q.put(None)
@@ -552,15 +656,16 @@ class FileExplorer(object):
     
 
     def _sync_and_open_item(self, item, force, open_file, open_original, open_oap):   
-        
-        if item.state == model.item.STATE_SYNCING:
-            self.log_console("Already syncing '%s'" %  item.full_name())
-            return
 
+        # If the document is synced already, we wait for this sync (see 
+        # SyncCoordinator) and open the document afterwards if requested
         if (force or item.state != model.item.STATE_SYNCED) and not item.is_root():
-            item.sync()
+            if item.is_document() and SyncCoordinator().is_syncing(item.id()):
+                self.log_console("Already syncing '%s'" %  item.full_name())
 
-            if item.is_document():
+            is_synced_by_us = item.sync()
+
+            if item.is_document() and is_synced_by_us:
                 self.log_console("Synced '%s'" %  item.full_name())
 
         if open_file and item.is_document():
@@ -569,7 +674,7 @@ class FileExplorer(object):
             elif open_oap:
                 file_to_open = item.oap_file()
                 if file_to_open == None:
-                    messagebox.showinfo("Information", "Document is not annotated.", icon='info')
+                    self.dispatcher.post(messagebox.showinfo, "Information", "Document is not annotated.")
                     return
             else: 
                 file_to_open = item.ann_or_orig_file()
@@ -605,7 +710,7 @@ class FileExplorer(object):
                 continue
             
             child_count = item.get_exact_children_count()
-            count = np.add(count, child_count)
+            count = [count[0] + child_count[0], count[1] + child_count[1]]
         
         message = "Do you really want to delete (or trash) %d collection(s) and %d file(s)?" % (count[1], count[0])
         result = messagebox.askquestion("Delete", message, icon='warning')
@@ -614,6 +719,8 @@ class FileExplorer(object):
             return
 
         def run():
+            items_to_trash = []
+            items_to_delete = []
             for item in items:
                 if item.name() == "Quick sheets" and item.parent().is_root():
                     self.log_console("(Warning) You can not delete the Quick sheets.")
@@ -624,11 +731,12 @@ class FileExplorer(object):
                     continue
                 
                 if item.parent().id() == "trash":
-                    item.delete()
-                    self.log_console("Deleted %s" % item.full_name())
+                    items_to_delete.append(item)
                 else: 
-                    trash = self.item_manager.trash
-                    self._move(item, trash)
+                    items_to_trash.append(item)
+            
+            self._delete_items(items_to_delete)
+            self._move_items(items_to_trash, self.item_manager.trash)
                     
         threading.Thread(target=run).start()
 
@@ -641,33 +749,69 @@ class FileExplorer(object):
         items = [self.item_manager.get_item(id) for id in selected_ids]
 
         def run():
+            items_to_restore = []
             for item in items:
                 if item.parent().id() != "trash":
                     self.log_console("(Warning) Restore of '%s' not necessary." % item.full_name())
                     continue
                 
-                self._move(item, self.item_manager.root)
+                items_to_restore.append(item)
+            
+            self._move_items(items_to_restore, self.item_manager.root)
                     
         threading.Thread(target=run).start()
 
 
-    def _move(self, item, new_parent):
-        old_parent_id = item.parent().id()
+    def _delete_items(self, items):
+        if len(items) <= 0:
+            return 
+
+        deleted, failed = Item.delete_bulk(items)
+        self.item_manager.invalidate_search_index()
+
+        deleted_ids = set([item.id() for item in deleted])
+        for item in items:
+            if item.id() in deleted_ids:
+                self.log_console("Deleted %s" % item.full_name())
+
+        if len(failed) > 0:
+            self.log_console("(Error) Failed to delete %d item(s)" % len(failed))
+
+
+    def _move_items(self, items, new_parent):
+        if len(items) <= 0:
+            return 
+
+        old_parent_ids = [item.parent().id() for item in items]
+
+        # Move on cloud with bulk requests. Items that could not be moved 
+        # are moved back by update_metadata_bulk.
+        for item in items:
+            item.move(new_parent, push=False)
+        updated, failed = Item.update_metadata_bulk(items)
+        self.item_manager.invalidate_search_index()
+
+        updated_ids = set([item.id() for item in updated])
+        for item, old_parent_id in zip(items, old_parent_ids):
+            if not item.id() in updated_ids:
+                continue
+            self.dispatcher.post(self._move_tree_item, item.id(), old_parent_id, new_parent.id())
+            self.log_console("Moved '%s' into '%s'" % (item.full_name(), new_parent.full_name()))
+
+        for item in failed:
+            self.log_console("(Error) Failed to move '%s' into '%s'" % (item.full_name(), new_parent.full_name()))
 
-        # Move on cloud
-        item.move(new_parent)
 
+    def _move_tree_item(self, id, old_parent_id, new_parent_id):
         # Remove from old parent (tree view)
         old_parent_children = list(self.tree.get_children(old_parent_id))
-        old_parent_children.remove(item.id())
+        old_parent_children.remove(id)
         self.tree.set_children(old_parent_id, *old_parent_children)
         
-        # Add to trash (tree view)
-        new_parent_children = list(self.tree.get_children(new_parent.id()))
-        new_parent_children.append(item.id())
-        self.tree.set_children(new_parent.id(), *new_parent_children)
-        
-        self.log_console("Moved '%s' into '%s'" % (item.full_name(), new_parent.full_name()))
+        # Add to new parent (tree view)
+        new_parent_children = list(self.tree.get_children(new_parent_id))
+        new_parent_children.append(id)
+        self.tree.set_children(new_parent_id, *new_parent_children)
 
     #
     # Copy, Paste, Cut
@@ -720,23 +864,17 @@ class FileExplorer(object):
             filetype = is_file(clipboard)
             if filetype != None:
                 name = os.path.splitext(os.path.basename(clipboard))[0]
-                self.tree.insert(
-                    parent_id, 9999, id,
-                    text= " " + name,
-                    image=self._create_tree_icon("document_upload"))
-
-                with open(clipboard, "rb") as f:
-                    data = f.read()
+                self.dispatcher.post(self._insert_upload_item, parent_id, id, name)
+                file_path = clipboard
+                data = None
 
-            elif is_url(path):
+            elif is_url(clipboard):
+                file_path = None
                 try:
                     import pdfkit
                     self.log_console("Converting webpage '%s'. This could take a few minutes." % clipboard)
                     name = clipboard
-                    self.tree.insert(
-                        parent_id, 9999, id,
-                        text= " " + name,
-                        image=self._create_tree_icon("document_upload"))
+                    self.dispatcher.post(self._insert_upload_item, parent_id, id, name)
 
                     options = {
                         # Here we can manually set some cookies to 
@@ -748,24 +886,91 @@ class FileExplorer(object):
                     data = pdfkit.from_url(clipboard, False, options=options)
                     filetype = "pdf"
                 except Exception as e:
-                    messagebox.showerror(
+                    self.dispatcher.post(messagebox.showerror,
                         "Failed to convert html to pdf", 
                         "Please ensure that you installed pdfkit and wkhtmltopdf correctly https://pypi.org/project/pdfkit/")
-                    self.tree.delete(id)
+                    self.dispatcher.post(self.tree.delete, id)
                     return
 
             # Show new item in tree
             self.log_console("Upload document %s..." % name)
 
-            # Upload
-            item = self.item_manager.upload_file(
-                id, parent_id, name, 
-                filetype, data,
-                self._update_tree_item)
-            self.log_console("Successfully uploaded %s" % item.full_name())
-
+            # Upload with a bounded number of threads (see UploadManager)
+            self.upload_manager.upload(UploadJob(
+                id, parent_id, name, filetype, 
+                data=data, 
+                path=file_path,
+                state_listener=self.item_state_changed_event_handler,
+                progress_listener=self.upload_progress_event_handler,
+                done_listener=self.upload_done_event_handler,
+                duplicate_listener=self.upload_duplicate_event_handler))
+
+        # Files are queued directly, only the conversion of webpages 
+        # needs an own thread.
         for path in paths:
-            threading.Thread(target=run, args=[path]).start()
+            if is_file(path) != None:
+                run(path)
+            else:
+                threading.Thread(target=run, args=[path]).start()
+
+
+    def upload_progress_event_handler(self, job, sent, total):
+        percent = int(100 * sent / max(total, 1))
+        self.dispatcher.post_latest(
+            "upload_%s" % job.id, 
+            self._update_upload_item, 
+            (job.id, "%s (%d%%)" % (job.name, percent)))
+    
+
+    def upload_done_event_handler(self, job, item, error):
+        if error != None:
+            self.log_console("(Error) Failed to upload %s" % job.name)
+            self.dispatcher.post(self.tree.delete, job.id)
+            return
+
+        if item.id() != job.id:
+            self.log_console("Skipped upload of %s (already exists)" % job.name)
+            return
+
+        self.item_manager.invalidate_search_index()
+        self.dispatcher.post_latest(
+            "upload_%s" % job.id, 
+            self._update_upload_item, 
+            (job.id, job.name))
+        self.log_console("Successfully uploaded %s" % item.full_name())
+
+
+    def upload_duplicate_event_handler(self, job, existing):
+        """ Called from the upload thread if the content of the file already
+            exists. Returns True if the file should be uploaded anyway.
+        """
+        message = "'%s' already exists as '%s'. Do you want to upload it anyway?" % (job.name, existing.full_name())
+        upload = self.dispatcher.call(messagebox.askyesno, "Duplicate", message)
+        if not upload:
+            self.dispatcher.post(self._show_existing_item, job.id, existing.id())
+        return upload
+
+
+    def _show_existing_item(self, upload_id, existing_id):
+        if self.tree.exists(upload_id):
+            self.tree.delete(upload_id)
+
+        if self.tree.exists(existing_id):
+            self.tree.see(existing_id)
+            self.tree.selection_set(existing_id)
+
+
+    def _update_upload_item(self, args):
+        id, text = args
+        if self.tree.exists(id):
+            self.tree.item(id, text=" " + text)
+
+
+    def _insert_upload_item(self, parent_id, id, name):
+        self.tree.insert(
+            parent_id, 9999, id,
+            text= " " + name,
+            image=self._create_tree_icon("document_upload"))
 
 
     def btn_open_in_file_explorer(self):
@@ -790,5 +995,10 @@ class FileExplorer(object):
 
         def run():
             for item in items:
-                item.set_bookmarked(not item.bookmarked())
+                item.set_bookmarked(not item.bookmarked(), push=False)
+            _, failed = Item.update_metadata_bulk(items)
+            self.item_manager.invalidate_search_index()
+
+            for item in failed:
+                self.log_console("(Error) Failed to toggle the bookmark of '%s'" % item.full_name())
         threading.Thread(target=run).start()
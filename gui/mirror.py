@@ -0,0 +1,122 @@
+import threading
+import tkinter as tk
+from tkinter import messagebox
+from pathlib import Path
+
+import utils.config as cfg
+from model.item_manager import ItemManager
+from model.mirror import Mirror
+
+
+#
+# DEFINITIONS
+#
+MIRROR_INTERVAL_MS = 5000
+
+
+class MirrorTab(object):
+    """ Mirrors all documents into a human readable folder tree and keeps it 
+        updated while RemaPy is running (see Mirror).
+    """
+
+    def __init__(self, root, window, dispatcher):
+        self.item_manager = ItemManager()
+        self.dispatcher = dispatcher
+        self.window = window
+        self.mirror = None
+        self.is_updating = False
+
+        root.grid_columnconfigure(4, minsize=180)
+        root.grid_rowconfigure(1, minsize=50)
+        root.grid_rowconfigure(2, minsize=30)
+        root.grid_rowconfigure(3, minsize=30)
+        root.grid_rowconfigure(4, minsize=50)
+
+        # gaps between columns
+        label = tk.Label(root, text="    ")
+        label.grid(row=1, column=1)
+        label = tk.Label(root, text="    ")
+        label.grid(row=1, column=3)
+        label = tk.Label(root, text="  ")
+        label.grid(row=1, column=5)
+
+        label = tk.Label(root, text="Mirror", font="Helvetica 14 bold")
+        label.grid(row=1, column=2, sticky="W")
+
+        label = tk.Label(root, text="Mirror path:")
+        label.grid(row=2, column=2, sticky="W")
+        self.mirror_path_text = tk.StringVar()
+        mirror_path_default = Path.joinpath(Path.home(), "Remarkable")
+        self.mirror_path_text.set(cfg.get("general.mirrorpath", default=str(mirror_path_default)))
+        self.entry_mirror_path = tk.Entry(root, textvariable=self.mirror_path_text)
+        self.entry_mirror_path.grid(row=2, column=4, sticky="W")
+
+        label = tk.Label(root, justify="left", anchor="w", text="All documents are mirrored into this folder. Renames, moves and \ndeletions are applied to the mirror, changed documents are copied again.")
+        label.grid(row=2, column=7, sticky="W")
+
+        self.auto_update = tk.BooleanVar()
+        self.auto_update.set(cfg.get("general.mirrorauto", default=False))
+        self.check_auto_update = tk.Checkbutton(root, text="Update automatically", variable=self.auto_update)
+        self.check_auto_update.grid(row=3, column=4, sticky="W")
+
+        self.btn_update = tk.Button(root, text="Update mirror", command=self.btn_update_click, width=17)
+        self.btn_update.grid(row=4, column=4, sticky="W")
+
+        self.label_status = tk.Label(root)
+        self.label_status.grid(row=4, column=7, sticky="W")
+
+        self.window.after(MIRROR_INTERVAL_MS, self._auto_update)
+
+
+    def btn_update_click(self):
+        if self.item_manager.root is None:
+            messagebox.showerror("Error", "Documents are not loaded yet.")
+            return
+
+        general = cfg.get("general", default={})
+        general["mirrorpath"] = self.mirror_path_text.get()
+        general["mirrorauto"] = self.auto_update.get()
+        cfg.save({"general": general})
+
+        self._update_async()
+
+
+    def _auto_update(self):
+        self.window.after(MIRROR_INTERVAL_MS, self._auto_update)
+        if not self.auto_update.get() or self.item_manager.root is None:
+            return
+        
+        mirror = self._get_mirror()
+        if mirror.has_changes():
+            self._update_async()
+
+
+    def _get_mirror(self):
+        mirror_path = Path(self.mirror_path_text.get())
+        if self.mirror is None or self.mirror.mirror_path != mirror_path:
+            # Otherwise the old mirror keeps listening to all items
+            if self.mirror != None:
+                self.mirror.close()
+            self.mirror = Mirror(mirror_path, self.item_manager)
+        return self.mirror
+
+
+    def _update_async(self):
+        if self.is_updating:
+            return
+        
+        self.is_updating = True
+        mirror = self._get_mirror()
+        self.label_status.config(text="Updating mirror...")
+
+        def run():
+            try:
+                changes = mirror.update()
+                status = "Mirror updated (%d changes)" % changes
+            except Exception as e:
+                print(e)
+                status = "(Error) Failed to update mirror"
+            self.dispatcher.post(self.label_status.config, {"text": status})
+            self.is_updating = False
+        
+        threading.Thread(target=run).start()
@@ -12,10 +12,24 @@ from api.remarkable_client import RemarkableClient
 import utils.config as cfg
 from model.item_manager import ItemManager
 
+
+#
+# DEFINITIONS
+#
+# Backup mode -> compression of the archive (False for a folder backup)
+BACKUP_MODES = {
+    "Folder": False,
+    "Archive (.tar)": None,
+    "Archive (.tar.gz)": "gz",
+    "Archive (.tar.xz)": "xz",
+}
+
+
 class Settings(object):
-    def __init__(self, root, font_size):
+    def __init__(self, root, font_size, dispatcher):
         self.rm_client=RemarkableClient()
         self.item_manager = ItemManager()
+        self.dispatcher = dispatcher
 
         root.grid_columnconfigure(4, minsize=180)
         root.grid_rowconfigure(1, minsize=50)
@@ -104,8 +118,29 @@ class Settings(object):
         label = tk.Label(root, justify="left", anchor="w", text="Copy currently downloaded and annotated PDF files \ninto the given directory. Note that those files can not \nbe restored on the tablet.")
         label.grid(row=11, column=7, sticky="W") 
 
+        label = tk.Label(root, text="Backup mode:")
+        label.grid(row=12, column=2, sticky="W")
+        self.backup_mode_text = tk.StringVar()
+        self.backup_mode_text.set(cfg.get("general.backupmode", default="Folder"))
+        self.combo_backup_mode = ttk.Combobox(root, textvariable=self.backup_mode_text, 
+                values=list(BACKUP_MODES.keys()), state="readonly", width=18)
+        self.combo_backup_mode.grid(row=12, column=4, sticky="W")
+
+        label = tk.Label(root, justify="left", anchor="w", text="Archives are streamed into a single (compressed) tar file.")
+        label.grid(row=12, column=7, sticky="W") 
+
+        label = tk.Label(root, text="Volume size (MB):")
+        label.grid(row=13, column=2, sticky="W")
+        self.backup_volume_size_text = tk.StringVar()
+        self.backup_volume_size_text.set(cfg.get("general.backupvolumesize", default=""))
+        self.entry_backup_volume_size = tk.Entry(root, textvariable=self.backup_volume_size_text)
+        self.entry_backup_volume_size.grid(row=13, column=4, sticky="W")
+
+        label = tk.Label(root, justify="left", anchor="w", text="Split archives into volumes of this size (empty = no split). \nJoin them again with 'cat backup.tar.000 backup.tar.001 ...'")
+        label.grid(row=13, column=7, sticky="W") 
+
         self.btn_create_backup = tk.Button(root, text="Create backup", command=self.btn_create_backup, width=17)
-        self.btn_create_backup.grid(row=12, column=4, sticky="W")
+        self.btn_create_backup.grid(row=14, column=4, sticky="W")
 
         # Subscribe to sign in event. Outer logic (i.e. main) can try to 
         # sign in automatically...
@@ -123,6 +158,8 @@ class Settings(object):
         self.btn_save.config(state="disabled")
         self.entry_backup_root.config(state="disabled")
         self.entry_backup_folder.config(state="disabled")
+        self.combo_backup_mode.config(state="disabled")
+        self.entry_backup_volume_size.config(state="disabled")
         self.entry_templates.config(state="disabled")
 
         if event == api.remarkable_client.EVENT_SUCCESS:
@@ -132,6 +169,8 @@ class Settings(object):
             self.btn_save.config(state="normal")
             self.entry_backup_root.config(state="normal")
             self.entry_backup_folder.config(state="normal")
+            self.combo_backup_mode.config(state="readonly")
+            self.entry_backup_volume_size.config(state="normal")
             self.entry_templates.config(state="normal")
             self.label_auth_status.config(text="Successfully signed in", fg="green")
             
@@ -153,10 +192,14 @@ class Settings(object):
     
 
     def btn_save_click(self):
-        general = {
+        # Keep the keys of the general section that are set elsewhere
+        general = cfg.get("general", default={})
+        general.update({
             "templates": self.entry_templates_text.get(),
-            "backuproot": self.backup_root_text.get()
-        }
+            "backuproot": self.backup_root_text.get(),
+            "backupmode": self.backup_mode_text.get(),
+            "backupvolumesize": self.backup_volume_size_text.get()
+        })
         cfg.save({"general": general})
 
 
@@ -170,12 +213,47 @@ class Settings(object):
         backup_root = self.backup_root_text.get()
         backup_folder = self.backup_folder_text.get()
         backup_path = Path.joinpath(Path(backup_root), backup_folder)
+        compression = BACKUP_MODES.get(self.backup_mode_text.get(), False)
+
+        try:
+            volume_size = self.backup_volume_size_text.get().strip()
+            volume_size = int(float(volume_size) * 1024 * 1024) if volume_size != "" else None
+        except ValueError:
+            messagebox.showerror("Error", "Invalid volume size.")
+            return
+
         self.label_backup_progress.config(text="Writing backup '%s'" % backup_path)
 
+        # Tk must only be used on the main thread (see GuiDispatcher)
         def run():
-            self.item_manager.create_backup(backup_path)
-            self.label_backup_progress.config(text="")
-            messagebox.showinfo("Info", "Successfully created backup '%s'" % backup_path)       
+            try:
+                if compression is False:
+                    summary = self.item_manager.create_backup(backup_path)
+                else:
+                    summary = self.item_manager.create_archive_backup(backup_path, compression, volume_size)
+            except Exception as e:
+                print("(Error) Failed to create backup '%s'" % backup_path)
+                print(e)
+                self.dispatcher.post(self._backup_finished, backup_path, None)
+                return
+            self.dispatcher.post(self._backup_finished, backup_path, summary)
 
         threading.Thread(target=run).start()
 
+
+    def _backup_finished(self, backup_path, summary):
+        self.label_backup_progress.config(text="")
+        if summary is None:
+            messagebox.showerror("Error", "Failed to create backup '%s'" % backup_path)
+            return
+
+        messagebox.showinfo("Info", 
+            "Successfully created backup '%s'\n\n"
+            "Copied: %d files (%.1f MB)\n"
+            "Reused: %d files (%.1f MB)\n"
+            "Failed: %d files" % (
+                backup_path, 
+                summary["copied_files"], summary["copied_bytes"] / 1e6,
+                summary["reused_files"], summary["reused_bytes"] / 1e6,
+                summary["failed_files"]))
+
@@ -0,0 +1,374 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import tarfile
+import tempfile
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from model.hash_index import hash_file
+
+
+#
+# DEFINITIONS
+#
+MANIFEST_NAME = ".remapy_backup.json"
+CHUNK_SIZE = 1024 * 1024
+DEFAULT_NUM_WORKERS = 8
+
+# Files that are added to an archive are snapshotted in memory up to this
+# size, larger ones are spooled to disk
+SNAPSHOT_SPOOL_SIZE = 32 * 1024 * 1024
+
+# ioctl to clone a file on filesystems that support reflinks (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+#
+# HELPER
+#
+def copy_file(src, dst):
+    """ Copies src to dst with the fastest method that is available and 
+        returns the sha256 hash of the copy. The data is copied inside of 
+        the kernel (reflink, copy_file_range or sendfile) if possible and 
+        the copy is hashed afterwards, otherwise it is hashed while it is 
+        copied in user space.
+    """
+    sha = None
+    with open(src, "rb") as f_src, open(dst, "wb") as f_dst:
+        if not _kernel_copy(f_src.fileno(), f_dst.fileno(), os.fstat(f_src.fileno()).st_size):
+            sha = hashlib.sha256()
+            for chunk in iter(lambda: f_src.read(CHUNK_SIZE), b""):
+                sha.update(chunk)
+                f_dst.write(chunk)
+    shutil.copystat(src, dst)
+    return sha.hexdigest() if sha != None else hash_file(dst)
+
+
+def _kernel_copy(fd_src, fd_dst, size):
+    if sys.platform.startswith("linux"):
+        try:
+            import fcntl
+            fcntl.ioctl(fd_dst, FICLONE, fd_src)
+            return True
+        except (ImportError, OSError):
+            pass
+
+    for copy_fun in [getattr(os, "copy_file_range", None), getattr(os, "sendfile", None)]:
+        if copy_fun is None:
+            continue
+
+        try:
+            offset = 0
+            while offset < size:
+                if copy_fun == os.sendfile:
+                    sent = os.sendfile(fd_dst, fd_src, offset, size - offset)
+                else:
+                    sent = os.copy_file_range(fd_src, fd_dst, size - offset, offset, offset)
+                if sent == 0:
+                    break
+                offset += sent
+            
+            if offset == size:
+                return True
+        except OSError:
+            pass
+        
+        # Start again with the next method
+        os.lseek(fd_dst, 0, os.SEEK_SET)
+        os.ftruncate(fd_dst, 0)
+
+    return False
+
+
+#
+# CLASS
+#
+class Backup(object):
+    """ Incremental backup of all documents. A manifest (stored in the parent
+        folder of the backup path i.e. the backup root) remembers id, version,
+        size, hash and backup path of every document. Unchanged documents 
+        are skipped if they are already in the backup path or hard-linked 
+        from the previous backup. Only changed documents are copied.
+        Folders are created while the tree is traversed and the files are 
+        copied in parallel by a thread pool.
+    """
+
+    #
+    # CTOR
+    #
+    def __init__(self, backup_path, num_workers=DEFAULT_NUM_WORKERS):
+        self.backup_path = Path(backup_path)
+        self.manifest_path = self.backup_path.parent / MANIFEST_NAME
+        self.manifest = self._load_manifest()
+
+        self.summary = {
+            "copied_files": 0,
+            "copied_bytes": 0,
+            "reused_files": 0,
+            "reused_bytes": 0,
+            "missing_files": 0,
+            "failed_files": 0,
+        }
+
+        self._lock = threading.Lock()
+        self._created_folders = set()
+        self._executor = ThreadPoolExecutor(max_workers=num_workers)
+
+
+    #
+    # Functions
+    #
+    def add(self, item):
+        if item.is_root():
+            return
+
+        if item.is_collection():
+            self._mkdir(self.backup_path / item.full_name())
+            return
+        
+        # Create the folder now such that the workers can start copying
+        source = item.ann_or_orig_file()
+        target = item.backup_file(self.backup_path)
+        self._mkdir(Path(target).parent)
+        self._executor.submit(self._add_document_safe, item, source, target)
+
+
+    def finish(self):
+        """ Writes the manifest and returns the summary of the backup.
+        """
+        self._executor.shutdown(wait=True)
+        self.backup_path.mkdir(parents=True, exist_ok=True)
+        tmp_path = "%s.tmp" % self.manifest_path
+        with open(tmp_path, "w") as out:
+            out.write(json.dumps(self.manifest, indent=4))
+        os.replace(tmp_path, self.manifest_path)
+        return self.summary
+
+
+    def _mkdir(self, path):
+        if path in self._created_folders:
+            return
+        
+        path.mkdir(parents=True, exist_ok=True)
+        self._created_folders.add(path)
+
+
+    def _add_document_safe(self, document, source, target):
+        try:
+            self._add_document(document, source, target)
+        except Exception as e:
+            with self._lock:
+                self.summary["failed_files"] += 1
+            print("(Warning) Failed to backup %s" % document.full_name())
+            print(e)
+
+
+    def _add_document(self, document, source, target):
+        if not os.path.exists(source):
+            with self._lock:
+                self.summary["missing_files"] += 1
+            return
+        
+        size = os.path.getsize(source)
+        with self._lock:
+            entry = self.manifest.get(document.id(), None)
+        is_unchanged = entry != None and \
+            entry["version"] == document.version() and \
+            entry["size"] == size and \
+            entry["source"] == os.path.basename(source) and \
+            os.path.exists(entry["path"])
+        
+        # Reused files keep their hash (manifests of older versions have none)
+        if is_unchanged:
+            content_hash = entry.get("hash", None) or hash_file(entry["path"])
+
+        if is_unchanged and os.path.abspath(entry["path"]) == os.path.abspath(target):
+            self._count("reused", size)
+        elif is_unchanged:
+            try:
+                if os.path.exists(target):
+                    os.remove(target)
+                os.link(entry["path"], target)
+                self._count("reused", size)
+            except OSError:
+                # E.g. a different filesystem
+                content_hash = copy_file(entry["path"], target)
+                self._count("copied", size)
+        else:
+            content_hash = copy_file(source, target)
+            self._count("copied", size)
+
+        with self._lock:
+            self.manifest[document.id()] = {
+                "version": document.version(),
+                "size": size,
+                "hash": content_hash,
+                "source": os.path.basename(source),
+                "path": os.path.abspath(target),
+            }
+
+
+    def _count(self, kind, size):
+        with self._lock:
+            self.summary["%s_files" % kind] += 1
+            self.summary["%s_bytes" % kind] += size
+
+
+    def _load_manifest(self):
+        if not self.manifest_path.exists():
+            return {}
+
+        try:
+            with open(self.manifest_path, "r") as f:
+                return json.loads(f.read())
+        except Exception as e:
+            print("(Warning) Failed to load backup manifest. Create full backup.")
+            print(e)
+            return {}
+
+
+class VolumeWriter(object):
+    """ Write-only file object that splits the written stream into volumes
+        path.000, path.001, ... of at most volume_size bytes. If volume_size
+        is None everything is written into a single file.
+    """
+
+    #
+    # CTOR
+    #
+    def __init__(self, path, volume_size=None):
+        self.path = str(path)
+        self.volume_size = volume_size
+        self.volumes = []
+        self._file = None
+        self._written = 0
+
+
+    #
+    # Functions
+    #
+    def write(self, data):
+        data = memoryview(data)
+        total = len(data)
+        while len(data) > 0:
+            if self._file is None or (self.volume_size != None and self._written >= self.volume_size):
+                self._next_volume()
+            
+            size = len(data) if self.volume_size is None else min(len(data), self.volume_size - self._written)
+            self._file.write(data[:size])
+            self._written += size
+            data = data[size:]
+        return total
+
+
+    def flush(self):
+        if self._file != None:
+            self._file.flush()
+
+
+    def close(self):
+        if self._file != None:
+            self._file.close()
+            self._file = None
+
+
+    def _next_volume(self):
+        self.close()
+        if self.volume_size is None:
+            path = self.path
+        else:
+            path = "%s.%03d" % (self.path, len(self.volumes))
+        
+        self._file = open(path, "wb")
+        self._written = 0
+        self.volumes.append(path)
+
+
+class ArchiveBackup(object):
+    """ Streams all documents into a single (optionally compressed) tar 
+        archive. Entries are written while the tree is traversed, nothing is
+        staged on disk. Items must be added top down, such that the entry
+        of a folder precedes its contents. If volume_size is given, the 
+        archive is split into volumes (see VolumeWriter) that can be joined 
+        again with cat.
+    """
+
+    #
+    # CTOR
+    #
+    def __init__(self, backup_path, compression=None, volume_size=None):
+        extension = ".tar" if compression is None else ".tar.%s" % compression
+        self.backup_path = Path(backup_path)
+        self.archive_path = Path("%s%s" % (backup_path, extension))
+        self.archive_path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._writer = VolumeWriter(self.archive_path, volume_size)
+        mode = "w|" if compression is None else "w|%s" % compression
+        self._tar = tarfile.open(fileobj=self._writer, mode=mode)
+
+        self.summary = {
+            "copied_files": 0,
+            "copied_bytes": 0,
+            "reused_files": 0,
+            "reused_bytes": 0,
+            "missing_files": 0,
+            "failed_files": 0,
+        }
+
+
+    #
+    # Functions
+    #
+    def add(self, item):
+        if item.is_root():
+            return
+        
+        if item.is_collection():
+            info = tarfile.TarInfo(item.full_name())
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            info.mtime = time.time()
+            self._tar.addfile(info)
+            return
+        
+        source = item.ann_or_orig_file()
+        if not os.path.exists(source):
+            self.summary["missing_files"] += 1
+            return
+
+        # Path inside of the archive
+        target = item.backup_file(self.backup_path)
+        arcname = os.path.relpath(target, self.backup_path)
+
+        # The file is copied into a snapshot before its header is written:
+        # If it changed during tar.add (e.g. a sync renders it again), the 
+        # entry would not match its header and corrupt the whole archive.
+        try:
+            snapshot = tempfile.SpooledTemporaryFile(max_size=SNAPSHOT_SPOOL_SIZE)
+            with open(source, "rb") as f:
+                shutil.copyfileobj(f, snapshot, CHUNK_SIZE)
+                info = self._tar.gettarinfo(fileobj=f, arcname=arcname)
+        except Exception as e:
+            self.summary["failed_files"] += 1
+            print("(Warning) Failed to backup %s" % item.full_name())
+            print(e)
+            return
+
+        with snapshot:
+            info.size = snapshot.tell()
+            snapshot.seek(0)
+            self._tar.addfile(info, snapshot)
+        self.summary["copied_files"] += 1
+        self.summary["copied_bytes"] += info.size
+
+
+    def finish(self):
+        self._tar.close()
+        self._writer.close()
+        self.summary["volumes"] = self._writer.volumes
+        return self.summary
@@ -1,7 +1,18 @@
-import numpy as np
 import model.item
 from model.item import Item
-from pathlib import Path
+from model.metadata_writer import MetadataWriter
+
+
+#
+# DEFINITIONS
+#
+# Positions of the aggregated counters (see Item.counts)
+COUNT_DOCUMENTS = 0
+COUNT_COLLECTIONS = 1
+COUNT_SYNCING = 2
+COUNT_OUT_OF_SYNC = 3
+# Items in the trash. A deleted collection counts once, not its children.
+COUNT_DELETED = 4
 
 
 class Collection(Item):
@@ -12,7 +23,12 @@ class Collection(Item):
     def __init__(self, metadata, parent):
         super(Collection, self).__init__(metadata, parent)
         self.state = model.item.STATE_SYNCED
-        pass
+
+        # Counters of this collection and all its descendants and the 
+        # counters that were contributed by each child. Therefore a state 
+        # change of a child can be propagated up to the root in O(depth).
+        self._counts = [0, 1, 0, 0, 0]
+        self._child_counts = {}
 
 
     #
@@ -22,12 +38,31 @@ class Collection(Item):
         return "-"
 
 
+    def counts(self):
+        # Whether this collection is deleted depends only on its parent,
+        # therefore it is added here rather than stored in _counts
+        counts = list(self._counts)
+        counts[COUNT_DELETED] += int(self.is_deleted())
+        return tuple(counts)
+
+
     #
     # Functions
     #
     def add_child(self, child: Item):
-        self._children.append(child)
-        child.add_state_listener(self.listen_child_state_change)
+        with model.item.tree_lock:
+            self._children.append(child)
+            child.add_state_listener(self.listen_child_state_change)
+            self.listen_child_state_change(child)
+
+
+    def remove_child(self, child: Item):
+        with model.item.tree_lock:
+            self._children = [c for c in self._children if c is not child]
+            child.remove_state_listener(self.listen_child_state_change)
+
+            old_counts = self._child_counts.pop(child.id(), model.item.NO_COUNTS)
+            self._add_counts(old_counts, model.item.NO_COUNTS)
 
 
     def sync(self):
@@ -35,22 +70,11 @@ class Collection(Item):
             return
 
         # Write metadata of collection and of all parents to ensure 
-        # that we have the same information available when we are offline
-        self._write_remapy_file()
-        self.parent().sync()
-
-
-    def delete(self):
-        
-        for child in self._children:
-            ok = child.delete()
-            if not ok:
-                return False
-
-        ok = self.rm_client.delete_item(self.id(), self.version())
-        if ok:
-            self._update_state(state=model.item.STATE_DELETED)
-        return ok
+        # that we have the same information available when we are offline.
+        # If this collection is already dirty, all parents are dirty too.
+        # The metadata is written with the next MetadataWriter.flush()
+        if MetadataWriter().mark_dirty(self):
+            self.parent().sync()
 
 
     def full_name(self):
@@ -77,44 +101,51 @@ class Collection(Item):
         
             return: (num_documents, num_collections)
         """
-        count = [0, 1]
-        for child in self._children:
-            if child.is_document():
-                count[0] += 1
-                continue
-            child_count = child.get_exact_children_count()
-            count = np.add(count, child_count)
-            
-        return count
+        return [self._counts[COUNT_DOCUMENTS], self._counts[COUNT_COLLECTIONS]]
     
 
     def is_parent_of(self, item):
-        for child in self._children:
-            if child.id() == item.id():
-                return True
-            
-            if child.is_parent_of(item):
-                return True
-        
-        return False
+        """ True if this collection is an ancestor of the given item. The 
+            parents of the item are checked rather than the whole subtree
+            of this collection, i.e. it takes O(depth).
+        """
+        return any(parent.id() == self.id() for parent in item.ancestors())
     
 
     def listen_child_state_change(self, item):
-        if item.state == model.item.STATE_DELETED:
-            self._children.remove(item)
-            return
-        
-        # Check sync stage
-        for child in self._children:
-            if child.state == model.item.STATE_SYNCING:
-                self._update_state(model.item.STATE_SYNCING)
+        # State changes are reported by many sync workers at once
+        with model.item.tree_lock:
+            # The item could have been moved away while the change was 
+            # reported, then the new parent counts it instead
+            if item.parent() is not self:
                 return
-        self._update_state(model.item.STATE_SYNCED)
-    
 
-    def create_backup(self, path):
-        Path(path).mkdir(parents=True, exist_ok=True)
+            old_counts = self._child_counts.get(item.id(), model.item.NO_COUNTS)
+
+            if item.state == model.item.STATE_DELETED:
+                self._children = [c for c in self._children if c is not item]
+                self._child_counts.pop(item.id(), None)
+                new_counts = model.item.NO_COUNTS
+            else:
+                new_counts = item.counts()
+                self._child_counts[item.id()] = new_counts
+            
+            self._add_counts(old_counts, new_counts)
 
+
+    def _add_counts(self, old_counts, new_counts):
+        """ Replaces the old counters of a child with the new ones and
+            informs the parent (via the state listener) if something changed.
+        """
+        if old_counts == new_counts:
+            return
+
+        for i in range(len(self._counts)):
+            self._counts[i] += new_counts[i] - old_counts[i]
+
+        is_syncing = self._counts[COUNT_SYNCING] > 0
+        self._update_state(model.item.STATE_SYNCING if is_syncing else model.item.STATE_SYNCED)
     
+
     def update_state(self):
         pass
\ No newline at end of file
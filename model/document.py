@@ -10,12 +10,18 @@ import json
 
 
 from api.remarkable_client import RemarkableClient
-from utils.helper import Singleton
-import model.render as render
+from utils.helper import Singleton, LazyModule
 import model.item
 from model.item import Item
 from model.collection import Collection
+from model.sync_coordinator import SyncCoordinator
 import utils.config as cfg
+import utils.timing as timing
+import utils.profiling as profiling
+
+
+# The render stack (reportlab, pdfrw) is only loaded once it is needed
+render = LazyModule("model.render")
 
 
 # Document type states
@@ -78,6 +84,13 @@ class Document(Item):
         return False
 
 
+    def counts(self):
+        return (1, 0, 
+            int(self.state == model.item.STATE_SYNCING), 
+            int(self.state == STATE_OUT_OF_SYNC),
+            int(self.is_deleted()))
+
+
     def full_name(self):
         return "%s/%s" % (self.parent().full_name(), self.name())
 
@@ -89,22 +102,34 @@ class Document(Item):
         return self.orig_file()
     
 
-    def rename(self, new_name):
-        
-        self.path_oap_pdf
-        super(Document, self).rename(new_name)
+    def rename(self, new_name, push=True):
+        super(Document, self).rename(new_name, push)
+        self._rename_local_files()
+
+
+    def update_metadata_local(self, metadata):
+        self.metadata = metadata
+        self.blob_url = None
+        self._rename_local_files()
+        self._update_state()
+
 
+    def _rename_local_files(self):
+        """ The annotated pdfs are named after the document.
+        """
         try:
             old = self.path_annotated_pdf
             self.path_annotated_pdf = self._get_path_annotated_pdf()
-            os.rename(old, self.path_annotated_pdf)
+            if old != self.path_annotated_pdf:
+                os.rename(old, self.path_annotated_pdf)
         except:
             pass
 
         try:
             old = self.path_oap_pdf
             self.path_oap_pdf = self._get_path_oap_pdf()
-            os.rename(old, self.path_oap_pdf)
+            if old != self.path_oap_pdf:
+                os.rename(old, self.path_oap_pdf)
         except:
             pass
 
@@ -137,51 +162,85 @@ class Document(Item):
     # Functions
     #
     def delete_local(self):
-        if os.path.exists(self.path):
-            shutil.rmtree(self.path)
+        with SyncCoordinator().item_lock(self.id()):
+            if os.path.exists(self.path):
+                shutil.rmtree(self.path)
         self._update_state()
     
 
-    def delete(self):
-        ok = self.rm_client.delete_item(self.id(), self.version())
-
-        if ok:
-            self.state = model.item.STATE_DELETED
-            self._update_state_listener()
-        return ok
+    def sync(self):
+        """ Downloads and renders this document. If it is synced already 
+            (e.g. by the background sync), we wait for this sync instead.
+            Returns True if this call synced the document.
+        """
+        result, is_synced_by_us = SyncCoordinator().run(self.id(), self._sync_once)
+        return is_synced_by_us
 
 
-    def sync(self):
-        if self.state == model.item.STATE_SYNCING:
-            return 
-            
+    def _sync_once(self):
         self.state = model.item.STATE_SYNCING
         self._update_state_listener()
 
-        self._download_raw()
+        try:
+            with timing.document(self.id(), self.name()):
+                with timing.phase("document.sync"):
+                    with profiling.profile(self.id(), self.name(), 
+                            lambda: render.stats(self.path_rm_files)):
+                        self._sync()
+        except:
+            # Otherwise the document would be shown as syncing forever
+            self._update_state()
+            raise
+
+        self.parent().sync()
+
+
+    def _sync(self):
+        with timing.phase("document.download_raw"):
+            self._download_raw()
         self._write_remapy_file()
         self._update_state(inform_listener=False)
 
         annotations_exist = os.path.exists(self.path_rm_files)
 
         if self.type == TYPE_NOTEBOOK and annotations_exist:
-            render.notebook(
-                self.path, 
-                self.id(), 
-                self.path_annotated_pdf,
-                path_templates=cfg.get("general.templates"))
+            with timing.phase("document.render"):
+                render.notebook(
+                    self.path, 
+                    self.id(), 
+                    self.path_annotated_pdf,
+                    path_templates=cfg.get("general.templates"))
         
         else:
             if annotations_exist:
                 # Also for epubs a pdf file exists which we can annotate :)
                 # We will then show the pdf rather than the epub...
-                render.pdf(
-                    self.path_rm_files, 
-                    self.path_original_pdf,
-                    self.path_annotated_pdf,
-                    self.path_oap_pdf)
+                with timing.phase("document.render"):
+                    render.pdf(
+                        self.path_rm_files, 
+                        self.path_original_pdf,
+                        self.path_annotated_pdf,
+                        self.path_oap_pdf)
 
         self._update_state()
+
+
+    def register_local(self, file_type, path=None, data=None):
+        """ Uses the file that was just uploaded as local copy of this 
+            document, such that it must not be downloaded again.
+        """
+        with SyncCoordinator().item_lock(self.id()):
+            Path(self.path).mkdir(parents=True, exist_ok=True)
+            target = self.path_original_epub if file_type == "epub" else self.path_original_pdf
+
+            if path is None:
+                with open(target, "wb") as out:
+                    out.write(data)
+            else:
+                shutil.copyfile(path, target)
+            
+            self._write_remapy_file()
+        self._update_state()
         self.parent().sync()
 
 
@@ -194,14 +253,20 @@ class Document(Item):
         if self.blob_url == None:
             self.blob_url = self.rm_client.get_item(self.id())["BlobURLGet"]
 
-        raw_file = self.rm_client.get_raw_file(self.blob_url)
-        with open(self.path_zip, "wb") as out:
-            out.write(raw_file)
-        
-        with zipfile.ZipFile(self.path_zip, "r") as zip_ref:
-            zip_ref.extractall(path)
-        
-        os.remove(self.path_zip)
+        try:
+            self.rm_client.download_file(self.blob_url, self.path_zip, version=self.version())
+        except Exception:
+            # Blob urls expire, therefore we request a new one next time.
+            # Partial data is kept and the download is resumed.
+            self.blob_url = None
+            raise
+
+        with timing.phase("document.extract"):
+            try:
+                with zipfile.ZipFile(self.path_zip, "r") as zip_ref:
+                    zip_ref.extractall(path)
+            finally:
+                os.remove(self.path_zip)
 
         # Update state
         self._update_state(inform_listener=False)
@@ -241,12 +306,10 @@ class Document(Item):
         self._update_state_listener()
 
 
-    def create_backup(self, backup_path):
-        
+    def backup_file(self, backup_path):
+        """ Returns the path of this document inside of the given backup.
+        """
         backup_path = "%s/%s" % (backup_path, self.parent().full_name())
-        Path(backup_path).mkdir(parents=True, exist_ok=True)
-
-        file_to_backup = self.ann_or_orig_file()
-        extension = os.path.splitext(file_to_backup)[1]
+        extension = os.path.splitext(self.ann_or_orig_file())[1]
         file_name = self.name().replace("/", ".") + extension
-        shutil.copyfile(file_to_backup, backup_path + "/" + file_name)
+        return "%s/%s" % (backup_path, file_name)
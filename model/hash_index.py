@@ -0,0 +1,181 @@
+import os
+import json
+import hashlib
+import threading
+from pathlib import Path
+
+from utils.helper import Singleton
+import utils.config
+
+
+#
+# DEFINITIONS
+#
+CHUNK_SIZE = 1024 * 1024
+
+
+#
+# HELPER
+#
+def get_path_index():
+    # Not inside of utils.config.PATH, as everything that is not an item 
+    # is deleted from this folder during a sync
+    return "%s/hashes.json" % Path(utils.config.PATH).parent
+
+
+def hash_file(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def hash_data(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+#
+# CLASS
+#
+class HashIndex(metaclass=Singleton):
+    """ Local index of the content hashes of all synced documents. It is 
+        used to detect whether a file that should be uploaded already 
+        exists in the rm cloud. Documents are hashed lazily and only if 
+        their size matches the size of the upload. Hashes are stored in 
+        ~/.remapy/hashes.json such that they are computed only once.
+    """
+
+    #
+    # CTOR
+    #
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._entries = self._load()
+        self._hashing = {}
+
+
+    #
+    # Functions
+    #
+    def find(self, content_hash, size, documents):
+        """ Returns the id of a document with the given hash and size or 
+            None. Only the given (synced) documents of the same size are 
+            hashed if the index contains no valid hash for them.
+        """
+        found = None
+        for document in documents:
+            path = document.orig_file()
+            if self._stat(path)[0] != size:
+                continue
+            
+            if self._hash(document, path) == content_hash:
+                found = document.id()
+                break
+        
+        self.flush()
+        return found
+
+
+    def add(self, document, content_hash):
+        """ Adds the hash of a document that was just uploaded.
+        """
+        size, mtime = self._stat(document.orig_file())
+        with self._lock:
+            self._set(document.id(), content_hash, size, mtime, document.version())
+        self.flush()
+
+
+    def flush(self):
+        """ Writes the index if it was changed.
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+        self._save()
+
+
+    #
+    # HELPER
+    #
+    def _hash(self, document, path):
+        """ Returns the hash of the original file of the document. The file
+            is hashed only if the index contains no valid hash for it i.e. 
+            if the version, size or modification time changed. Concurrent
+            uploads wait for each other if they need the same hash.
+        """
+        id = document.id()
+        while True:
+            size, mtime = self._stat(path)
+            with self._lock:
+                entry = self._entries.get(id, None)
+                if entry != None and entry["size"] == size and \
+                        entry.get("mtime") == mtime and \
+                        entry.get("version") == document.version():
+                    return entry["hash"]
+                
+                event = self._hashing.get(id, None)
+                if event is None:
+                    event = threading.Event()
+                    self._hashing[id] = event
+                    break
+            event.wait()
+
+        content_hash = None
+        try:
+            content_hash = hash_file(path)
+        except Exception as e:
+            print("(Warning) Failed to hash %s" % path)
+            print(e)
+
+        with self._lock:
+            if content_hash != None:
+                self._set(id, content_hash, size, mtime, document.version())
+            del self._hashing[id]
+        event.set()
+        return content_hash
+
+
+    def _stat(self, path):
+        try:
+            stat = os.stat(path)
+            return stat.st_size, stat.st_mtime
+        except (OSError, TypeError):
+            return None, None
+
+
+    def _set(self, id, content_hash, size, mtime, version):
+        self._entries[id] = {
+            "hash": content_hash, 
+            "size": size, 
+            "mtime": mtime,
+            "version": version
+        }
+        self._dirty = True
+
+
+    def _load(self):
+        path = get_path_index()
+        if not os.path.exists(path):
+            return {}
+        
+        try:
+            with open(path, "r") as f:
+                return json.loads(f.read())
+        except Exception as e:
+            print("(Warning) Failed to load hash index.")
+            print(e)
+            return {}
+
+
+    def _save(self):
+        with self._lock:
+            content = json.dumps(self._entries)
+        
+        path = get_path_index()
+        tmp_path = "%s.%d.tmp" % (path, threading.get_ident())
+        with open(tmp_path, "w") as out:
+            out.write(content)
+        os.replace(tmp_path, path)
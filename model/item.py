@@ -1,5 +1,7 @@
 from datetime import datetime
 import time
+import os
+import threading
 from pathlib import Path
 import json
 
@@ -14,8 +16,18 @@ STATE_SYNCING = 1
 STATE_SYNCED = 2
 STATE_DELETED = 170591
 
+# (documents, collections, syncing, out of sync, deleted) see Collection.counts
+NO_COUNTS = (0, 0, 0, 0, 0)
+
 RFC3339Nano = "%Y-%m-%dT%H:%M:%SZ"
 
+# Serializes all changes of the tree structure (children, parents and 
+# counters). Children are only appended in place and removed children are
+# dropped by replacing the list (copy on write), so iterating children 
+# never fails. Consistent traversals take a snapshot of the subtree while
+# holding this lock (see ItemManager.traverse_tree).
+tree_lock = threading.RLock()
+
 
 #
 # HELPER
@@ -54,6 +66,9 @@ class Item(object):
 
         self.rm_client = RemarkableClient()
         self.state_listener = []
+
+        # (metadata, parent) before the first change that was not pushed
+        self._pushed_state = None
         
 
     #
@@ -65,6 +80,11 @@ class Item(object):
     def is_root(self):
         return self.metadata is None
 
+    def is_deleted(self):
+        """ True if the item was moved into the trash (but not its children).
+        """
+        return self._parent is not None and self._parent.is_trash()
+
 
     def id(self):
         return self._meta_value("ID")
@@ -112,10 +132,23 @@ class Item(object):
 
     def parent(self):
         return self._parent
+
+    def ancestors(self):
+        """ Returns all parents of this item up to the root (bottom up).
+        """
+        ancestors = []
+        parent = self._parent
+        while parent != None:
+            ancestors.append(parent)
+            parent = parent.parent()
+        return ancestors
     
     def children(self):
         return self._children
 
+    def counts(self):
+        return NO_COUNTS
+
     def _meta_value(self, key, root_value=""):
         if self.is_root():
             return root_value
@@ -125,38 +158,178 @@ class Item(object):
     #
     # Functions
     #
-    def set_bookmarked(self, bookmarked):
+    def set_bookmarked(self, bookmarked, push=True):
+        """ If push is False, the metadata is only changed locally and 
+            must be pushed later via Item.update_metadata_bulk.
+        """
         if self.is_trash() or self.is_root():
             return 
 
+        self._keep_pushed_state(push)
         self.metadata["Bookmarked"] = bookmarked
-        self.metadata["ModifiedClient"] = now_rfc3339()
-        self.metadata["Version"] += 1
-        self.rm_client.update_metadata(self.metadata)
-        self._write_remapy_file()
-        self._update_state_listener()
+        self._metadata_changed(push)
 
 
-    def rename(self, new_name):
+    def rename(self, new_name, push=True):
         if self.is_trash() or self.is_root():
             return 
 
+        self._keep_pushed_state(push)
         self.metadata["VissibleName"] = new_name
-        self.metadata["ModifiedClient"] = now_rfc3339()
-        self.metadata["Version"] += 1
-        self.rm_client.update_metadata(self.metadata)
-        self._write_remapy_file()
-        self._update_state_listener()
+        self._metadata_changed(push)
 
 
-    def move(self, new_parent):
+    def move(self, new_parent, push=True):
         if self.is_trash() or self.is_root():
             return 
 
-        self._parent = new_parent
-        self.metadata["Parent"] = new_parent.id()
+        self._keep_pushed_state(push)
+        with tree_lock:
+            self._set_parent(new_parent)
+            self.metadata["Parent"] = new_parent.id()
+        self._metadata_changed(push)
+
+
+    def update_metadata_local(self, metadata):
+        """ Replaces the metadata by the (newer) metadata of the rm cloud.
+            In contrast to rename etc. nothing is pushed to the rm cloud.
+        """
+        self.metadata = metadata
+        self._update_state_listener()
+
+
+    def subtree(self):
+        """ Returns this item and all children of this item (bottom up).
+        """
+        items = []
+        for child in self._children:
+            items.extend(child.subtree())
+        items.append(self)
+        return items
+
+
+    def delete(self):
+        """ Deletes this item and all its children from the rm cloud.
+        """
+        _, failed = Item.delete_bulk([self])
+        return len(failed) <= 0
+
+
+    @staticmethod
+    def delete_bulk(items):
+        """ Deletes all given items and all of their children with as few
+            requests as possible. Items that could not be deleted are kept,
+            as are all of their ancestors.
+            return: (deleted items, failed items)
+        """
+        to_delete = []
+        ids = set()
+        for item in items:
+            for subtree_item in item.subtree():
+                if subtree_item.is_root() or subtree_item.is_trash() or subtree_item.id() in ids:
+                    continue
+                to_delete.append(subtree_item)
+                ids.add(subtree_item.id())
+        
+        # Leaves first: A collection is deleted only after all of its 
+        # children are, such that a failed child never becomes an orphan
+        rm_client = RemarkableClient()
+        pending = to_delete
+        deleted_ids = set()
+        while True:
+            batch = [item for item in pending 
+                if all(child.id() in deleted_ids for child in item.children())]
+            if len(batch) <= 0:
+                break
+
+            batch_ids = set([item.id() for item in batch])
+            pending = [item for item in pending if not item.id() in batch_ids]
+            deleted_ids.update(rm_client.delete_items(
+                [(item.id(), item.version()) for item in batch]))
+        
+        deleted = [item for item in to_delete if item.id() in deleted_ids]
+        failed = [item for item in to_delete if not item.id() in deleted_ids]
+
+        # Children of a deleted collection are removed together with the 
+        # collection, therefore we inform only the topmost deleted items.
+        for item in deleted:
+            item.state = STATE_DELETED
+        
+        for item in deleted:
+            if not item.parent().id() in deleted_ids:
+                item._update_state_listener()
+        
+        return deleted, failed
+
+
+    @staticmethod
+    def update_metadata_bulk(items):
+        """ Pushes the metadata of all given items to the rm cloud with as 
+            few requests as possible and updates the versions afterwards.
+            The local changes of items that could not be updated are 
+            rolled back.
+            return: (updated items, failed items)
+        """
+        items = [item for item in items if not item.is_trash() and not item.is_root()]
+        if len(items) <= 0:
+            return [], []
+
+        rm_client = RemarkableClient()
+        cloud_metadata = rm_client.update_metadata_bulk([item.metadata for item in items])
+        updated = [item for item in items if item.id() in cloud_metadata]
+        failed = [item for item in items if not item.id() in cloud_metadata]
+        
+        for item in updated:
+            if cloud_metadata[item.id()] is not None:
+                item.metadata["Version"] = cloud_metadata[item.id()]["Version"]
+            item._pushed_state = None
+            item._write_remapy_file()
+            item._update_state_listener()
+        
+        for item in failed:
+            item._rollback()
+
+        return updated, failed
+
+
+    def _keep_pushed_state(self, push):
+        """ Local changes (push is False) can be rolled back until they 
+            are pushed by Item.update_metadata_bulk.
+        """
+        if not push and self._pushed_state is None:
+            self._pushed_state = (dict(self.metadata), self._parent)
+
+
+    def _rollback(self):
+        """ Restores the state before all changes that were not pushed.
+        """
+        if self._pushed_state is None:
+            return 
+
+        metadata, parent = self._pushed_state
+        self._pushed_state = None
+        with tree_lock:
+            self._set_parent(parent)
+            self.metadata = metadata
+        self._update_state_listener()
+
+
+    def _set_parent(self, new_parent):
+        # Added to the new parent first, such that the item is always part
+        # of the tree for readers that do not hold the lock
+        old_parent = self._parent
+        if new_parent is not old_parent:
+            self._parent = new_parent
+            new_parent.add_child(self)
+            old_parent.remove_child(self)
+
+
+    def _metadata_changed(self, push):
         self.metadata["ModifiedClient"] = now_rfc3339()
         self.metadata["Version"] += 1
+        if not push:
+            return 
+
         self.rm_client.update_metadata(self.metadata)
         self._write_remapy_file()
         self._update_state_listener()
@@ -166,6 +339,12 @@ class Item(object):
         self.state_listener.append(listener)
 
 
+    def remove_state_listener(self, listener):
+        # Replaced rather than changed in place, such that a listener can 
+        # remove itself while the listeners are called
+        self.state_listener = [l for l in self.state_listener if l != listener]
+
+
     def _update_state_listener(self):
         for listener in self.state_listener:
             listener(self)
@@ -175,6 +354,10 @@ class Item(object):
         if self.is_root():
             return 
 
+        # Write into a temporary file first and replace the old metadata
+        # atomically such that we never read a partially written file.
         Path(self.path_remapy).mkdir(parents=True, exist_ok=True)
-        with open(self.path_metadata_local, "w") as out:
-            out.write(json.dumps(self.metadata, indent=4))
\ No newline at end of file
+        tmp_path = "%s.%d.tmp" % (self.path_metadata_local, threading.get_ident())
+        with open(tmp_path, "w") as out:
+            out.write(json.dumps(self.metadata, indent=4))
+        os.replace(tmp_path, self.path_metadata_local)
\ No newline at end of file
@@ -1,16 +1,51 @@
 import os
 import shutil
 import json 
-from io import BytesIO
+import tempfile
+import threading
 import zipfile
 from zipfile import ZipFile
+from pathlib import Path
 
 from api.remarkable_client import RemarkableClient
 import model.item
+import model.document
 from model.collection import Collection
 from model.document import Document
+from model.search_index import SearchIndex
+from model.metadata_writer import MetadataWriter
+from model.backup import Backup, ArchiveBackup
+import model.hash_index
+from model.hash_index import HashIndex
 from utils.helper import Singleton
 import utils.config
+import utils.timing as timing
+
+
+#
+# DEFINITIONS
+#
+# Uploads larger than this are spooled to disk rather than kept in memory
+UPLOAD_SPOOL_SIZE = 8 * 1024 * 1024
+
+# Those file types are already compressed, deflating them again is useless
+COMPRESSED_FILE_TYPES = ["pdf", "epub"]
+
+
+#
+# HELPER
+#
+def get_path_listing():
+    # Not inside of utils.config.PATH, as everything that is not an item 
+    # is deleted from this folder during a sync
+    return "%s/listing.json" % Path(utils.config.PATH).parent
+
+
+class UploadError(IOError):
+    """ The file could not be uploaded into the rm cloud, i.e. nothing was
+        created and the upload can be retried.
+    """
+    pass
 
 
 class ItemManager(metaclass=Singleton):
@@ -18,6 +53,9 @@ class ItemManager(metaclass=Singleton):
         that are stored in your rm cloud. Load and create items through 
         this class. It is a singleton such that it is ensured that access to 
         items goes through the same tree structure.
+        The tree can be traversed by many threads while it is changed (see
+        model.item.tree_lock). New trees are built aside and swapped in 
+        at once, such that no thread sees a half-built tree.
     """
     
 
@@ -25,6 +63,10 @@ class ItemManager(metaclass=Singleton):
         self.rm_client = RemarkableClient()
         self.root = None
         self.trash = None
+        self.search_index = None
+
+        # id -> item of the current tree
+        self._items = {}
 
 
     def get_root(self, force=False):
@@ -38,18 +80,62 @@ class ItemManager(metaclass=Singleton):
 
         metadata_list, is_online = self._get_metadata_list()
         
-        self._clean_local_items(metadata_list)
-        self.root, self.trash = self._create_tree(metadata_list)
-        return self.root, is_online
+        with timing.phase("tree.clean_local_items"):
+            self._clean_local_items(metadata_list)
+        with timing.phase("tree.create"):
+            tree = self._create_tree(metadata_list)
+        root = self._swap_tree(tree)
+        return root, is_online
+
+
+    def load_cached_root(self):
+        """ Creates the tree from the listing of the last session without 
+            any request such that it can be shown immediately. Call 
+            reconcile() afterwards to apply the changes of the rm cloud.
+        """
+        metadata_list = self._get_cached_metadata_list()
+        with timing.phase("tree.create"):
+            tree = self._create_tree(metadata_list)
+        return self._swap_tree(tree)
+
+
+    def reconcile(self):
+        """ Loads the listing from the rm cloud and applies only the 
+            differences to the current tree, such that all item objects 
+            (and their listeners) are kept. Changed and deleted items 
+            inform their state listeners.
+            return: (changes, is_online) with changes a dict of "added" 
+            items (parents first), "moved" (item, old parent id) tuples, 
+            "changed" and "removed" items. changes is None if there was 
+            no tree before, i.e. everything is new.
+        """
+        if self.root is None:
+            _, is_online = self.get_root(force=True)
+            return None, is_online
+
+        metadata_list, is_online = self._get_metadata_list()
+        if not is_online:
+            return {"added": [], "moved": [], "changed": [], "removed": []}, False
+
+        with timing.phase("tree.reconcile"), model.item.tree_lock:
+            changes = self._apply_metadata_list(metadata_list)
+        with timing.phase("tree.clean_local_items"):
+            self._clean_local_items(metadata_list)
+        return changes, True
 
 
     def get_item(self, id, item=None):
         """ Get item object for given id. If item metadata is not already
-            downloaded, it is downloaded beforehand.
+            downloaded, it is downloaded beforehand. If item is given, only
+            the subtree of this item is searched.
         """
         self.get_root()
-        
-        item = self.root if item is None else item
+
+        if item is None:
+            found = self._items.get(id, None)
+            if found is None or found.state == model.item.STATE_DELETED:
+                return None
+            return found
 
         if item.id() == id:
             return item
@@ -62,54 +148,167 @@ class ItemManager(metaclass=Singleton):
         return None
 
 
+    def get_search_index(self):
+        """ Get the search index of the current tree. The index is only 
+            built again if the tree was changed in between.
+        """
+        if self.search_index is None:
+            self.get_root()
+            self.search_index = SearchIndex(self.root)
+        return self.search_index
+
+
+    def invalidate_search_index(self):
+        self.search_index = None
+
+
     def create_backup(self, backup_path):
-        # Create folder structure
-        self.traverse_tree(
-            fun=lambda item: item.create_backup(backup_path),
-            document=False,
-            collection=True)
+        """ Creates an incremental backup (see Backup) and returns a summary
+            of copied and reused files.
+        """
+        backup = Backup(backup_path)
+        self.traverse_tree(fun=backup.add)
+        return backup.finish()
 
-        # And copy files into it
-        self.traverse_tree(
-            fun=lambda item: item.create_backup(backup_path),
-            document=True,
-            collection=False)
+
+    def create_archive_backup(self, backup_path, compression=None, volume_size=None):
+        """ Streams all documents into a tar archive (see ArchiveBackup).
+            compression can be None, "gz", "bz2" or "xz".
+        """
+        backup = ArchiveBackup(backup_path, compression, volume_size)
+        self.traverse_tree(fun=backup.add, top_down=True)
+        return backup.finish()
     
 
-    def upload_file(self, id, parent_id, name, filetype, data, state_listener=None):
+    def upload_file(self, id, parent_id, name, filetype, data=None, state_listener=None, 
+            path=None, progress=None, register_local=False, on_duplicate=None):
+        """ Uploads the given data or (to avoid loading large files into 
+            memory) the file at the given path. If register_local is True,
+            the uploaded file is used as local copy instead of downloading 
+            the document again. If the same content was already synced, 
+            on_duplicate(existing_item) is called and the upload is skipped
+            (and the existing item is returned) if it returns False.
+            Raises UploadError if the upload itself failed. Once it 
+            succeeded, later steps only warn such that a retry never 
+            uploads the same file twice.
+        """
+        if path is None:
+            content_hash = model.hash_index.hash_data(data)
+            size = len(data)
+        else:
+            content_hash = model.hash_index.hash_file(path)
+            size = os.path.getsize(path)
+
+        if on_duplicate != None:
+            existing = self.find_duplicate(content_hash, size)
+            if existing != None and not on_duplicate(existing):
+                return existing
+
+        if self.get_item(parent_id) is None:
+            print("(Warning) Parent of %s not found, upload into root" % name)
+            parent_id = ""
+
         metadata, mf = self._prepare_new_document_zip(
                 id,
                 name, 
                 data,
                 file_type=filetype, 
-                parent_id = parent_id)
+                parent_id = parent_id,
+                path=path)
 
         # Upload file into cloud
-        metadata = self.rm_client.upload(id, metadata, mf)
+        try:
+            metadata = self.rm_client.upload(id, metadata, mf, progress=progress)
+        except Exception as e:
+            raise UploadError("Failed to upload %s: %s" % (name, e))
+        finally:
+            mf.close()
+        
+        if metadata is None:
+            raise UploadError("Failed to upload %s" % name)
 
-        # Download again to ensure that metadata is correct
+        # The parent could have been deleted by a refresh during the upload.
+        # The next refresh moves the item to the place the cloud reports.
         parent = self.get_item(parent_id)
-        item = self._create_item(metadata, parent)
+        if parent is None:
+            print("(Warning) Parent of %s was deleted during the upload" % name)
+            parent = self.root
+        
+        with model.item.tree_lock:
+            item = self._create_item(metadata, parent)
+            self._items[item.id()] = item
 
         if state_listener != None:
             item.add_state_listener(state_listener)
 
-        # Download again to get it correctly
-        item.sync()
+        # Download again to get it correctly. The upload itself succeeded, 
+        # therefore we only warn if this fails. The document can be synced
+        # later on.
+        try:
+            if register_local:
+                item.register_local(filetype, path=path, data=data)
+            else:
+                item.sync()
+        except Exception as e:
+            print("(Warning) Failed to sync uploaded document %s" % name)
+            print(e)
+        
+        try:
+            HashIndex().add(item, content_hash)
+            self.flush_metadata()
+        except Exception as e:
+            print("(Warning) Failed to store metadata of %s" % name)
+            print(e)
+        return item
+
+
+    def find_duplicate(self, content_hash, size):
+        """ Returns the synced document that has the given content hash 
+            and size or None if no such document exists.
+        """
+        documents = []
+        self.traverse_tree(
+            fun=documents.append,
+            document=True,
+            collection=False)
+        
+        documents = [d for d in documents if d.type in [model.document.TYPE_PDF, model.document.TYPE_EPUB]]
+        id = HashIndex().find(content_hash, size, documents)
+        if id is None:
+            return None
+
+        item = self.get_item(id)
+        if item is None or item.state == model.item.STATE_DELETED:
+            return None
         return item
 
 
-    def traverse_tree(self, fun, item=None, document=True, collection=True):
+    def flush_metadata(self):
+        """ Writes the metadata of all items that were changed during 
+            the last sync (see MetadataWriter) and the new content hashes.
+        """
+        HashIndex().flush()
+        return MetadataWriter().flush()
+
+
+    def traverse_tree(self, fun, item=None, document=True, collection=True, top_down=False):
         """ Traverse item tree (bottom up) and call fun for item depending on 
-            whether document=True and colleciton=True.
+            whether document=True and colleciton=True. If top_down is True,
+            every collection is visited before its children. The items are 
+            taken from a snapshot of the tree, i.e. items that are moved in 
+            the meantime are visited exactly once.
         """
         item = self.get_root() if item == None else item
+
+        with model.item.tree_lock:
+            items = item.subtree()
         
-        for child in item.children():
-            self.traverse_tree(fun, child, document, collection)
+        if top_down:
+            items.reverse()
         
-        if (item.is_document() and document) or (item.is_collection() and collection):
-            fun(item)
+        for item in items:
+            if (item.is_document() and document) or (item.is_collection() and collection):
+                fun(item)
 
 
     def _create_item(self, metadata, parent):
@@ -123,37 +322,144 @@ class ItemManager(metaclass=Singleton):
             raise Exception("Unknown type %s" % metadata["Type"])
         
         parent.add_child(new_object)
+        self.search_index = None
         return new_object
 
         
+    def _apply_metadata_list(self, metadata_list):
+        changes = {"added": [], "moved": [], "changed": [], "removed": []}
+        items = {}
+        for item in self.root.subtree():
+            items["" if item.is_root() else item.id()] = item
+        cloud_ids = set([metadata["ID"] for metadata in metadata_list])
+        
+        # New items (and their parents) are created as during a full load
+        known_ids = set(items.keys())
+        lookup_table = {}
+        for i in range(len(metadata_list)):
+            lookup_table[metadata_list[i]["ID"]] = i
+        for i in range(len(metadata_list)):
+            self._create_item_and_parents(i, metadata_list, items, lookup_table)
+        changes["added"] = [items[m["ID"]] for m in metadata_list if not m["ID"] in known_ids]
+
+        # Changed metadata of existing items e.g. renamed or moved
+        for metadata in metadata_list:
+            id = metadata["ID"]
+            if not id in known_ids or metadata == items[id].metadata:
+                continue
+
+            item = items[id]
+            old_parent = item.parent()
+            new_parent = items.get(metadata["Parent"], self.root)
+            if new_parent != old_parent:
+                item._parent = new_parent
+                new_parent.add_child(item)
+                old_parent.remove_child(item)
+                changes["moved"].append((item, old_parent.id()))
+
+            item.update_metadata_local(metadata)
+            changes["changed"].append(item)
+
+        # Items that were deleted in the meantime. Children of deleted 
+        # collections are removed together with the collection.
+        removed = [item for id, item in items.items() 
+            if id != "" and id != "trash" and not id in cloud_ids]
+        removed_ids = set([item.id() for item in removed])
+        for item in removed:
+            item.state = model.item.STATE_DELETED
+        for item in removed:
+            if not item.parent().id() in removed_ids:
+                item._update_state_listener()
+        changes["removed"] = removed
+
+        for id in removed_ids:
+            items.pop(id, None)
+        self._items = items
+        self.search_index = None
+        return changes
+
+
+    def _swap_tree(self, tree):
+        """ Makes the given (root, trash, items) the current tree.
+        """
+        root, trash, items = tree
+        with model.item.tree_lock:
+            self.root, self.trash, self._items = root, trash, items
+            self.search_index = None
+        return root
+
+
     def _get_metadata_list(self):
         try:
             metadata_list = self.rm_client.list_items()
-            return metadata_list, metadata_list != None
-        except:
-            metadata_list = []
-            for local_id in os.listdir(utils.config.PATH):
-                metadata_path = model.item.get_path_metadata_local(local_id)
+        except Exception as e:
+            print("(Warning) Failed to load items from the rm cloud.")
+            print(e)
+            metadata_list = None
+        
+        if metadata_list is None:
+            return self._get_cached_metadata_list(), False
+
+        self._write_cached_metadata_list(metadata_list)
+        return metadata_list, True
+
+
+    def _get_cached_metadata_list(self):
+        """ The listing of the last session or, if not available, the 
+            metadata of all local items.
+        """
+        try:
+            if os.path.exists(get_path_listing()):
+                with open(get_path_listing(), "r") as f:
+                    return json.loads(f.read())
+        except Exception as e:
+            print("(Warning) Failed to load cached listing.")
+            print(e)
+
+        metadata_list = []
+        for local_id in os.listdir(utils.config.PATH):
+            metadata_path = model.item.get_path_metadata_local(local_id)
+            try:
                 with open(metadata_path, 'r') as file:
                     metadata_content = file.read().replace('\n', '')
                 
                 metadata = json.loads(metadata_content)
                 metadata_list.append(metadata)
+            except Exception as e:
+                print("(Warning) Failed to load metadata of %s" % local_id)
+                print(e)
+
+        return metadata_list
 
-        return metadata_list, False
+
+    def _write_cached_metadata_list(self, metadata_list):
+        try:
+            # Reconcile and a reload can write the listing at the same time
+            tmp_path = "%s.%d.tmp" % (get_path_listing(), threading.get_ident())
+            with open(tmp_path, "w") as out:
+                out.write(json.dumps(metadata_list))
+            os.replace(tmp_path, get_path_listing())
+        except Exception as e:
+            print("(Warning) Failed to cache listing.")
+            print(e)
 
 
     def _clean_local_items(self, metadata_list):
-        online_ids = [metadata["ID"] for metadata in metadata_list]
+        online_ids = set([metadata["ID"] for metadata in metadata_list])
         for local_id in os.listdir(utils.config.PATH):
-            if local_id in online_ids:
+            # Downloads in progress (id.zip, id.zip.part) are kept as well
+            if local_id.split(".")[0] in online_ids:
                 continue
             
+            # Another sync could have deleted it in the meantime
             local_file_or_folder = "%s/%s" % (utils.config.PATH, local_id)
-            if os.path.isfile(local_file_or_folder):
-                os.remove(local_file_or_folder)
-            else:
-                shutil.rmtree(local_file_or_folder)
+            try:
+                if os.path.isfile(local_file_or_folder):
+                    os.remove(local_file_or_folder)
+                else:
+                    shutil.rmtree(local_file_or_folder)
+            except FileNotFoundError:
+                continue
             print("Deleted local item %s" % local_id)
 
 
@@ -190,7 +496,7 @@ class ItemManager(metaclass=Singleton):
         for i in range(len(metadata_list)):
             self._create_item_and_parents(i, metadata_list, items, lookup_table)
 
-        return root, trash
+        return root, trash, items
 
 
     def _create_item_and_parents(self, i, metadata_list, items, lookup_table):
@@ -213,7 +519,7 @@ class ItemManager(metaclass=Singleton):
         items[new_object.id()] = new_object
 
 
-    def _prepare_new_document_zip(self, id, name, data, file_type, parent_id=""):
+    def _prepare_new_document_zip(self, id, name, data, file_type, parent_id="", path=None):
 
         # .content file
         content_file = json.dumps({
@@ -274,10 +580,17 @@ class ItemManager(metaclass=Singleton):
             # "BlobURLPutExpires": ""
         }
 
-        mf = BytesIO()
-        mf.seek(0)
+        # The zip is spooled into a temporary file and the payload is 
+        # copied in chunks, such that large files are never completely 
+        # loaded into memory.
+        mf = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_SIZE)
+        compression = zipfile.ZIP_STORED if file_type in COMPRESSED_FILE_TYPES else zipfile.ZIP_DEFLATED
         with ZipFile(mf, mode='w', compression=zipfile.ZIP_DEFLATED ) as zf:
-            zf.writestr("%s.%s" % (id, file_type), data)
+            file_name = "%s.%s" % (id, file_type)
+            if path is None:
+                zf.writestr(file_name, data, compress_type=compression)
+            else:
+                zf.write(path, file_name, compress_type=compression)
             zf.writestr("%s.content" % id, content_file)
             zf.writestr("%s.pagedata" % id, "")
 
@@ -0,0 +1,81 @@
+import atexit
+import threading
+
+from utils.helper import Singleton
+
+
+#
+# DEFINITIONS
+#
+# Dirty items are written at the latest this many seconds after they 
+# were marked, also if nobody calls flush()
+FLUSH_DELAY_SECONDS = 2.0
+
+
+class MetadataWriter(metaclass=Singleton):
+    """ Write-behind cache for the local metadata of items. During a sync 
+        every document marks its parent collections as dirty instead of 
+        writing their metadata immediately. flush() then persists the 
+        metadata of every dirty item exactly once. Items that are not 
+        flushed by the caller (e.g. a single sync) are flushed by a timer
+        and when the application exits.
+    """
+
+    #
+    # CTOR
+    #
+    def __init__(self, delay=FLUSH_DELAY_SECONDS):
+        self.delay = delay
+        self._lock = threading.Lock()
+        self._dirty = {}
+        self._timer = None
+        atexit.register(self.flush)
+
+
+    #
+    # Functions
+    #
+    def mark_dirty(self, item):
+        """ Returns False if the item was already marked as dirty.
+        """
+        with self._lock:
+            if item.id() in self._dirty:
+                return False
+            
+            self._dirty[item.id()] = item
+            if self._timer is None:
+                self._timer = threading.Timer(self.delay, self._flush_timer)
+                self._timer.daemon = True
+                self._timer.start()
+            return True
+
+
+    def is_dirty(self, item):
+        with self._lock:
+            return item.id() in self._dirty
+
+
+    def flush(self):
+        """ Writes the metadata of all dirty items and returns the number
+            of written files.
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+
+        for item in dirty.values():
+            try:
+                item._write_remapy_file()
+            except Exception as e:
+                print("(Warning) Failed to write metadata of %s" % item.id())
+                print(e)
+        
+        return len(dirty)
+
+
+    #
+    # HELPER
+    #
+    def _flush_timer(self):
+        with self._lock:
+            self._timer = None
+        self.flush()
@@ -0,0 +1,286 @@
+import os
+import json
+import shutil
+import threading
+from pathlib import Path
+
+import model.item
+from model.backup import copy_file
+
+
+#
+# DEFINITIONS
+#
+STATE_NAME = ".remapy_mirror.json"
+
+
+#
+# CLASS
+#
+class Mirror(object):
+    """ Keeps a human readable folder tree of all documents in sync with
+        the tree of the rm cloud. The mirror remembers the path of every
+        item by its id. Therefore renames and moves become renames in the
+        filesystem and only documents that changed are copied again.
+        Items report their changes through state listeners, such that an
+        update only touches the items that changed since the last update.
+        Items in the trash are not mirrored.
+    """
+
+    #
+    # CTOR
+    #
+    def __init__(self, mirror_path, item_manager):
+        self.mirror_path = Path(mirror_path)
+        self.state_path = self.mirror_path / STATE_NAME
+        self.item_manager = item_manager
+        self.state = self._load_state()
+
+        self._lock = threading.Lock()
+        self._update_lock = threading.Lock()
+        self._dirty = set()
+        self._root = None
+        self._closed = False
+
+
+    #
+    # Functions
+    #
+    def has_changes(self):
+        with self._lock:
+            if self._closed:
+                return False
+            return len(self._dirty) > 0 or self._root is not self.item_manager.root
+
+
+    def close(self):
+        """ Stops listening to the items, e.g. if the mirror path changed.
+            The mirror must not be updated afterwards.
+        """
+        with self._lock:
+            self._closed = True
+            root, self._root = self._root, None
+            self._dirty = set()
+        
+        if root != None:
+            self.item_manager.traverse_tree(
+                fun=lambda item: item.remove_state_listener(self.item_changed_event_handler), 
+                item=root)
+
+
+    def item_changed_event_handler(self, item):
+        with self._lock:
+            if self._closed:
+                # Attached by an update that ran while the mirror was closed
+                item.remove_state_listener(self.item_changed_event_handler)
+                return
+            self._dirty.add(item.id())
+
+
+    def update(self):
+        """ Applies all changes since the last update to the mirror and
+            returns the number of changed files and folders.
+        """
+        with self._update_lock:
+            root = self.item_manager.root
+            if root is None or self._closed:
+                return 0
+
+            # A new tree was loaded, therefore we compare all items (and
+            # items that are not available anymore) with the mirror.
+            if root is not self._root:
+                self._root = root
+                with self._lock:
+                    self._dirty = set(self.state.keys())
+                self.item_manager.traverse_tree(fun=self._attach, item=root)
+
+            with self._lock:
+                dirty, self._dirty = self._dirty, set()
+
+            changes = self._apply(dirty)
+            self._save_state()
+            return changes
+
+
+    def _attach(self, item):
+        if item.is_root():
+            return
+
+        if not self.item_changed_event_handler in item.state_listener:
+            item.add_state_listener(self.item_changed_event_handler)
+
+        with self._lock:
+            self._dirty.add(item.id())
+
+
+    def _attach_new_children(self, collection, dirty):
+        """ New children (e.g. uploads) of a changed collection have no 
+            listener yet.
+        """
+        for child in collection.children():
+            if child.id() in self.state or child.id() in dirty:
+                continue
+
+            self._attach(child)
+            if child.is_collection():
+                self._attach_new_children(child, dirty)
+
+
+    def _apply(self, dirty):
+        collections, documents, removed = [], [], []
+        for id in dirty:
+            item = self.item_manager.get_item(id)
+            if item is None or not self._is_mirrored(item):
+                removed.append((id, item))
+            elif item.is_collection():
+                collections.append(item)
+                self._attach_new_children(item, dirty)
+            else:
+                documents.append(item)
+
+        with self._lock:
+            new_items, self._dirty = self._dirty, set()
+        for id in new_items:
+            item = self.item_manager.get_item(id)
+            if item is None:
+                continue
+            elif item.is_collection():
+                collections.append(item)
+            else:
+                documents.append(item)
+
+        # Parents are renamed before their children. Folders are removed at
+        # the end, after all documents that are still alive moved out.
+        changes = 0
+        collections.sort(key=lambda c: len(c.full_name().split("/")))
+        for collection in collections:
+            changes += self._update_collection(collection)
+
+        for document in documents:
+            changes += self._update_document(document)
+
+        removed.sort(key=lambda r: len(self.state.get(r[0], {}).get("path", "").split("/")), reverse=True)
+        for id, item in removed:
+            changes += self._remove(id, item)
+
+        return changes
+
+
+    def _update_collection(self, collection):
+        path = collection.full_name()
+        entry = self.state.get(collection.id(), None)
+
+        if entry != None and entry["path"] != path:
+            self._rename(entry["path"], path)
+
+            # The paths of all children changed too
+            old_prefix = entry["path"] + "/"
+            for child in collection.subtree():
+                child_entry = self.state.get(child.id(), None)
+                if child_entry != None and child_entry["path"].startswith(old_prefix):
+                    child_entry["path"] = path + "/" + child_entry["path"][len(old_prefix):]
+
+        (self.mirror_path / path).mkdir(parents=True, exist_ok=True)
+        self.state[collection.id()] = {"path": path}
+        return int(entry is None or entry["path"] != path)
+
+
+    def _update_document(self, document):
+        source = document.ann_or_orig_file()
+        if not os.path.exists(source):
+            return 0
+
+        path = os.path.relpath(document.backup_file(self.mirror_path), self.mirror_path)
+        stat = os.stat(source)
+        entry = self.state.get(document.id(), None)
+        changes = 0
+
+        if entry != None and entry["path"] != path:
+            self._rename(entry["path"], path)
+            changes += 1
+
+        target = self.mirror_path / path
+        is_changed = entry is None or \
+            entry.get("version") != document.version() or \
+            entry.get("size") != stat.st_size or \
+            entry.get("mtime") != stat.st_mtime or \
+            not target.exists()
+
+        if is_changed:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = "%s.tmp" % target
+            copy_file(source, tmp_path)
+            os.replace(tmp_path, target)
+            changes += 1
+
+        self.state[document.id()] = {
+            "path": path,
+            "version": document.version(),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime
+        }
+        return changes
+
+
+    def _remove(self, id, item):
+        entry = self.state.pop(id, None)
+        if entry is None:
+            return 0
+
+        path = self.mirror_path / entry["path"]
+        if path.is_dir():
+            shutil.rmtree(path, ignore_errors=True)
+        elif path.exists():
+            os.remove(path)
+
+        # Children of deleted collections are removed together with it
+        if item != None:
+            for child in item.subtree():
+                if child.id() != id and child.id() in self.state and \
+                        self.state[child.id()]["path"].startswith(entry["path"] + "/"):
+                    del self.state[child.id()]
+        return 1
+
+
+    def _rename(self, old_path, new_path):
+        old = self.mirror_path / old_path
+        new = self.mirror_path / new_path
+        if not old.exists() or old == new:
+            return
+
+        new.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(old, new)
+
+
+    def _is_mirrored(self, item):
+        if item.state == model.item.STATE_DELETED:
+            return False
+
+        # Walk up to the root, items in the trash are not mirrored
+        parent = item
+        while parent != None and not parent.is_root():
+            if parent.is_trash() or parent.state == model.item.STATE_DELETED:
+                return False
+            parent = parent.parent()
+        return parent != None
+
+
+    def _load_state(self):
+        if not self.state_path.exists():
+            return {}
+
+        try:
+            with open(self.state_path, "r") as f:
+                return json.loads(f.read())
+        except Exception as e:
+            print("(Warning) Failed to load mirror state.")
+            print(e)
+            return {}
+
+
+    def _save_state(self):
+        self.mirror_path.mkdir(parents=True, exist_ok=True)
+        tmp_path = "%s.tmp" % self.state_path
+        with open(tmp_path, "w") as out:
+            out.write(json.dumps(self.state))
+        os.replace(tmp_path, self.state_path)
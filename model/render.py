@@ -1,19 +1,14 @@
-import sys
 import struct
 import os.path
-import argparse
-import math
 import json
 import io
-import time
 import re
-import numpy as np
-from pdfrw import PdfReader, PdfWriter, PageMerge, IndirectPdfDict, PdfDict
-from reportlab.graphics import renderPDF
+from pdfrw import PdfReader, PdfWriter, PageMerge
 from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
 from reportlab.lib import colors
-from reportlab.graphics.shapes import PolyLine, Drawing, Line
+
+import utils.timing as timing
+import utils.profiling as profiling
 
 
 # Size
@@ -32,12 +27,15 @@ default_stroke_color = {
 }
 
 
+@profiling.profiled("render.pdf", 
+    stats_fun=lambda rm_files_path, *args, **kwargs: stats(rm_files_path))
 def pdf(rm_files_path, path_original_pdf, path_annotated_pdf, path_oap_pdf):
     """ Render pdf with annotations. The path_oap_pdf defines the pdf 
         which includes only annotated pages.
     """
 
-    base_pdf = PdfReader(open(path_original_pdf, "rb"))
+    with timing.phase("render.read_pdf"):
+        base_pdf = PdfReader(open(path_original_pdf, "rb"))
 
     # Parse remarkable files and write into pdf
     annotations_pdf = []
@@ -59,7 +57,8 @@ def pdf(rm_files_path, path_original_pdf, path_annotated_pdf, path_oap_pdf):
                 continue
             
         image_width, image_height = float(page_layout[2]), float(page_layout[3])
-        annotated_page = _render_rm_file(rm_file_name, image_width=image_width, image_height=image_height, crop_box=crop_box)
+        with timing.phase("render.page"):
+            annotated_page = _render_rm_file(rm_file_name, image_width=image_width, image_height=image_height, crop_box=crop_box)
         if len(annotated_page.pages) <= 0:
             annotations_pdf.append(None)
         else:
@@ -69,20 +68,24 @@ def pdf(rm_files_path, path_original_pdf, path_annotated_pdf, path_oap_pdf):
     # Merge annotations pdf and original pdf
     writer_full = PdfWriter()
     writer_oap = PdfWriter()
-    for i in range(base_pdf.numPages):          
-        annotations_page = annotations_pdf[i]
+    with timing.phase("render.merge"):
+        for i in range(base_pdf.numPages):          
+            annotations_page = annotations_pdf[i]
 
-        if annotations_page != None:
-            merger = PageMerge(base_pdf.pages[i])
-            merger.add(annotations_page).render()
-            writer_oap.addpage(base_pdf.pages[i])
+            if annotations_page != None:
+                merger = PageMerge(base_pdf.pages[i])
+                merger.add(annotations_page).render()
+                writer_oap.addpage(base_pdf.pages[i])
 
-        writer_full.addpage(base_pdf.pages[i])
+            writer_full.addpage(base_pdf.pages[i])
 
-    writer_full.write(path_annotated_pdf)
-    writer_oap.write(path_oap_pdf)
+    with timing.phase("render.write_pdf"):
+        writer_full.write(path_annotated_pdf)
+        writer_oap.write(path_oap_pdf)
 
 
+@profiling.profiled("render.notebook", 
+    stats_fun=lambda path, id, *args, **kwargs: stats("%s/%s" % (path, id)))
 def notebook(path, id, path_annotated_pdf, path_templates=None):
     
     rm_files_path = "%s/%s" % (path, id)
@@ -96,40 +99,86 @@ def notebook(path, id, path_annotated_pdf, path_templates=None):
         if not os.path.exists(rm_file):
             break
 
-        overlay = _render_rm_file(rm_file_name)
+        with timing.phase("render.page"):
+            overlay = _render_rm_file(rm_file_name)
         annotations_pdf.append(overlay)
         p += 1  
     
     # Write empty notebook notes containing blank pages or templates
-    writer = PdfWriter()
-    templates = _get_templates_per_page(path, id, path_templates)
-    for template in templates:
-        if template == None:
-            writer.addpage(_blank_page())
-        else:
-            writer.addpage(template.pages[0])
-    writer.write(path_annotated_pdf)
+    with timing.phase("render.templates"):
+        writer = PdfWriter()
+        templates = _get_templates_per_page(path, id, path_templates)
+        for template in templates:
+            if template == None:
+                writer.addpage(_blank_page())
+            else:
+                writer.addpage(template.pages[0])
+        writer.write(path_annotated_pdf)
     
     # Overlay empty notebook with annotations
-    templates_pdf = PdfReader(path_annotated_pdf)
-    for i in range(len(annotations_pdf)):
+    with timing.phase("render.merge"):
+        templates_pdf = PdfReader(path_annotated_pdf)
+        for i in range(len(annotations_pdf)):
 
-        empty_page = len(annotations_pdf[i].pages) <= 0
-        if empty_page:
-            continue 
+            empty_page = len(annotations_pdf[i].pages) <= 0
+            if empty_page:
+                continue 
 
-        annotated_page = annotations_pdf[i].pages[0]
-        if templates != None:
-            merger = PageMerge(templates_pdf.pages[i])
-            merger.add(annotated_page).render()
-        else:
-            output_pdf.addPage(annotated_page)
+            annotated_page = annotations_pdf[i].pages[0]
+            if templates != None:
+                merger = PageMerge(templates_pdf.pages[i])
+                merger.add(annotated_page).render()
+            else:
+                output_pdf.addPage(annotated_page)
     
-    writer = PdfWriter()
-    writer.write(path_annotated_pdf, templates_pdf)
+    with timing.phase("render.write_pdf"):
+        writer = PdfWriter()
+        writer.write(path_annotated_pdf, templates_pdf)
 
 
 
+def stats(rm_files_path):
+    """ Returns the number of (pages, strokes, points) of all .rm files of 
+        a document without rendering them.
+    """
+    pages, strokes, points = 0, 0, 0
+    if not os.path.exists(rm_files_path):
+        return pages, strokes, points
+
+    for file_name in os.listdir(rm_files_path):
+        if not file_name.endswith(".rm"):
+            continue
+
+        num_strokes, num_points = _rm_file_stats("%s/%s" % (rm_files_path, file_name))
+        pages += 1
+        strokes += num_strokes
+        points += num_points
+    return pages, strokes, points
+
+
+def _rm_file_stats(rm_file):
+    with open(rm_file, 'rb') as f:
+        data = f.read()
+
+    is_v3 = data.startswith(b'reMarkable .lines file, version=3')
+    fmt = '<43sI'
+    _, nlayers = struct.unpack_from(fmt, data, 0)
+    offset = struct.calcsize(fmt)
+    stroke_fmt = '<IIIfI' if is_v3 else '<IIIffI'
+    stroke_size = struct.calcsize(stroke_fmt)
+    segment_size = struct.calcsize('<ffffff')
+
+    strokes, points = 0, 0
+    for layer in range(nlayers):
+        (nstrokes,) = struct.unpack_from('<I', data, offset); offset += 4
+        strokes += nstrokes
+        for stroke in range(nstrokes):
+            nsegments = struct.unpack_from(stroke_fmt, data, offset)[-1]
+            offset += stroke_size + nsegments * segment_size
+            points += nsegments
+    return strokes, points
+
+
 def _get_templates_per_page(path, id, path_templates):
 
     pagedata_file = "%s/%s.pagedata" % (path, id)
@@ -234,11 +283,13 @@ def _render_rm_file(rm_file_name, image_width=DEFAULT_IMAGE_WIDTH,
 
 
     # Iterate through layers on the page (There is at least one)
+    num_strokes, num_points = 0, 0
     packet = io.BytesIO()
     can = canvas.Canvas(packet, pagesize=(image_width, image_height))
     for layer in range(nlayers):
         fmt = '<I'
         (nstrokes,) = struct.unpack_from(fmt, data, offset); offset += struct.calcsize(fmt)
+        num_strokes += nstrokes
 
         # Iterate through the strokes in the layer (If there is any)
         for stroke in range(nstrokes):
@@ -291,6 +342,7 @@ def _render_rm_file(rm_file_name, image_width=DEFAULT_IMAGE_WIDTH,
                 opacity = 0.
 
             # Iterate through the segments to form a polyline
+            num_points += nsegments
             points = []
             width = []
             for segment in range(nsegments):
@@ -309,7 +361,6 @@ def _render_rm_file(rm_file_name, image_width=DEFAULT_IMAGE_WIDTH,
                 continue
             
             # Render lines
-            drawing = Drawing(image_width, image_height)
             can.setLineCap(1)
 
             if layer_colors[layer] is None:
@@ -332,6 +383,10 @@ def _render_rm_file(rm_file_name, image_width=DEFAULT_IMAGE_WIDTH,
     packet.seek(0)
     overlay = PdfReader(packet)
 
+    timing.count("render.pages")
+    timing.count("render.strokes", num_strokes)
+    timing.count("render.points", num_points)
+
     if is_landscape:
         for page in overlay.pages:
             page.Rotate=90
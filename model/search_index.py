@@ -0,0 +1,130 @@
+import model.item
+
+
+#
+# DEFINITIONS
+#
+BOOKMARK_PREFIX = "!b"
+
+
+#
+# HELPER
+#
+def parse_filter(filter):
+    """ Splits a filter string into (bookmarked_only, lowercase text).
+        To search only for bookmarked items the filter starts with "!b".
+    """
+    if filter is None:
+        return False, ""
+
+    if filter.startswith(BOOKMARK_PREFIX + " "):
+        return True, filter[len(BOOKMARK_PREFIX)+1:].lower()
+
+    if filter == BOOKMARK_PREFIX:
+        return True, ""
+
+    return False, filter.lower()
+
+
+#
+# CLASS
+#
+class SearchIndex(object):
+    """ Flat index of all items of the tree that is used to filter items.
+        The index is built once (e.g. after a sync) in pre-order such that
+        every parent is stored before its children. Therefore all ancestors
+        of the matching items can be found with a single bottom-up pass
+        over the index.
+    """
+
+    #
+    # CTOR
+    #
+    def __init__(self, root):
+        self.items = []
+        self.ids = []
+        self.names = []
+        self.bookmarked = []
+        self.parents = []
+        self.is_collection = []
+        self.ends = []
+
+        self._last_query = None
+        self._last_direct = None
+
+        self._add(root, -1)
+
+
+    #
+    # Functions
+    #
+    def match(self, filter):
+        """ Returns a dict that contains the ids of all items that should be
+            shown for the given filter. The value is True if the item should
+            be expanded in the tree view i.e. if it is not only shown because
+            one of its parent collections matches the filter.
+        """
+        query = parse_filter(filter)
+        direct = self._direct_matches(query)
+        self._last_query, self._last_direct = query, direct
+
+        # Children of a matching collection are shown (collapsed). As the
+        # index is in pre-order all children are in the range [i+1, end).
+        visible = {}
+        covered_end = 0
+        for i in direct:
+            if i < covered_end:
+                continue
+
+            visible[i] = True
+            if self.is_collection[i]:
+                for j in range(i+1, self.ends[i]):
+                    visible[j] = False
+                covered_end = self.ends[i]
+
+        # Bottom-up: all ancestors of a match are shown too. We can stop 
+        # as soon as we reach an ancestor that was already visited.
+        for i in direct:
+            p = self.parents[i]
+            while p > 0 and not p in visible:
+                visible[p] = True
+                p = self.parents[p]
+
+        return {self.ids[i]: is_open for i, is_open in visible.items()}
+
+
+    def _direct_matches(self, query):
+        bookmarked_only, text = query
+
+        # If the query extends the previous one, only the previous
+        # matches can match again.
+        candidates = range(1, len(self.items))
+        if self._last_query is not None:
+            last_bookmarked_only, last_text = self._last_query
+            if text.startswith(last_text) and (bookmarked_only or not last_bookmarked_only):
+                candidates = self._last_direct
+
+        direct = []
+        for i in candidates:
+            if self.items[i].state == model.item.STATE_DELETED:
+                continue
+            if bookmarked_only and not self.bookmarked[i]:
+                continue
+            if text in self.names[i]:
+                direct.append(i)
+        return direct
+
+
+    def _add(self, item, parent_pos):
+        pos = len(self.items)
+        self.items.append(item)
+        self.ids.append(item.id())
+        self.parents.append(parent_pos)
+        self.is_collection.append(item.is_collection())
+        self.names.append(item.name().lower())
+        self.bookmarked.append(item.bookmarked())
+        self.ends.append(pos+1)
+
+        for child in item.children():
+            self._add(child, pos)
+        self.ends[pos] = len(self.items)
@@ -0,0 +1,111 @@
+import threading
+import contextlib
+
+from utils.helper import Singleton
+
+
+#
+# HELPER
+#
+class _Flight(object):
+    """ A sync that is in progress. Callers that join it wait for the
+        event and get the same result (or error) as the caller that
+        started it.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _ItemLock(object):
+    """ Lock of the local files of an item. It is removed from the 
+        coordinator as soon as no thread holds or waits for it.
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.users = 0
+
+
+#
+# CLASS
+#
+class SyncCoordinator(metaclass=Singleton):
+    """ Ensures that every item is synced only once at a time, e.g. if a
+        document is double clicked while the background sync downloads it.
+        Concurrent syncs of the same item (by id, such that also items of
+        a reloaded tree are covered) wait for the sync in flight rather
+        than downloading, extracting and rendering it again.
+    """
+
+    #
+    # CTOR
+    #
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._item_locks = {}
+
+
+    #
+    # Functions
+    #
+    def run(self, id, fun):
+        """ Calls fun if no sync of the given item is in flight, otherwise
+            waits for it. Returns (result of fun, True if fun was called
+            by this caller).
+        """
+        with self._lock:
+            flight = self._flights.get(id, None)
+            is_leader = flight is None
+            if is_leader:
+                flight = _Flight()
+                self._flights[id] = flight
+
+        if not is_leader:
+            flight.done.wait()
+            if flight.error != None:
+                raise flight.error
+            return flight.result, False
+
+        try:
+            with self.item_lock(id):
+                flight.result = fun()
+            return flight.result, True
+
+        except BaseException as e:
+            flight.error = e
+            raise
+
+        finally:
+            with self._lock:
+                del self._flights[id]
+            flight.done.set()
+
+
+    def is_syncing(self, id):
+        with self._lock:
+            return id in self._flights
+
+
+    @contextlib.contextmanager
+    def item_lock(self, id):
+        """ Lock of the local files of the given item (use it as with-block).
+            It is held during a sync and should be held by all other 
+            operations that modify the local files (e.g. delete_local).
+        """
+        with self._lock:
+            item_lock = self._item_locks.get(id, None)
+            if item_lock is None:
+                item_lock = _ItemLock()
+                self._item_locks[id] = item_lock
+            item_lock.users += 1
+
+        try:
+            with item_lock.lock:
+                yield
+        finally:
+            with self._lock:
+                item_lock.users -= 1
+                if item_lock.users <= 0:
+                    del self._item_locks[id]
@@ -0,0 +1,154 @@
+import time
+import queue
+import threading
+
+from model.item_manager import ItemManager, UploadError
+from utils.helper import Singleton
+import utils.config as cfg
+
+
+#
+# DEFINITIONS
+#
+DEFAULT_NUM_WORKERS = 3
+DEFAULT_MAX_RETRIES = 3
+RETRY_BACKOFF_SECONDS = 2
+
+
+#
+# CLASS
+#
+class UploadJob(object):
+    """ A single file (or data) that should be uploaded into the rm cloud.
+    """
+
+    def __init__(self, id, parent_id, name, filetype, data=None, path=None,
+            state_listener=None, progress_listener=None, done_listener=None,
+            duplicate_listener=None):
+        self.id = id
+        self.parent_id = parent_id
+        self.name = name
+        self.filetype = filetype
+        self.data = data
+        self.path = path
+        self.state_listener = state_listener
+        self.progress_listener = progress_listener
+        self.done_listener = done_listener
+        self.duplicate_listener = duplicate_listener
+        self.attempts = 0
+
+
+class UploadManager(metaclass=Singleton):
+    """ Uploads files with a bounded number of worker threads such that 
+        pasting many files does not start one thread per file. Failed 
+        uploads are retried with an exponential backoff, but only if 
+        nothing was created in the rm cloud (see ItemManager.upload_file).
+
+        Settings (general section of the config):
+            upload_workers: Number of parallel uploads
+            upload_retries: Number of retries of a failed upload
+            upload_register_local: Use the uploaded file as local copy 
+                instead of downloading the document again
+            upload_check_duplicates: Ask before uploading a file that
+                already exists in the rm cloud
+    """
+
+    #
+    # CTOR
+    #
+    def __init__(self):
+        self.item_manager = ItemManager()
+        self.num_workers = cfg.get("general.upload_workers", DEFAULT_NUM_WORKERS)
+        self.max_retries = cfg.get("general.upload_retries", DEFAULT_MAX_RETRIES)
+        self.register_local = cfg.get("general.upload_register_local", True)
+        self.check_duplicates = cfg.get("general.upload_check_duplicates", True)
+
+        self._queue = queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+
+
+    #
+    # Functions
+    #
+    def upload(self, job: UploadJob):
+        """ Adds the job to the upload queue. The done_listener of the job is
+            called with (job, item, error) as soon as the upload finished.
+        """
+        self._start_workers()
+        self._queue.put(job)
+
+
+    def pending(self):
+        return self._queue.qsize()
+
+
+    def _start_workers(self):
+        with self._lock:
+            while len(self._workers) < self.num_workers:
+                worker = threading.Thread(target=self._worker, daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            try:
+                self._process(job)
+            finally:
+                self._queue.task_done()
+
+
+    def _process(self, job):
+        item, error = None, None
+
+        while job.attempts <= self.max_retries:
+            job.attempts += 1
+            try:
+                item = self.item_manager.upload_file(
+                    job.id, job.parent_id, job.name, job.filetype, 
+                    data=job.data, 
+                    state_listener=job.state_listener,
+                    path=job.path,
+                    progress=self._progress_function(job),
+                    register_local=self.register_local,
+                    on_duplicate=self._duplicate_function(job))
+                error = None
+                break
+            except UploadError as e:
+                error = e
+                print("(Warning) Upload of %s failed (attempt %d)" % (job.name, job.attempts))
+                print(e)
+                
+                if job.attempts <= self.max_retries:
+                    time.sleep(RETRY_BACKOFF_SECONDS * 2 ** (job.attempts - 1))
+            
+            except Exception as e:
+                # E.g. the file can not be read, a retry would not help
+                error = e
+                print("(Warning) Upload of %s failed" % job.name)
+                print(e)
+                break
+
+        if job.done_listener != None:
+            job.done_listener(job, item, error)
+
+
+    def _duplicate_function(self, job):
+        if job.duplicate_listener is None or not self.check_duplicates:
+            return None
+
+        def on_duplicate(existing):
+            # Ask only once, also if the upload is retried
+            listener, job.duplicate_listener = job.duplicate_listener, None
+            return listener(job, existing)
+        
+        return on_duplicate
+
+
+    def _progress_function(self, job):
+        if job.progress_listener is None:
+            return None
+
+        return lambda sent, total: job.progress_listener(job, sent, total)
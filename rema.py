@@ -10,6 +10,8 @@ import tkinter.ttk as ttk
 from gui.file_explorer import FileExplorer
 from gui.about import About
 from gui.settings import Settings
+from gui.mirror import MirrorTab
+from gui.dispatcher import GuiDispatcher
 
 import api.remarkable_client
 from api.remarkable_client import RemarkableClient
@@ -28,6 +30,7 @@ class Main(object):
 
         # Subscribe to events
         self.rm_client.listen_sign_in_event(self)
+        self.dispatcher = GuiDispatcher(window)
 
         # Window settings
         window.title("RemaPy Explorer")
@@ -44,7 +47,8 @@ class Main(object):
         self.notebook.pack(expand=1, fill="both")
 
         frame = ttk.Frame(self.notebook)
-        self.file_explorer = FileExplorer(frame, window, font_size=font_size, row_height=row_height)
+        self.file_explorer = FileExplorer(frame, window, font_size=font_size, 
+            row_height=row_height, dispatcher=self.dispatcher)
         self.notebook.add(frame, text="File Explorer")
 
         frame = ttk.Frame(self.notebook)
@@ -54,13 +58,14 @@ class Main(object):
         self.notebook.add(frame, text="Zotero", state="hidden")
 
         frame = ttk.Frame(self.notebook)
-        self.notebook.add(frame, text="Mirror", state="hidden")
+        self.mirror = MirrorTab(frame, window, self.dispatcher)
+        self.notebook.add(frame, text="Mirror")
 
         frame = ttk.Frame(self.notebook)
         self.notebook.add(frame, text="SSH", state="hidden")
 
         frame = ttk.Frame(self.notebook)
-        self.settings = Settings(frame, font_size)
+        self.settings = Settings(frame, font_size, self.dispatcher)
         self.notebook.add(frame, text="Settings")
         
         frame = ttk.Frame(self.notebook)
@@ -70,8 +75,10 @@ class Main(object):
         # Try to sign in to the rm cloud without a onetime code i.e. we 
         # assume that the user token is already available. If it is not 
         # possible we get a signal to disable "My remarkable" and settings
-        # are shown...
-        self.rm_client.sign_in()
+        # are shown... The user token is renewed in the background such 
+        # that the window is shown immediately; listeners are informed on 
+        # the main thread.
+        self.rm_client.sign_in_async(dispatch=self.dispatcher.post)
         
 
     #
@@ -0,0 +1,214 @@
+import time
+import threading
+
+
+#
+# DEFINITIONS
+#
+# Multiplicative decrease if the server throttles us (429 / 5xx)
+THROTTLE_DECREASE = 0.5
+# Gentle decrease if the latency grows without any gain in throughput
+LATENCY_DECREASE = 0.9
+# A window is congested if its latency is this much above the baseline...
+LATENCY_TOLERANCE = 2.0
+# ...and the throughput grew by less than this fraction
+THROUGHPUT_GAIN = 0.05
+# The baseline latency slowly follows the current latency
+BASELINE_DRIFT = 0.05
+
+
+#
+# HELPER
+#
+class _Slot(object):
+    """ One in-flight request. Slots are reentrant per thread such that
+        e.g. a streamed download can hold the slot of its request until
+        the whole body is read.
+    """
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.is_outer = False
+        self.num_bytes = 0
+        self.throttled = False
+        self.start = None
+
+    def __enter__(self):
+        current = getattr(self.limiter._local, "slot", None)
+        if current != None:
+            return current
+
+        self.limiter._acquire()
+        self.is_outer = True
+        self.start = time.perf_counter()
+        self.limiter._local.slot = self
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if not self.is_outer:
+            return False
+
+        self.limiter._local.slot = None
+        seconds = time.perf_counter() - self.start
+        self.limiter._release(self, seconds, ok=exc_type is None and not self.throttled)
+        return False
+
+    def add_bytes(self, num_bytes):
+        self.num_bytes += num_bytes
+
+
+#
+# CLASS
+#
+class AdaptiveLimiter(object):
+    """ Limits the number of concurrent requests with an AIMD controller:
+        The limit grows by one after each window of successful requests
+        and shrinks multiplicatively if the server throttles us (429 / 5xx)
+        or if the latency grows without any gain in throughput (e.g. if
+        the bandwidth is saturated). A window contains as many requests
+        as the current limit i.e. roughly one round trip.
+    """
+
+    #
+    # CTOR
+    #
+    def __init__(self, minimum=1, maximum=16, initial=4, adaptive=True):
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self.configure(minimum, maximum, initial, adaptive)
+
+
+    #
+    # Functions
+    #
+    def configure(self, minimum=1, maximum=16, initial=4, adaptive=True):
+        """ If adaptive is False, the limit is fixed to maximum.
+        """
+        with self._cond:
+            self.minimum = max(1, minimum)
+            self.maximum = max(self.minimum, maximum)
+            self.adaptive = adaptive
+            self._limit = float(min(max(initial, self.minimum), self.maximum)) \
+                if adaptive else float(self.maximum)
+            self._in_flight = 0
+            self._resume_at = 0
+            self._last_decrease = 0
+            self._baseline_latency = None
+            self._last_throughput = None
+            self._stats = {"requests": 0, "throttled": 0, "max_in_flight": 0,
+                "min_limit": self._limit, "max_limit": self._limit}
+            self._reset_window()
+            self._cond.notify_all()
+
+
+    def limit(self):
+        return int(self._limit)
+
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats["limit"] = self.limit()
+            return stats
+
+
+    def slot(self):
+        """ Waits until a request can be sent. Use it as with-block around
+            the request and the transfer of its body.
+        """
+        return _Slot(self)
+
+
+    def current_slot(self):
+        return getattr(self._local, "slot", None)
+
+
+    def throttle(self, retry_after=None):
+        """ Called if the server throttled the request of the current
+            slot. No requests are sent during the next retry_after seconds.
+        """
+        slot = self.current_slot()
+        with self._cond:
+            self._stats["throttled"] += 1
+            if slot != None:
+                slot.throttled = True
+
+            if retry_after != None and retry_after > 0:
+                self._resume_at = max(self._resume_at, time.time() + retry_after)
+
+            # Requests that were sent before the last decrease saw the same
+            # congestion, therefore we decrease only once per round trip.
+            if slot is None or slot.start >= self._last_decrease:
+                self._decrease(THROTTLE_DECREASE)
+            self._cond.notify_all()
+
+
+    #
+    # HELPER
+    #
+    def _acquire(self):
+        with self._cond:
+            while True:
+                wait = self._resume_at - time.time()
+                if wait <= 0 and self._in_flight < int(self._limit):
+                    break
+                self._cond.wait(timeout=wait if wait > 0 else None)
+
+            self._in_flight += 1
+            self._stats["requests"] += 1
+            self._stats["max_in_flight"] = max(self._stats["max_in_flight"], self._in_flight)
+
+
+    def _release(self, slot, seconds, ok):
+        with self._cond:
+            self._in_flight -= 1
+            if ok:
+                self._window_requests += 1
+                self._window_bytes += slot.num_bytes
+                self._window_seconds += seconds
+                if self._window_requests >= max(1, int(self._limit)):
+                    self._end_window()
+            self._cond.notify_all()
+
+
+    def _end_window(self):
+        elapsed = max(time.perf_counter() - self._window_start, 1e-6)
+        throughput = (self._window_bytes or self._window_requests) / elapsed
+        latency = self._window_seconds / self._window_requests
+
+        if self._baseline_latency is None or latency < self._baseline_latency:
+            self._baseline_latency = latency
+        else:
+            self._baseline_latency += (latency - self._baseline_latency) * BASELINE_DRIFT
+
+        congested = latency > self._baseline_latency * LATENCY_TOLERANCE and \
+            self._last_throughput != None and \
+            throughput < self._last_throughput * (1 + THROUGHPUT_GAIN)
+
+        if congested:
+            self._decrease(LATENCY_DECREASE)
+        elif self.adaptive:
+            self._set_limit(self._limit + 1)
+
+        self._last_throughput = throughput
+        self._reset_window()
+
+
+    def _decrease(self, factor):
+        if not self.adaptive:
+            return
+        self._set_limit(self._limit * factor)
+        self._last_decrease = time.perf_counter()
+        self._reset_window()
+
+
+    def _set_limit(self, limit):
+        self._limit = min(max(limit, self.minimum), self.maximum)
+        self._stats["min_limit"] = min(self._stats["min_limit"], self._limit)
+        self._stats["max_limit"] = max(self._stats["max_limit"], self._limit)
+
+
+    def _reset_window(self):
+        self._window_start = time.perf_counter()
+        self._window_requests = 0
+        self._window_bytes = 0
+        self._window_seconds = 0.0
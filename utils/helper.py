@@ -1,3 +1,4 @@
+import importlib
 
 
 class Singleton (type):
@@ -5,4 +6,19 @@ class Singleton (type):
     def __call__(cls, *args, **kwargs):
         if cls not in cls._instances:
             cls._instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
-        return cls._instances[cls]
\ No newline at end of file
+        return cls._instances[cls]
+
+
+class LazyModule(object):
+    """ Imports the module with the given name only when one of its 
+        attributes is accessed for the first time. Used for heavy modules 
+        (e.g. the render stack) that are not needed to show the window.
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
@@ -0,0 +1,219 @@
+import os
+import io
+import json
+import time
+import threading
+import functools
+from pathlib import Path
+
+import utils.config as cfg
+from utils.helper import LazyModule
+
+# Only needed if profiling is enabled
+pstats = LazyModule("pstats")
+cProfile = LazyModule("cProfile")
+
+
+#
+# DEFINITIONS
+#
+ENV_PROFILE = "REMAPY_PROFILE"
+ENV_PROFILE_THRESHOLD = "REMAPY_PROFILE_THRESHOLD"
+PATH_PROFILES = Path.joinpath(Path.home(), ".remapy/profiles")
+DEFAULT_THRESHOLD_SECONDS = 5.0
+NUM_SLOWEST = 20
+NUM_STATS_LINES = 40
+
+
+#
+# HELPER
+#
+class _NoProfiler(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_NO_PROFILER = _NoProfiler()
+
+
+class _Profiler(object):
+    """ Profiles the with-block with cProfile. The profile is only written
+        if the block took longer than the threshold. stats_fun is called
+        afterwards to get the (pages, strokes, points) of slow documents.
+    """
+    def __init__(self, id, name, stats_fun):
+        self.id = id
+        self.name = name
+        self.stats_fun = stats_fun
+        self.profiler = None
+        self.is_outer = False
+
+    def __enter__(self):
+        # Nested blocks (e.g. render inside of a sync) are part of
+        # the outer profile already.
+        if getattr(_local, "active", False):
+            return self
+
+        _local.active = True
+        self.is_outer = True
+        self.profiler = cProfile.Profile()
+        try:
+            self.profiler.enable()
+        except ValueError:
+            # Only one profiler can be active at once on some python
+            # versions, therefore we measure only the time in this case.
+            self.profiler = None
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        if not self.is_outer:
+            return False
+
+        seconds = time.perf_counter() - self.start
+        if self.profiler != None:
+            self.profiler.disable()
+        _local.active = False
+
+        profile_path = None
+        if seconds >= _threshold and self.profiler != None:
+            profile_path = _write_profile(self.id, self.profiler)
+        _add_result(self.id, self.name, seconds, profile_path, self.stats_fun)
+        return False
+
+
+_local = threading.local()
+_lock = threading.Lock()
+_slowest = []
+
+_enabled = os.environ.get(ENV_PROFILE, "") not in ("", "0") or \
+    bool(cfg.get("general.profile", default=False))
+_threshold = float(os.environ.get(ENV_PROFILE_THRESHOLD,
+    cfg.get("general.profilethreshold", default=DEFAULT_THRESHOLD_SECONDS)))
+
+
+def _write_profile(id, profiler):
+    try:
+        PATH_PROFILES.mkdir(parents=True, exist_ok=True)
+        path = Path.joinpath(PATH_PROFILES, "%s.prof" % id)
+        profiler.dump_stats(str(path))
+
+        # Also write a human readable version of the hottest functions
+        out = io.StringIO()
+        stats = pstats.Stats(profiler, stream=out)
+        stats.sort_stats("cumulative").print_stats(NUM_STATS_LINES)
+        with open(Path.joinpath(PATH_PROFILES, "%s.txt" % id), "w") as f:
+            f.write(out.getvalue())
+        return str(path)
+
+    except Exception as e:
+        print("(Warning) Failed to write profile.")
+        print(e)
+        return None
+
+
+def _add_result(id, name, seconds, profile_path, stats_fun):
+    with _lock:
+        if len(_slowest) >= NUM_SLOWEST and seconds <= _slowest[-1]["seconds"]:
+            return
+
+    # Only the slowest documents are analyzed
+    pages, strokes, points = (0, 0, 0)
+    if stats_fun != None:
+        try:
+            pages, strokes, points = stats_fun()
+        except Exception as e:
+            print("(Warning) Failed to count strokes of %s." % name)
+            print(e)
+
+    result = {
+        "id": id,
+        "name": name,
+        "seconds": seconds,
+        "pages": pages,
+        "strokes": strokes,
+        "points": points,
+        "profile": profile_path
+    }
+
+    with _lock:
+        _slowest[:] = [r for r in _slowest if r["id"] != id]
+        _slowest.append(result)
+        _slowest.sort(key=lambda r: r["seconds"], reverse=True)
+        del _slowest[NUM_SLOWEST:]
+
+
+#
+# Functions
+#
+def is_enabled():
+    return _enabled
+
+
+def enable(enabled=True, threshold=None):
+    global _enabled, _threshold
+    _enabled = enabled
+    if threshold != None:
+        _threshold = threshold
+
+
+def profile(id, name, stats_fun=None):
+    """ Profiles the with-block and writes a profile file into
+        ~/.remapy/profiles if it takes longer than the threshold.
+    """
+    if not _enabled:
+        return _NO_PROFILER
+    return _Profiler(id, name, stats_fun)
+
+
+def profiled(name, stats_fun=None):
+    """ Decorator that profiles every call of the given function. The 
+        optional stats_fun is called with the arguments of the call to 
+        count the (pages, strokes, points) of slow calls.
+    """
+    def decorator(fun):
+        @functools.wraps(fun)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fun(*args, **kwargs)
+
+            call_stats_fun = None
+            if stats_fun != None:
+                call_stats_fun = lambda: stats_fun(*args, **kwargs)
+
+            id = "%s_%d" % (name, int(time.time() * 1000))
+            with _Profiler(id, name, call_stats_fun):
+                return fun(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def slowest():
+    with _lock:
+        return list(_slowest)
+
+
+def dump_summary():
+    """ Writes the slowest documents (with their page, stroke and point
+        counts) into ~/.remapy/profiles/slowest.json. Returns the path of
+        the file or None if profiling is disabled.
+    """
+    if not _enabled:
+        return None
+
+    try:
+        PATH_PROFILES.mkdir(parents=True, exist_ok=True)
+        path = Path.joinpath(PATH_PROFILES, "slowest.json")
+        with open(path, "w") as out:
+            out.write(json.dumps({
+                "threshold": _threshold,
+                "documents": slowest()
+            }, indent=4))
+        return path
+
+    except Exception as e:
+        print("(Warning) Failed to write profile summary.")
+        print(e)
+        return None
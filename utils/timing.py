@@ -0,0 +1,225 @@
+import os
+import json
+import time
+import threading
+from pathlib import Path
+
+import utils.config as cfg
+
+
+#
+# DEFINITIONS
+#
+ENV_TIMING = "REMAPY_TIMING"
+PATH_TIMING = Path.joinpath(Path.home(), ".remapy/timing")
+
+
+#
+# HELPER
+#
+class _NoTimer(object):
+    """ Returned if timing is disabled such that instrumented code costs
+        not more than a function call.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_NO_TIMER = _NoTimer()
+
+
+class _Timer(object):
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.recorder.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _DocumentTimer(object):
+    def __init__(self, recorder, id, name):
+        self.recorder = recorder
+        self.id = id
+        self.name = name
+
+    def __enter__(self):
+        self.recorder.begin_document(self.id, self.name)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.recorder.end_document(time.perf_counter() - self.start)
+        return False
+
+
+#
+# CLASS
+#
+class Recorder(object):
+    """ Aggregates the time of all phases (and some counters) of a run
+        e.g. a sync. Phases that are measured while a document is synced
+        (i.e. inside of document()) are also added to this document.
+    """
+
+    #
+    # CTOR
+    #
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+
+    #
+    # Functions
+    #
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.phases = {}
+            self.counters = {}
+            self.documents = {}
+
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            self._add_phase(self.phases, name, seconds)
+            doc = self._current_document()
+            if doc != None:
+                self._add_phase(doc["phases"], name, seconds)
+
+
+    def add_count(self, name, value):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            doc = self._current_document()
+            if doc != None:
+                doc["counters"][name] = doc["counters"].get(name, 0) + value
+
+
+    def begin_document(self, id, name):
+        with self._lock:
+            if not id in self.documents:
+                self.documents[id] = {"name": name, "seconds": 0.0, "phases": {}, "counters": {}}
+        stack = getattr(self._local, "documents", [])
+        stack.append(id)
+        self._local.documents = stack
+
+
+    def end_document(self, seconds):
+        id = self._local.documents.pop()
+        with self._lock:
+            if id in self.documents:
+                self.documents[id]["seconds"] += seconds
+
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "started": self.started,
+                "seconds": time.time() - self.started,
+                "phases": self.phases,
+                "counters": self.counters,
+                "documents": self.documents
+            }
+
+
+    def _current_document(self):
+        stack = getattr(self._local, "documents", None)
+        if not stack:
+            return None
+        return self.documents.get(stack[-1], None)
+
+
+    def _add_phase(self, phases, name, seconds):
+        phase = phases.get(name, None)
+        if phase is None:
+            phase = phases[name] = {"count": 0, "seconds": 0.0, "max": 0.0}
+        phase["count"] += 1
+        phase["seconds"] += seconds
+        phase["max"] = max(phase["max"], seconds)
+
+
+_recorder = Recorder()
+_enabled = os.environ.get(ENV_TIMING, "") not in ("", "0") or \
+    bool(cfg.get("general.timing", default=False))
+
+
+#
+# Functions
+#
+def is_enabled():
+    return _enabled
+
+
+def enable(enabled=True):
+    global _enabled
+    _enabled = enabled
+
+
+def phase(name):
+    """ Measures the time of the with-block e.g.
+        with timing.phase("render.pdf"): ...
+    """
+    if not _enabled:
+        return _NO_TIMER
+    return _Timer(_recorder, name)
+
+
+def document(id, name):
+    """ All phases and counters inside of this with-block are also
+        aggregated for the document with the given id.
+    """
+    if not _enabled:
+        return _NO_TIMER
+    return _DocumentTimer(_recorder, id, name)
+
+
+def count(name, value=1):
+    if not _enabled:
+        return
+    _recorder.add_count(name, value)
+
+
+def reset():
+    if not _enabled:
+        return
+    _recorder.reset()
+
+
+def result():
+    return _recorder.to_dict()
+
+
+def dump(run_name):
+    """ Writes the timings of the current run as json file into
+        ~/.remapy/timing and starts a new run. Returns the path of the file
+        or None if timing is disabled.
+    """
+    if not _enabled:
+        return None
+
+    data = _recorder.to_dict()
+    data["run"] = run_name
+    _recorder.reset()
+
+    PATH_TIMING.mkdir(parents=True, exist_ok=True)
+    file_name = "%s_%s.json" % (run_name, time.strftime("%Y%m%d-%H%M%S", time.localtime(data["started"])))
+    path = Path.joinpath(PATH_TIMING, file_name)
+    try:
+        with open(path, "w") as out:
+            out.write(json.dumps(data, indent=4))
+    except Exception as e:
+        print("(Warning) Failed to write timings.")
+        print(e)
+        return None
+
+    return path